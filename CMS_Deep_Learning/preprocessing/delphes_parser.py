@@ -9,11 +9,20 @@ import numpy as np
 import math
 import time
 import pandas as pd
-from itertools import islice
+from itertools import cycle, islice
+from functools import partial
+import multiprocessing
+import threading
 import glob
 import ntpath
+import shutil
 import getopt
+from CMS_Deep_Learning.preprocessing.kinematics import fourMomentum
 from CMS_Deep_Learning.storage.meta import msgpack_assertMeta
+from CMS_Deep_Learning.storage.manifest import isConverted, recordConversion, readManifest, tempPath
+from CMS_Deep_Learning.storage.columnar import writeParquetFrames, PARQUET_EXT
+from CMS_Deep_Learning.storage.dataset_stats import fileStatsRecord
+from CMS_Deep_Learning.preprocessing.preprocessing import getNumValFrame
 
 
 def DeltaRsq(A_Eta, A_Phi, B_Eta, B_Phi):
@@ -93,51 +102,299 @@ def Iso(A_Eta, A_Phi, A_Pt, B_Eta, B_Phi, to_ommit=None,maxdist=0.3):
     out = np.sum(DRsq, axis=1, dtype='float64')/A_Pt
     return out
 
-def getMaxPt_Eta_Phi(leaves_by_object,entry,obj, PT_ET_MET="PT"):
+#The largest number of (A,B) pairs to hold in memory at once when computing
+#   distances for many entries in one go
+MAX_PAIRS = 2**22
+
+def _entryChunks(A_offsets, B_offsets, max_pairs=MAX_PAIRS):
+    '''Helper Function - splits the entries into contiguous ranges [first, last) that each have
+        at most max_pairs pairs of A and B objects (or a single entry if it alone has more)'''
+    n_entries = len(A_offsets) - 1
+    n_pairs = np.diff(A_offsets) * np.diff(B_offsets)
+    cum_pairs = np.concatenate([[0], np.cumsum(n_pairs)])
+    first = 0
+    while(first < n_entries):
+        last = np.searchsorted(cum_pairs, cum_pairs[first] + max_pairs, side='right') - 1
+        last = min(max(last, first + 1), n_entries)
+        yield first, last
+        first = last
+
+def _entryPairs(A_offsets, B_offsets, first, last):
+    '''Helper Function - gets the indicies (pair_a, pair_b) of every pair of an A and a B object that
+        are in the same entry, for all entries in [first, last). Pairs are grouped by A.'''
+    nA = np.diff(A_offsets[first:last+1])
+    nB = np.diff(B_offsets[first:last+1])
+    a_entry = np.repeat(np.arange(first, last), nA)
+    n_pairs_per_a = nB[a_entry - first]
+    pair_a = np.repeat(np.arange(A_offsets[first], A_offsets[last]), n_pairs_per_a)
+    pair_starts = np.cumsum(n_pairs_per_a) - n_pairs_per_a
+    within = np.arange(len(pair_a)) - np.repeat(pair_starts, n_pairs_per_a)
+    pair_b = np.repeat(B_offsets[a_entry], n_pairs_per_a) + within
+    return pair_a, pair_b
+
+def _pairDeltaRsq(A_Eta, A_Phi, B_Eta, B_Phi):
+    '''Helper Function - the squared angular distance between A[i] and B[i] for every i, like DeltaRsq'''
+    DeltaEta = A_Eta - B_Eta
+    DeltaPhi = A_Phi - B_Phi
+    DeltaPhi = DeltaPhi - 2.*math.pi*(DeltaPhi > math.pi) + 2.*math.pi*(DeltaPhi < -math.pi)
+    return DeltaEta*DeltaEta+DeltaPhi*DeltaPhi
+
+def _segmentArgmin(values, segment_ids):
+    '''Helper Function - finds the first minimum of values in each run of equal segment_ids
+        #Returns (segments, positions)
+            The id of every segment and the index into values of its first minimum (-1 if it is NaN)
+    '''
+    starts = np.flatnonzero(np.concatenate([[True], segment_ids[1:] != segment_ids[:-1]]))
+    lengths = np.diff(np.concatenate([starts, [len(values)]]))
+    mins = np.minimum.reduceat(values, starts)
+    idx = np.flatnonzero(values == np.repeat(mins, lengths))
+    seg_of_idx = np.repeat(np.arange(len(starts)), lengths)[idx]
+    first = np.concatenate([[True], seg_of_idx[1:] != seg_of_idx[:-1]])
+    positions = np.full((len(starts),), -1, dtype='int64')
+    positions[seg_of_idx[first]] = idx[first]
+    return segment_ids[starts], positions
+
+def selectJagged(offsets, keep):
+    '''Selects values out of a jagged array with a boolean mask
+        #Arguments
+            offsets -- The offsets of the jagged array (see readJagged)
+            keep -- A boolean numpy array with one value for each value of the jagged array
+        #Returns (offsets, indicies)
+            The offsets of the selected jagged array and the indicies of the values that were kept
+    '''
+    n_entries = len(offsets) - 1
+    entry_of = np.repeat(np.arange(n_entries), np.diff(offsets))
+    counts = np.bincount(entry_of[keep], minlength=n_entries)
+    return np.concatenate([[0], np.cumsum(counts)]), np.flatnonzero(keep)
+
+def batchTrackMatch(prt_offsets, prtEta, prtPhi, trk_offsets, trkEta, trkPhi, max_pairs=MAX_PAIRS):
+    '''Matches every reconstructed particle in a set of entries with its track, like trackMatch() but
+        for all entries at once.
+        #Arguments
+            prt_offsets -- The offsets of the particles of each entry (see readJagged)
+            prtEta, prtPhi -- numpy arrays with the Eta and Phi values of all the particles
+            trk_offsets -- The offsets of the tracks of each entry
+            trkEta, trkPhi -- numpy arrays with the Eta and Phi values of all the tracks
+            max_pairs -- How many particle-track pairs to compute distances for at a time
+        #Returns
+            A numpy array with the (global) index of the track closest to each particle, or -1 if
+            there are no tracks in the particle's entry.
+    '''
+    matches = np.full((len(prtEta),), -1, dtype='int64')
+    for first, last in _entryChunks(prt_offsets, trk_offsets, max_pairs):
+        pair_a, pair_b = _entryPairs(prt_offsets, trk_offsets, first, last)
+        if(len(pair_a) == 0): continue
+        delRsq = _pairDeltaRsq(prtEta[pair_a], prtPhi[pair_a], trkEta[pair_b], trkPhi[pair_b])
+        particles, positions = _segmentArgmin(delRsq, pair_a)
+        found = positions >= 0
+        matches[particles[found]] = pair_b[positions[found]]
+    return matches
+
+def _cellGrid(Eta, Phi, maxdist):
+    '''Helper Function - bins objects into cells in (eta, phi) that are at least maxdist wide, so that any two
+        objects closer than maxdist are in the same or in neighbouring cells. Phi cells wrap around.
+        #Returns (eta_cells, phi_cells, n_phi)
+            The eta and phi cell of each object and the number of cells in phi
+    '''
+    n_phi = max(int(2.*math.pi/maxdist), 1)
+    phi_width = 2.*math.pi/n_phi
+    eta_cells = np.floor(Eta/maxdist).astype('int64')
+    phi_cells = np.floor((Phi + math.pi)/phi_width).astype('int64') % n_phi
+    return eta_cells, phi_cells, n_phi
+
+def _gridPairs(A_offsets, A_Eta, A_Phi, B_offsets, B_Eta, B_Phi, first, last, maxdist):
+    '''Helper Function - like _entryPairs(), but only gets the pairs of A and B objects that are in the
+        same or in neighbouring (eta, phi) cells of the same entry. Pairs are grouped by A.'''
+    a_start, a_stop = A_offsets[first], A_offsets[last]
+    b_start, b_stop = B_offsets[first], B_offsets[last]
+    a_entry = np.repeat(np.arange(first, last), np.diff(A_offsets[first:last+1]))
+    b_entry = np.repeat(np.arange(first, last), np.diff(B_offsets[first:last+1]))
+    a_eta, a_phi, n_phi = _cellGrid(A_Eta[a_start:a_stop], A_Phi[a_start:a_stop], maxdist)
+    b_eta, b_phi, n_phi = _cellGrid(B_Eta[b_start:b_stop], B_Phi[b_start:b_stop], maxdist)
+
+    #Sort the B objects by (entry, eta cell, phi cell) so that each cell is a contiguous range
+    eta_min = min(a_eta.min(), b_eta.min()) - 1
+    n_eta = max(a_eta.max(), b_eta.max()) - eta_min + 2
+    def key(entry, eta, phi):
+        return ((entry - first) * n_eta + (eta - eta_min)) * n_phi + phi
+    b_keys = key(b_entry, b_eta, b_phi)
+    b_order = np.argsort(b_keys, kind='mergesort')
+    b_keys = b_keys[b_order]
+
+    #With fewer than 3 cells in phi some neighbours are the same cell, so only visit them once
+    phi_steps = sorted(set([d % n_phi for d in (-1, 0, 1)]))
+    lo, hi = [], []
+    for d_eta in (-1, 0, 1):
+        for d_phi in phi_steps:
+            k = key(a_entry, a_eta + d_eta, (a_phi + d_phi) % n_phi)
+            lo.append(np.searchsorted(b_keys, k, side='left'))
+            hi.append(np.searchsorted(b_keys, k, side='right'))
+    lo, hi = np.stack(lo, axis=1).ravel(), np.stack(hi, axis=1).ravel()
+    n_cands = hi - lo
+    pair_a = np.repeat(np.repeat(np.arange(a_start, a_stop), len(phi_steps)*3), n_cands)
+    cand_starts = np.cumsum(n_cands) - n_cands
+    within = np.arange(len(pair_a)) - np.repeat(cand_starts, n_cands)
+    pair_b = b_start + b_order[np.repeat(lo, n_cands) + within]
+    return pair_a, pair_b
+
+def batchIso(A_offsets, A_Eta, A_Phi, A_Pt, B_offsets, B_Eta, B_Phi, maxdist=0.3, max_pairs=MAX_PAIRS, use_grid=False):
+    '''Computes the isolation between two object types, like Iso() but for all entries at once.
+        #Arguments
+            A_offsets, B_offsets -- The offsets of the A and B objects of each entry (see readJagged)
+            (A or B)_Eta, (A or B)_Phi -- numpy arrays with the Eta and Phi values of all the objects
+            A_Pt -- numpy array with the transverse momentum of all the A objects
+            maxdist -- The maximum cartesian distance between Eta and Phi to be included in the isolation
+            max_pairs -- How many A-B pairs to compute distances for at a time
+            use_grid -- If True bin the objects into (eta, phi) cells and only compute distances between
+                        objects in neighbouring cells. Gives the same values, but is much faster for
+                        entries with many objects.
+        #Returns
+            The isolations of each particle in A w.r.t the particles in B in the same entry
+    '''
+    out = np.zeros((len(A_Eta),), dtype='float64')
+    for first, last in _entryChunks(A_offsets, B_offsets, max_pairs):
+        a_start, a_stop = A_offsets[first], A_offsets[last]
+        if(a_start == a_stop or B_offsets[first] == B_offsets[last]): continue
+        if(use_grid):
+            pair_a, pair_b = _gridPairs(A_offsets, A_Eta, A_Phi, B_offsets, B_Eta, B_Phi, first, last, maxdist)
+        else:
+            pair_a, pair_b = _entryPairs(A_offsets, B_offsets, first, last)
+        DRsq = _pairDeltaRsq(A_Eta[pair_a], A_Phi[pair_a], B_Eta[pair_b], B_Phi[pair_b])
+
+        #Exclude particles in B that are too far away
+        close = DRsq < maxdist*maxdist
+        pair_a, pair_b, DRsq = pair_a[close], pair_b[close], DRsq[close]
+        if(use_grid):
+            #Add up in the same order as without the grid so that the sums are identical
+            order = np.lexsort((pair_b, pair_a))
+            pair_a, DRsq = pair_a[order], DRsq[order]
+        out[a_start:a_stop] += np.bincount(pair_a - a_start, weights=DRsq, minlength=a_stop-a_start)
+    return out/A_Pt
+
+def _drawBuffer(buf, n):
+    '''Helper Function - copies the first n values of a TTree::Draw buffer (i.e. tree.GetV1()) into a numpy array'''
+    if(n <= 0):
+        return np.zeros((0,), dtype='float64')
+    try:
+        buf.SetSize(n)
+    except AttributeError:
+        #Newer PyROOT (cppyy) hands back a LowLevelView instead of a PyDoubleBuffer
+        buf.reshape((n,))
+    return np.array(buf, dtype='float64', copy=True)
+
+class ColumnBuffer(object):
+    '''A typed numpy array that values can be appended to. The underlying array grows geometrically
+        so that appending n values in total only copies O(n) values.
+        #Arguments
+            dtype -- The numpy dtype of the values
+            capacity -- How many values to allocate space for up front
+    '''
+    def __init__(self, dtype='float64', capacity=0):
+        self.data = np.zeros((max(int(capacity), 0),), dtype=dtype)
+        self.size = 0
+
+    def reserve(self, capacity):
+        '''Makes sure that there is room for at least capacity values'''
+        if(capacity > len(self.data)):
+            data = np.zeros((max(int(capacity), 2*len(self.data)),), dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+
+    def append(self, values):
+        '''Copies a numpy array of values onto the end of the buffer'''
+        self.reserve(self.size + len(values))
+        self.data[self.size:self.size + len(values)] = values
+        self.size += len(values)
+
+    def values(self):
+        '''Returns a numpy array of the values in the buffer (without copying them)'''
+        return self.data[:self.size]
+
+#How many entries readJagged() draws from the tree at a time. Bounds the size of the TTree::Draw buffers.
+READ_CHUNK_ENTRIES = 10000
+
+def readJagged(tree, obj, observs, first_entry, n_entries, chunk_entries=READ_CHUNK_ENTRIES):
+    '''Reads the branches of an object collection for a range of entries in bulk, with one TTree::Draw call
+        per branch and chunk of entries instead of one GetEntry/GetValue call per entry and value.
+        #Arguments
+            tree -- The Delphes TTree to read from
+            obj -- The type of object we are reading (i.e. Electron, EFlowTrack, etc.)
+            observs -- The ROOT observables to read for this kind of object (i.e. ['PT', 'Eta', 'Phi'])
+            first_entry -- The first entry in the ROOT file to read
+            n_entries -- How many entries to read
+            chunk_entries -- How many entries to draw from the tree at a time
+        #Returns (offsets, values)
+            offsets -- A numpy array of shape (n_entries+1,) such that the values of the i-th entry read
+                        are values[observ][offsets[i]:offsets[i+1]]
+            values -- A dictionary keyed by observable type of flat float64 numpy arrays containing the values
+                        of all the entries read one after the other
+    '''
+    offsets = np.zeros((n_entries + 1,), dtype='int64')
+    buffers = {observ : ColumnBuffer('float64') for observ in observs}
+    for start in range(first_entry, first_entry + n_entries, chunk_entries):
+        n_chunk = min(chunk_entries, first_entry + n_entries - start)
+
+        #Delphes stores the length of each TClonesArray in a leaf called <obj>_size
+        tree.SetEstimate(n_chunk + 1)
+        n = tree.Draw(obj + "_size", "", "goff", n_chunk, start)
+        counts = _drawBuffer(tree.GetV1(), n).astype('int64')
+        if(n != n_chunk):
+            raise IOError("Read %r values for %r in entries [%r, %r)" % (n, obj + "_size", start, start+n_chunk))
+        i = start - first_entry
+        np.cumsum(counts, out=offsets[i+1:i+n_chunk+1])
+        offsets[i+1:i+n_chunk+1] += offsets[i]
+        chunk_values = int(offsets[i+n_chunk] - offsets[i])
+
+        #Size the buffers by extrapolating from the first chunk, they grow if that was not enough
+        if(start == first_entry):
+            for buf in buffers.values():
+                buf.reserve(chunk_values * n_entries // n_chunk)
+
+        #Make sure that TTree::Draw keeps every value and not just the first 'estimate' of them
+        tree.SetEstimate(max(chunk_values, n_chunk) + 1)
+        for observ in observs:
+            n = tree.Draw(obj + "." + observ, "", "goff", n_chunk, start)
+            if(n != chunk_values):
+                raise IOError("Read %r values for %r but %r has %r values in entries [%r, %r)"
+                                % (n, obj + "." + observ, obj + "_size", chunk_values, start, start+n_chunk))
+            buffers[observ].append(_drawBuffer(tree.GetV1(), n))
+    return offsets, {observ : buf.values() for observ, buf in buffers.items()}
+
+def getMaxPt_Eta_Phi(jagged_by_object,obj, PT_ET_MET="PT"):
     '''Returns the PT, Eta and Phi corresponding to the particle of the highest PT in the object collection
+        of every entry
         #Arguments
-            dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
-                                    keyed by observable type. Arrays are expected to be prefilled with
-                                    zeros
-            leaves_by_object -- A dictionary keyed by object type, containing dictionaries of tuples
-                                like (leaf, branch) keyed by observable type. Only valid ROOT
-                                observables are used as keys. Each (leaf,branch) pair corresponds
-                                to the leaf and branch of a ROOT observable.
-            entry -- The entry to in the ROOT file to read from
-        #Returns PT, Eta, Phi or if empty 0,0,0
+            jagged_by_object -- A dictionary keyed by object type containing the (offsets, values) jagged
+                                arrays returned by readJagged()
+            obj -- The type of object to look through
+            PT_ET_MET -- The particluar flavor of transverse energy for this kind of object either
+                        ('PT',  'ET', 'MET')
+        #Returns PT, Eta, Phi
+            numpy arrays with one value per entry, or 0,0,0 for entries that are empty
     '''
-    d = leaves_by_object[obj]
-    for (leaf, branch) in d.values():
-        branch.GetEntry(entry)
-    n_values = d["Phi"][0].GetLen()
-    l_PT = d[PT_ET_MET][0]
-    l_Eta = d["Eta"][0]
-    l_Phi = d["Phi"][0]
-    max_PT, max_index = 0.0,-1
-    # print(obj,n_values)
-    for i in range(n_values):
-        PT = l_PT.GetValue(i)
-        if(PT > max_PT):
-            max_PT, max_index = PT, i
-    if(max_index == -1):
-        return 0.0,0.0,0.0
-
-    return max_PT, l_Eta.GetValue(max_index), l_Phi.GetValue(max_index)
-
-
-def fill_object(dicts_by_object,leaves_by_object,entry, start_index,obj, PT_ET_MET, M, others, maxLepPT_Eta_Phi, METPT_Eta_Phi):
-    '''Fills an object with values for a given entry
+    offsets, values = jagged_by_object[obj]
+    n_entries = len(offsets) - 1
+    PT = values[PT_ET_MET]
+    out = [np.zeros((n_entries,), dtype='float64') for i in range(3)]
+    if(len(PT) == 0): return tuple(out)
+    entries, positions = _segmentArgmin(-PT, np.repeat(np.arange(n_entries), np.diff(offsets)))
+    found = (positions >= 0)
+    found[found] = PT[positions[found]] > 0.0
+    entries, positions = entries[found], positions[found]
+    for arr, observ in zip(out, [PT_ET_MET, "Eta", "Phi"]):
+        arr[entries] = values[observ][positions]
+    return tuple(out)
+
+
+def fill_object(dicts_by_object,jagged_by_object, obj, PT_ET_MET, M, others):
+    '''Fills the table columns of an object type for every entry read at once
         #Arguments
             dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
-                                keyed by observable type. Arrays are expected to be prefilled with
-                                zeros
-            leaves_by_object -- A dictionary keyed by object type, containing dictionaries of tuples 
-                                like (leaf, branch) keyed by observable type. Only valid ROOT 
-                                observables are used as keys. Each (leaf,branch) pair corresponds
-                                to the leaf and branch of a ROOT observable.
-            entry -- The entry to in the ROOT file to read from
-            start_index -- Where to start filling each array in the dictionary dicts_by_object[obj].
-                            They should all have the same length since each array is a column in a table.
+                                keyed by observable type. Arrays are expected to be numpy arrays
+                                prefilled with zeros (see allocateColumns)
+            jagged_by_object -- A dictionary keyed by object type containing the (offsets, values) jagged
+                                arrays returned by readJagged(). Only valid ROOT observables are keys
+                                of values.
             obj -- The type of object we are filling
             PT_ET_MET -- The particluar flavor of transverse energy for this kind of object either 
                         ('PT',  'ET', 'MET')
@@ -145,131 +402,56 @@ def fill_object(dicts_by_object,leaves_by_object,entry, start_index,obj, PT_ET_M
             others -- Any ROOT observables unique to this kind of object that we should read
                                              
         #Returns 
-            The number of values filled in for each column of our table
+            A numpy array with the number of values filled in for each entry
             
     '''
-    d = leaves_by_object[obj]
+    offsets, values = jagged_by_object[obj]
     fill_dict = dicts_by_object[obj]
-    for (leaf, branch) in d.values():
-        branch.GetEntry(entry)
-    n_values = d["Phi"][0].GetLen()
-    # print(obj,n_values)
-
-    #start_index = index_by_objects[obj]
-    lv = ROOT.TLorentzVector()
-    l_PT = d[PT_ET_MET][0]
-    l_Eta = d["Eta"][0]
-    l_Phi = d["Phi"][0]
-    l_others = [(other, d[other][0]) for other in others]
-    #lv_leaves = [d[ lorentz_vars[i] ][0] for i in range(lorentz_vars)]
-    maxLepPT, maxLepEta, maxLepPhi = maxLepPT_Eta_Phi
-    METPT, METEta, METPhi = METPT_Eta_Phi
-    for i in range(n_values):
-        index = start_index + i
-        # print(obj,index)
-        PT = l_PT.GetValue(i)
-        Eta = l_Eta.GetValue(i)
-        Phi = l_Phi.GetValue(i)
-        lv.SetPtEtaPhiM(PT,Eta,Phi, M)
-        fill_dict["Entry"][index] = entry
-        fill_dict["E/c"][index] = lv.E()
-        fill_dict["Px"][index] = lv.Px()
-        fill_dict["Py"][index] = lv.Py()
-        fill_dict["Pz"][index] = lv.Pz()
-        fill_dict["PT_ET"][index] = PT
-        fill_dict["Eta"][index] = Eta
-        fill_dict["Phi"][index] = Phi
-
-        # maxLepDeltaRSqr = (Eta-maxLepEta) ** 2 + (Phi-maxLepPhi)**2
-        # fill_dict["MaxLepDeltaR"][index] = np.sqrt(maxLepDeltaRSqr)
-        # fill_dict["MaxLepKt"][index] = min(PT**2, maxLepPT**2) * maxLepDeltaRSqr
-        # fill_dict["MaxLepAntiKt"][index] = min(PT**-2, maxLepPT**-2) * maxLepDeltaRSqr
-        # METDeltaRSqr = (Eta-METEta)**2 + (Phi-METPhi)**2
-        # fill_dict["METDeltaR"][index] = np.sqrt(METDeltaRSqr)
-        # fill_dict["METKt"][index] = min(PT ** 2, METPT ** 2) * METDeltaRSqr
-        # fill_dict["METAntiKt"][index] = min(PT ** -2, METPT ** -2) * METDeltaRSqr
-
-        for (other, l_other) in l_others:
-            #if(obj == "EFlowTrack"): print(other, l_other.GetValue(i))
-            fill_dict[other][index] = l_other.GetValue(i)
-        # for OUTPUT_OBSERVS
-    return n_values 
-def fillTrackMatch(dicts_by_object,obj, trackIndicies, prtStart, trackStart):
-    '''Fills an object with values for a given entry
+    counts = np.diff(offsets)
+
+    PT = values[PT_ET_MET]
+    E, Px, Py, Pz = fourMomentum(PT, values["Eta"], values["Phi"], M)
+    fill_dict["Entry"][:] = np.repeat(np.arange(len(counts)), counts)
+    fill_dict["E/c"][:] = E
+    fill_dict["Px"][:] = Px
+    fill_dict["Py"][:] = Py
+    fill_dict["Pz"][:] = Pz
+    fill_dict["PT_ET"][:] = PT
+    fill_dict["Eta"][:] = values["Eta"]
+    fill_dict["Phi"][:] = values["Phi"]
+    for other in others:
+        fill_dict[other][:] = values[other]
+    return counts
+
+def fillTrackMatch(dicts_by_object,obj, trackIndicies):
+    '''Fills the track information of an object type from the tracks it was matched with
         #Arguments
             dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
-                                keyed by observable type. Arrays are expected to be prefilled with
-                                zeros
+                                keyed by observable type.
             obj -- The type of object we are matching with a track
-            trackIndicies -- The result of trackMatch(). A numpy array of indicies corresponding to
-                            tracks being matched to particles
-            prtStart -- Where to start filling in X,Y,Z, and Dxy values for paricles matched to tracks
-            trackStart -- Where to start reading track values from.
-                #Note: We need to know where to start because we may not be filling or reading from
-                        the beginning of each of our table columns.
-                                             
+            trackIndicies -- The result of batchTrackMatch(). A numpy array of indicies corresponding to
+                            tracks being matched to particles, or -1 for particles without a track.
         #Returns(void)
             
     '''
     l = dicts_by_object[obj]
     t = dicts_by_object["EFlowTrack"]
-    lX = l["X"]
-    lY = l["Y"]
-    lZ = l["Z"]
-    lDxy = l["Dxy"]
-    tX = t["X"]
-    tY = t["Y"]
-    tZ = t["Z"]
-    tDxy = t["Dxy"]
-    for lepI, trkI in enumerate(trackIndicies):
-        lepIndex = lepI + prtStart
-        trkIndex = trkI + trackStart
-        # print(obj, lepIndex, trkIndex, tX[trkIndex], tY[trkIndex], tZ[trkIndex])
-        lX[lepIndex] = tX[trkIndex]
-        lY[lepIndex] = tY[trkIndex]
-        lZ[lepIndex] = tZ[trkIndex]
-        lDxy[lepIndex] = tDxy[trkIndex]
+    matched = trackIndicies >= 0
+    for observ in ["X", "Y", "Z", "Dxy"]:
+        l[observ][matched] = t[observ][trackIndicies[matched]]
 
     
-def fillIso(dicts_by_object,obj, isoType,  obj_start,iso):
-    '''Fills an object with values for a given entry
+def fillIso(dicts_by_object,obj, isoType, iso):
+    '''Fills the isolation values of an object type
         #Arguments
             dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
-                                keyed by observable type. Arrays are expected to be prefilled with
-                                zeros
+                                keyed by observable type.
             obj -- The type of object are running isolation on
             isoType -- The object type corresponding to the type of isolation we are running
-            obj_start -- Where to start filling in isolation values
-                 #Note: We need to know where to start because we may not be filling or reading from
-                        the beginning of each of our table columns.
-            iso -- The result of Iso(). A list of isolation values.
+            iso -- The result of batchIso(). A numpy array of isolation values.
         #Returns(void)     
     '''
-    isoArr = dicts_by_object[obj][isoType]
-    # print(type(iso), iso)
-    for i in range(len(iso)):
-        isoArr[obj_start+i] = iso[i]
-
-def getEtaPhiPTasNumpy(dicts_by_object,obj, start, n_vals):
-    '''Gets numpy arrays corresponding to all of the Eta, Phi, and Pt values for a given object type
-            in a given sample. Here start and n_vals specifiy where the sample starts and how long it is. 
-        #Arguments
-            dicts_by_object -- A dictionary keyed by object type containing dictionaries of arrays
-                                keyed by observable type. Arrays are expected to be prefilled with
-                                zeros
-            obj -- The type of object we are reading from to create our numpy arrays
-            start -- where to start reading in that object
-                #Note: We need to know where to start because we may not be filling or reading from
-                        the beginning of each of our table columns.
-            n_vals -- How many values to read.
-        #Returns
-            Eta, Phi, Pt -- numpy arrays    
-    '''
-    d = dicts_by_object[obj]
-    Eta =  np.array( d["Eta"][start:start+n_vals] )
-    Phi =  np.array( d["Phi"][start:start+n_vals] )
-    Pt =  np.array( d["PT_ET"][start:start+n_vals] )
-    return Eta, Phi, Pt 
+    dicts_by_object[obj][isoType][:] = iso
 
 
 #Masses for electrons and muons
@@ -289,153 +471,170 @@ OUTPUT_OBSERVS =  ['Entry','E/c', 'Px', 'Py', 'Pz', 'PT_ET','Eta', 'Phi',
                     'MaxLepDeltaR', 'MaxLepKt', 'MaxLepAntiKt','METDeltaR', 'METKt', 'METAntiKt',
                     'Charge', 'X', 'Y', 'Z', 'Dxy', 'Ehad', 'Eem', 'MuIso', 'EleIso','ChHadIso','NeuHadIso','GammaIso']
 ISO_TYPES = [('MuIso', 'MuonTight'), ('EleIso','Electron'), ('ChHadIso','EFlowTrack') ,('NeuHadIso','EFlowNeutralHadron'),('GammaIso','EFlowPhoton')]
+#The dtypes of the columns in OUTPUT_OBSERVS that are not float64
+OUTPUT_DTYPES = {'Entry' : 'int32'}
 
-def delphes_to_pandas(filepath, verbosity=1, fixedNum=None):
+def allocateColumns(n):
+    '''Allocates zero filled numpy arrays for every column of the output tables
+        #Arguments
+            n -- The number of rows in the table
+        #Returns
+            A dictionary keyed by observable type (see OUTPUT_OBSERVS) of numpy arrays of shape (n,)
+    '''
+    return {observ : np.zeros((n,), dtype=OUTPUT_DTYPES.get(observ, 'float64')) for observ in OUTPUT_OBSERVS}
+
+def delphes_to_pandas(filepath, verbosity=1, fixedNum=None, use_grid=False, start=0, stop=None):
+    '''Parses a Delphes ROOT file into a dictionary of pandas DataFrames keyed by object type
+        #Arguments
+            filepath -- The path to the ROOT file
+            verbosity -- 0:silent, 1:print timing information
+            fixedNum -- If not None, only parse this many entries starting at start
+            use_grid -- Whether or not to use an (eta, phi) grid to compute isolation (see batchIso)
+            start, stop -- Only parse the entries in [start, stop). Entries are numbered w.r.t the whole ROOT
+                        file, so the Entry column starts at start and NumValues is indexed from start.
+        #Returns
+            A dictionary keyed by object type of DataFrames with the columns in OUTPUT_OBSERVS and
+            a DataFrame keyed by "NumValues" with the number of rows of each object type in each entry
+    '''
     start_time = time.clock()
     fileIN = ROOT.TFile.Open(filepath)
     tree = fileIN.Get("Delphes")
-    if(fixedNum == None):
-        n_entries=tree.GetEntries()
-    else:
-        n_entries = fixedNum
+    if(stop == None):
+        stop = tree.GetEntries() if fixedNum == None else start + fixedNum
+    n_entries = stop - start
 
     tree.SetCacheSize(30*1024*1024)
 
-    #Get all the leaves that we need to read and their associated branches
-    leaves_by_object = {}
+    #Read every branch that we need in bulk as jagged arrays
+    jagged_by_object = {}
     for obj in OBJECT_TYPES:
-        leaves_by_object[obj] = {}
-        for observ in ROOT_OBSERVS:
-            leaf = tree.GetLeaf(obj + '.' + observ)
-            if(isinstance(leaf,ROOT.TLeafElement)):
-                leaves_by_object[obj][observ] = (leaf, leaf.GetBranch())
-
+        observs = [observ for observ in ROOT_OBSERVS
+                        if isinstance(tree.GetLeaf(obj + '.' + observ), ROOT.TLeafElement)]
+        jagged_by_object[obj] = readJagged(tree, obj, observs, start, n_entries)
 
     #Allocate the data for the tables by filling arrays with zeros
     dicts_by_object = {}
     dicts_by_object["NumValues"] = {}
     for obj in OBJECT_TYPES:
-        dicts_by_object[obj] = {}
-        (leaf, branch) = leaves_by_object[obj]['Phi']
-        total_values = 0
-
-        #Loop over all the Phi values (since everything has Phi) and accumilate
-        #   the total number of values for each object type
-        for entry in range(n_entries):
-            branch.GetEntry(entry)
-            total_values += leaf.GetLen()
-
-        #Fill arrays with zeros to avoid reallocating data later
-        for observ in OUTPUT_OBSERVS:
-            dicts_by_object[obj][observ] = [0] * total_values
-        dicts_by_object["NumValues"][obj] = [0] * n_entries
-
-
-    index_by_objects = {o:0 for o in OBJECT_TYPES}
-    last_time = time.clock()
-    prev_entry = 0
-    to_ommit = []
-    beep_count = 0
-    for entry in range(n_entries):
-
-        #Make a pretty progress bar in the terminal
-        if(verbosity > 0):
-            c = time.clock() 
-            if(c > last_time + .25):
-                percent = float(entry)/float(n_entries)
-                sys.stdout.write('\r')
-                sys.stdout.write("[%-20s] %r/%r  %r(Entry/sec)" % ('='*int(20*percent), entry, int(n_entries), 4 * (entry-prev_entry)))
-                sys.stdout.flush()
-                last_time = c
-                prev_entry = entry
-
-        #Initialize some temporary helper variables
-        number_by_object = {}
-        Eta_Phi_PT_by_object = {}
-
-        #Find the PT,Eta, and Phi for the leption with the highest PT, and for the MET
-        maxLepPT_Eta_Phi = max([getMaxPt_Eta_Phi(leaves_by_object, entry, obj) for obj in LEPTON_TYPES], \
-                                            key=lambda x: x[0])
-        # print([getMaxPt_Eta_Phi(leaves_by_object, entry, obj) for obj in LEPTON_TYPES])
-        if(maxLepPT_Eta_Phi[0] == 0.0): beep_count += 1
-        METPT_Eta_Phi = getMaxPt_Eta_Phi(leaves_by_object, entry,"MissingET", "MET")
-
-        #Fill each type of object with everything that is observable in the ROOT file for that object
-        #   in addition to Energy and the three components of momentum
-        for obj, PT_ET_type, mass, extra_fills in zip(OBJECT_TYPES, PT_ET_TYPES, MASSES, EXTRA_FILLS):
-            start = index_by_objects[obj]
-            n = fill_object(dicts_by_object,leaves_by_object,entry, start, obj, PT_ET_type, mass, extra_fills, maxLepPT_Eta_Phi, METPT_Eta_Phi)
-            dicts_by_object["NumValues"][obj][entry] = n
-            number_by_object[obj] = n
-            Eta_Phi_PT_by_object[obj] = getEtaPhiPTasNumpy(dicts_by_object,obj, start, n)
-
-        #Do Track matching for objects with TRACK_MATCH = True
-        trkEta, trkPhi, dummy = Eta_Phi_PT_by_object["EFlowTrack"]
-        start_tracks = index_by_objects["EFlowTrack"]
-        for obj, ok in zip(OBJECT_TYPES, TRACK_MATCH):
-            if(ok):
-                start = index_by_objects[obj]
-                Phi, Eta, PT = Eta_Phi_PT_by_object[obj]
-                matches = trackMatch(Phi, Eta, trkEta, trkPhi)
-                track_ommitions = matches.tolist()
-                to_ommit += [start_tracks + x for x in track_ommitions]
-                isoEta, isoPhi, isoPt = Eta_Phi_PT_by_object["EFlowTrack"]
-
-                #Omit info for repeat tracks, for Isolation calculation
-                sel = np.arange(len(isoEta))
-                sel = np.delete(sel, track_ommitions)
-                Eta_Phi_PT_by_object["EFlowTrack"] = isoEta[sel], isoPhi[sel], isoPt[sel]
-                fillTrackMatch(dicts_by_object,obj, matches, start, start_tracks)
-
-        #Compute isolation
-        for obj, ok in zip(OBJECT_TYPES, COMPUTE_ISO):
-            start = index_by_objects[obj]
-            if(ok):
-                objEta, objPhi, objPt = Eta_Phi_PT_by_object[obj]
-                for iso_type, iso_obj in ISO_TYPES:
-                    isoEta, isoPhi, isoPt = Eta_Phi_PT_by_object[iso_obj]
-                    iso_val = Iso(objEta, objPhi, objPt, isoEta, isoPhi)
-                    iso_val = iso_val - 1.0 if obj == iso_obj else iso_val
-                    fillIso(dicts_by_object,obj, iso_type,  start, iso_val)
-
-        for obj in OBJECT_TYPES:
-            index_by_objects[obj] += number_by_object[obj]
+        offsets, values = jagged_by_object[obj]
+        dicts_by_object[obj] = allocateColumns(int(offsets[-1]))
+
+
+    #Fill each type of object with everything that is observable in the ROOT file for that object
+    #   in addition to Energy and the three components of momentum
+    for obj, PT_ET_type, mass, extra_fills in zip(OBJECT_TYPES, PT_ET_TYPES, MASSES, EXTRA_FILLS):
+        dicts_by_object["NumValues"][obj] = fill_object(dicts_by_object,jagged_by_object, obj, PT_ET_type, mass, extra_fills)
+
+    #Find the PT,Eta, and Phi for the leption with the highest PT
+    maxLepPT = np.maximum(*[getMaxPt_Eta_Phi(jagged_by_object, obj)[0] for obj in LEPTON_TYPES])
+    beep_count = int(np.sum(maxLepPT == 0.0))
+
+    offsets_by_object = {obj : jagged_by_object[obj][0] for obj in OBJECT_TYPES}
+
+    #Do Track matching for objects with TRACK_MATCH = True
+    trk = dicts_by_object["EFlowTrack"]
+    trk_offsets = offsets_by_object["EFlowTrack"]
+    track_keep = np.ones((len(trk["Eta"]),), dtype='bool')
+    for obj, ok in zip(OBJECT_TYPES, TRACK_MATCH):
+        if(ok):
+            d = dicts_by_object[obj]
+            matches = batchTrackMatch(offsets_by_object[obj], d["Eta"], d["Phi"], trk_offsets, trk["Eta"], trk["Phi"])
+            fillTrackMatch(dicts_by_object,obj, matches)
+            track_keep[matches[matches >= 0]] = False
+
+    #Remove Tracks that correspond to Electrons and Muons, and update the numValues so that they are correct.
+    #   This also omits them from the isolation calculation
+    offsets_by_object["EFlowTrack"], kept = selectJagged(trk_offsets, track_keep)
+    dicts_by_object["EFlowTrack"] = {observ : column[kept] for observ, column in trk.items()}
+    dicts_by_object["NumValues"]["EFlowTrack"] = np.diff(offsets_by_object["EFlowTrack"])
+
+    #Compute isolation
+    for obj, ok in zip(OBJECT_TYPES, COMPUTE_ISO):
+        if(ok):
+            d = dicts_by_object[obj]
+            for iso_type, iso_obj in ISO_TYPES:
+                B = dicts_by_object[iso_obj]
+                iso_val = batchIso(offsets_by_object[obj], d["Eta"], d["Phi"], d["PT_ET"],
+                                    offsets_by_object[iso_obj], B["Eta"], B["Phi"], use_grid=use_grid)
+                iso_val = iso_val - 1.0 if obj == iso_obj else iso_val
+                fillIso(dicts_by_object,obj, iso_type, iso_val)
+
     pandas_out = {}
     for obj,d in dicts_by_object.items():
         if(obj == "NumValues"):
-            pandas_out[obj] = pd.DataFrame(d, columns=OBJECT_TYPES)
+            pandas_out[obj] = pd.DataFrame(d, columns=OBJECT_TYPES, index=np.arange(start, stop))
         else:
+            d["Entry"] += start
             pandas_out[obj] = pd.DataFrame(d, columns=OUTPUT_OBSERVS)
-    
-    #Remove Tracks that correspond to Electrons and Muons
-    df = pandas_out["EFlowTrack"]
-    to_drop = df.iloc[to_ommit]
-    to_subtract = to_drop[['Entry']].groupby('Entry').agg({'Entry':'count'})
-    to_subtract = to_subtract.rename(columns={'Entry':'EFlowTrack'})
-   
-    #Update the numValues so that they are correct
-    pandas_out["NumValues"] = pandas_out["NumValues"].sub(to_subtract,fill_value=0)
-
-    #assert pandas_out["NumValues"]['EFlowTrack'].dtype == int, "NumValues is wrong dtype, %r" %  pandas_out["EFlowTrack"]['Entry'].dtype
-    
-    cleaned = df.drop(df.index[to_ommit]).reset_index(drop=True)
-    pandas_out["EFlowTrack"] = cleaned
 
-    print("ElapseTime: %.2f" % float(time.clock()-start_time))
-    print("BEEP:",beep_count, n_entries)
+    if(verbosity >= 1):
+        print("ElapseTime: %.2f" % float(time.clock()-start_time))
+        print("BEEP:",beep_count, n_entries)
     return pandas_out
 
 
+def _parseRange(args):
+    '''Helper Function - parses a range of entries of a ROOT file, used as the task for worker processes'''
+    filepath, start, stop, use_grid = args
+    return delphes_to_pandas(filepath, verbosity=0, use_grid=use_grid, start=start, stop=stop)
+
+def stitchFrames(chunks):
+    '''Concatenates the output of delphes_to_pandas() for consecutive ranges of entries
+        #Arguments
+            chunks -- A list of dictionaries of DataFrames as returned by delphes_to_pandas(), in order of entry
+        #Returns
+            A dictionary of DataFrames like delphes_to_pandas() would return for the whole range
+    '''
+    out = {}
+    for key in chunks[0]:
+        if(key == "NumValues"):
+            out[key] = pd.concat([c[key] for c in chunks])
+        else:
+            out[key] = pd.concat([c[key] for c in chunks], ignore_index=True)
+    return out
+
+#How many entries to give each worker at a time when parsing one ROOT file in parallel
+PARSE_CHUNK_ENTRIES = 5000
+
+def parseChunked(filepath, start=0, stop=None, num_workers=1, chunk_entries=PARSE_CHUNK_ENTRIES, use_grid=False):
+    '''Parses a range of entries of a ROOT file by splitting it into chunks that are parsed in parallel,
+        and then stitching the chunks back together.
+        #Arguments
+            filepath -- The path to the ROOT file
+            start, stop -- Only parse the entries in [start, stop). If stop is None parse to the end of the file.
+            num_workers -- How many processes to parse chunks with. If 1 chunks are parsed in this process.
+            chunk_entries -- How many entries are in each chunk
+            use_grid -- Whether or not to use an (eta, phi) grid to compute isolation (see batchIso)
+        #Returns
+            A dictionary of DataFrames like delphes_to_pandas(filepath, start=start, stop=stop)
+    '''
+    if(stop == None):
+        fileIN = ROOT.TFile.Open(filepath)
+        stop = fileIN.Get("Delphes").GetEntries()
+        fileIN.Close()
+    tasks = [(filepath, a, min(a+chunk_entries, stop), use_grid) for a in range(start, stop, chunk_entries)]
+    if(len(tasks) == 0): tasks = [(filepath, start, stop, use_grid)]
+    if(num_workers <= 1 or len(tasks) == 1):
+        chunks = [_parseRange(t) for t in tasks]
+    else:
+        pool = multiprocessing.Pool(min(num_workers, len(tasks)))
+        try:
+            chunks = pool.map(_parseRange, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    return stitchFrames(chunks)
+
 #http://stackoverflow.com/questions/3678869/pythonic-way-to-combine-two-lists-in-an-alternating-fashion
 def roundrobin(*iterables):
    "roundrobin('ABC', 'D', 'EF') --> A D E B F C"
    # Recipe credited to George Sakkis
    pending = len(iterables)
-   nexts = cycle(iter(it).next for it in iterables)
+   nexts = cycle(partial(next, iter(it)) for it in iterables)
    while pending:
       try:
-         for next in nexts:
-             yield next()
+         for nxt in nexts:
+             yield nxt()
       except StopIteration:
          pending -= 1
          nexts = cycle(islice(nexts, pending))
@@ -458,75 +657,223 @@ def makeJobs(filename,
     #    jobs.append((f, store_dir))
     return jobs
 
-def doJob(job, redo=False):
+def doJob(job, redo=False, retries=0, num_workers=1):
+    '''Parses a ROOT file and stores the result, retrying if something goes wrong
+        #Arguments
+            job -- A (filepath, store_dir, storeType) tuple as returned by makeJobs()
+            redo -- Whether or not to parse the file again if its output already exists
+            retries -- How many more times to try if parsing or storing the file raises an error
+            num_workers -- How many processes to parse chunks of the file with (see parseChunked)
+        #Returns
+            The number of samples stored, 0 if the file could not be parsed or stored after every attempt
+    '''
     f, store_dir, storeType = job
-    try:
-        return store(f, store_dir,rerun=redo,storeType=storeType)
-    except Exception as e:
-        print(e)
-        print("Something weird happened when parsing %r." % f)
+    for attempt in range(retries+1):
+        try:
+            return store(f, store_dir,rerun=redo,storeType=storeType, num_workers=num_workers)
+        except Exception as e:
+            print(e)
+            print("Something weird happened when parsing %r. (attempt %r of %r)" % (f, attempt+1, retries+1))
+    print("Skipping %r after %r attempts" % (f, retries+1))
     return 0
 
+def _timedJob(label, job, redo, retries, num_workers=1):
+    '''Helper Function - runs doJob() and times it, used as the task for worker processes'''
+    start_time = time.time()
+    num = doJob(job, redo=redo, retries=retries, num_workers=num_workers)
+    return label, job, num, time.time()-start_time
 
+def _timedTask(task):
+    '''Helper Function - runs _timedJob() on a tuple of its arguments, used with Pool.imap_unordered'''
+    return _timedJob(*task)
 
+def runJobs(jobs_by_label, num_workers=1, redo=False, num_samples=None, retries=1, split_files=False, verbosity=1):
+    '''Parses and stores the ROOT files of several labels (i.e. sample directories) with a pool of
+        worker processes. Jobs from different labels are interleaved so that every label makes progress
+        at the same rate.
+        #Arguments
+            jobs_by_label -- A list of lists of jobs as returned by makeJobs(), one list for each label
+            num_workers -- How many processes to parse files with. If 1 files are parsed in this process.
+            redo -- Whether or not to parse files again if their output already exists
+            num_samples -- If not None, stop scheduling files for a label once this many samples
+                            have been stored for it. Files that are already being parsed are finished,
+                            so a label may end up with a few more samples.
+            retries -- How many more times to try files that raise an error before skipping them
+            split_files -- If True parse files one at a time, splitting each file into chunks of entries
+                            that are parsed by num_workers processes (see parseChunked). Balances the load
+                            better when there are few files or their sizes vary a lot.
+            verbosity -- 0:silent, 1:report on every file and at the end
+        #Returns
+            A list with the number of samples stored for each label
+    '''
+    tasks = roundrobin(*[[(label, job) for job in jobs] for label, jobs in enumerate(jobs_by_label)])
+    samples_read = [0] * len(jobs_by_label)
+    num_files, num_bytes = 0, 0
+    start_time = time.time()
+
+    def nextTask():
+        for label, job in tasks:
+            if(num_samples == None or samples_read[label] < num_samples):
+                return label, job
+        return None
+
+    def report(label, job, num, elapsed):
+        samples_read[label] += num
+        if(verbosity >= 1):
+            print("Parsed %r samples from %r in %.2fs" % (num, job[0], elapsed))
+            if(num_samples != None):
+                print("Parsed %r of %r samples for %r" % (samples_read[label], num_samples, job[1]))
+
+    if(num_workers <= 1 or split_files):
+        task = nextTask()
+        while(task != None):
+            report(*_timedJob(task[0], task[1], redo, retries, num_workers))
+            num_files += 1
+            num_bytes += os.path.getsize(task[1][0])
+            task = nextTask()
+    else:
+        #Keep every worker busy, but do not schedule more than we might need. The pool takes a task from
+        #scheduled() only once a worker is free and the samples of the files before it have been counted.
+        free_workers = threading.Semaphore(num_workers)
+        stopped = []
+        def scheduled():
+            while True:
+                free_workers.acquire()
+                task = None if stopped else nextTask()
+                if(task == None): return
+                yield (task[0], task[1], redo, retries)
+
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            for label, job, num, elapsed in pool.imap_unordered(_timedTask, scheduled()):
+                report(label, job, num, elapsed)
+                num_files += 1
+                num_bytes += os.path.getsize(job[0])
+                free_workers.release()
+        finally:
+            #Let scheduled() return if it is still waiting for a worker, i.e. when a job raised
+            stopped.append(True)
+            free_workers.release()
+            pool.close()
+            pool.join()
+
+    elapsed = time.time()-start_time
+    if(verbosity >= 1):
+        print("Parsed %r samples from %r files (%.1f MB) in %.2fs with %r workers: %.1f samples/s, %.1f MB/s"
+                % (sum(samples_read), num_files, num_bytes/1e6, elapsed, num_workers,
+                   sum(samples_read)/max(elapsed, 1e-9), num_bytes/1e6/max(elapsed, 1e-9)))
+    return samples_read
+
+
+def _parseForStore(filepath, start, stop, num_workers):
+    '''Helper Function - parses a range of entries of a ROOT file for store(). If only part of the file is
+        parsed Entry and NumValues are renumbered to start at 0, so that the output can be read on its own.'''
+    frames = parseChunked(filepath, start=start, stop=stop, num_workers=num_workers)
+    if(start != 0):
+        for key, frame in frames.items():
+            if(key == "NumValues"):
+                frame.index = frame.index - start
+            else:
+                frame["Entry"] -= start
+    return frames
+
+def _adoptOutput(filepath, outputdir, out_name, storeType, start, stop):
+    '''Helper Function - records an output file that was written before it had a manifest entry (i.e. by an older
+        version of store()) as converted from filepath, so that it is not parsed again. Its entries and statistics
+        come from its NumValues frame.
+        #Returns
+            The number of samples in the output, or None if it doesn't exist, was already recorded as converted
+            or can't be read
+    '''
+    out_file = outputdir + out_name
+    #Records with only statistics (see dataset_stats.directoryStats) don't say that the output was converted
+    if(not os.path.exists(out_file) or "source" in readManifest(outputdir).get(out_name, {})):
+        return None
+    try:
+        num_val_frame = getNumValFrame(out_file, storeType)
+    except Exception as e:
+        print(e)
+        print("Failed to read existing output %r, parsing %r again" % (out_file, filepath))
+        return None
+    num = len(num_val_frame.index)
+    recordConversion(outputdir, out_name, filepath, num, start=start, stop=stop,
+                     **fileStatsRecord(out_file, num_val_frame))
+    return num
 
-def store(filepath, outputdir, rerun=False, storeType="hdf5"):
+def store(filepath, outputdir, rerun=False, storeType="hdf5", start=0, stop=None, num_workers=1):
+    '''Parses a ROOT file and stores the result in outputdir, unless the manifest of outputdir says
+        that it has already been stored (see CMS_Deep_Learning.storage.manifest). Outputs that exist without
+        a manifest entry are added to the manifest instead of being parsed again.
+        #Arguments
+            filepath -- The path to the ROOT file
+            outputdir -- The directory to store the output in
+            rerun -- Whether or not to parse the file again if its output already exists
+            storeType -- The format to store the output in, either 'hdf5', 'msgpack' or 'parquet'
+            start, stop -- Only parse the entries in [start, stop). The output file is named
+                        <name>_<start>-<stop> unless the whole file is parsed.
+            num_workers -- How many processes to parse chunks of the file with (see parseChunked)
+        #Returns
+            The number of samples stored. Errors parsing or writing the file are raised after any partial
+            output is removed, so that doJob() can try again.
+    '''
     filename = os.path.splitext(ntpath.basename(filepath))[0]
+    if(start != 0 or stop != None):
+        filename = "%s_%s-%s" % (filename, start, "" if stop == None else stop)
     if(storeType == "hdf5"):
-        out_file = outputdir + filename + ".h5"
-        print(out_file)
-        store = pd.HDFStore(out_file)
-        keys = store.keys()
-        #print("KEYS:", set(keys))
-        #print("KEYS:", set(["/"+key for key in OBJECT_TYPES+["NumValues"]]))
-        #print("KEYS:", set(keys)==set(["/"+key for key in OBJECT_TYPES+["NumValues"]]))
-        if(set(keys) != set(["/"+key for key in OBJECT_TYPES+["NumValues"]]) or rerun):
-            #print("OUT",out_file)
-            try:
-                frames = delphes_to_pandas(filepath)
-            except Exception as e:
-                print(e)
-                print("Failed to parse file %r. File may be corrupted." % f)
-                return 0
+        out_name = filename + ".h5"
+    elif(storeType == "msgpack"):
+        out_name = filename + ".msg"
+    elif(storeType == "parquet"):
+        out_name = filename + PARQUET_EXT
+    else:
+        raise ValueError("storeType %r not recognized" % storeType)
+    out_file = outputdir + out_name
+    print(out_file)
+
+    #Skip files that the manifest says were completely converted from the current version of the ROOT file,
+    #and outputs from before there was a manifest
+    if(not rerun):
+        record = isConverted(outputdir, out_name, filepath)
+        if(record != None):
+            return record["entries"]
+        num = _adoptOutput(filepath, outputdir, out_name, storeType, start, stop)
+        if(num != None):
+            return num
+
+    try:
+        frames = _parseForStore(filepath, start, stop, num_workers)
+    except Exception:
+        print("Failed to parse file %r. File may be corrupted." % filepath)
+        raise
+
+    #Write to a temporary file and rename it when it is done, so that a crash never leaves a partial output
+    tmp_file = tempPath(out_file)
+    try:
+        if(storeType == "hdf5"):
+            store = pd.HDFStore(tmp_file, mode='w')
             try:
                 for key,frame in frames.items():
                     store.put(key, frame, format='table')
-            except Exception as e:
-                print(e)
-                print("Failed to write to HDFStore %r" % out_file)
-                return 0
-        num = len(store.get('NumValues').index)
-        store.close()
-    elif(storeType == "msgpack"):
-        out_file = outputdir + filename + ".msg"
-        # meta_out_file = outputdir + filename + ".meta"
-        print(out_file)
-        if(not os.path.exists(out_file) or rerun):
-            try:
-                frames = delphes_to_pandas(filepath)
-            except Exception as e:
-                print(e)
-                print("Failed to parse file %r. File may be corrupted." % f)
-                return 0
-            try:
-                pd.to_msgpack(out_file, frames)
-            except Exception as e:
-                print(e)
-                print("Failed to write msgpack %r" % out_file)
-                return 0
-            # pd.to_msgpack(meta_out_file, meta_frames)
-            meta_frames = msgpack_assertMeta(out_file, frames)
+            finally:
+                store.close()
+        elif(storeType == "parquet"):
+            writeParquetFrames(tmp_file, frames)
         else:
-            meta_frames = msgpack_assertMeta(out_file)
-
-        num = len(meta_frames["NumValues"].index)
-        # elif(not os.path.exists(meta_out_file)):
-        #     print(".meta file missing creating %r" % meta_out_file)
-        #     frames = pd.read_msgpack(out_file)
-        #     meta_frames = {"NumValues" : frames["NumValues"]}
-        #     pd.to_msgpack(meta_out_file, meta_frames)
-    else:
-        raise ValueError("storeType %r not recognized" % storeType)
+            pd.to_msgpack(tmp_file, frames)
+        #A directory can only be renamed onto a path that does not exist
+        if(os.path.isdir(out_file)): shutil.rmtree(out_file)
+        os.rename(tmp_file, out_file)
+    except Exception:
+        print("Failed to write %r" % out_file)
+        if(os.path.isdir(tmp_file)): shutil.rmtree(tmp_file)
+        elif(os.path.exists(tmp_file)): os.remove(tmp_file)
+        raise
+    if(storeType == "msgpack"):
+        msgpack_assertMeta(out_file, frames, redo=True)
+
+    num = len(frames["NumValues"].index)
+    recordConversion(outputdir, out_name, filepath, num, start=start, stop=stop,
+                     **fileStatsRecord(out_file, frames["NumValues"]))
     return num
 
 def main(data_dir, argv):
@@ -534,39 +881,53 @@ def main(data_dir, argv):
     storeType = "hdf5"
     redo = False
     num_samples = None
-    screwup_error = "python delphes_parser.py <input_dir>"
+    num_workers = 1
+    retries = 1
+    split_files = False
+    screwup_error = "python delphes_parser.py <input_dir> [<input_dir> ...] [-j <num_workers>] [-s] [-n <num_samples>] [-m|-p|--hdf5] [-r] [--retries <retries>] [-h]"
     try:
-        opts, args = getopt.getopt(argv,'n:mrh')
+        #data_dir is parsed too, so that options can come first (i.e. -h)
+        opts, args = getopt.gnu_getopt([data_dir] + argv,'n:mprhj:s',
+                            ["msg", "msgpack", "parquet", "hdf", "hdf5", "redo", "num_samples=", "workers=", "retries=", "split", "help"])
         print(opts)
         print(args)
     except getopt.GetoptError:
-        print screwup_error
+        print(screwup_error)
         sys.exit(2)
   
     for opt, arg in opts:
       # print(opt, arg)
-        if opt in ("-m", "--msg", "--msgpack"):
+        if opt in ("-h", "--help"):
+            print(screwup_error)
+            sys.exit(0)
+        elif opt in ("-m", "--msg", "--msgpack"):
             storeType = "msgpack"
-        elif opt in ('-h5', "--hdf", "--hdf5"):
+        elif opt in ("-p", "--parquet"):
+            storeType = "parquet"
+        elif opt in ("--hdf", "--hdf5"):
             storeType = "hdf5"
         elif opt in ('-r', "--redo"):
             redo = True
         elif opt in ('-n', "--num_samples"):
             if(arg == ''): arg = None
             num_samples = int(arg)
+        elif opt in ('-j', "--workers"):
+            num_workers = int(arg)
+        elif opt in ("--retries",):
+            retries = int(arg)
+        elif opt in ('-s', "--split"):
+            split_files = True
     print(num_samples)
     print(storeType)
-    folder = "/pandas_h5/" if storeType == "hdf5" else "/pandas_msg/"
-    jobs = makeJobs(data_dir,storeType, folder=folder)
-
-    samples_read = 0
-    for job in jobs:
-        # print(job)
-        samples_read += doJob(job, redo=redo)
-        if(num_samples != None):
-            print("Parsed %r of %r samples" %(samples_read, num_samples))
-            if(samples_read >= num_samples):
-                break
+    folder = {"hdf5" : "/pandas_h5/", "msgpack" : "/pandas_msg/", "parquet" : "/pandas_parquet/"}[storeType]
+
+    #Every input directory is a label, files from different labels are parsed in alternating order
+    if(len(args) == 0):
+        print(screwup_error)
+        sys.exit(2)
+    jobs_by_label = [makeJobs(d,storeType, folder=folder) for d in args]
+    runJobs(jobs_by_label, num_workers=num_workers, redo=redo, num_samples=num_samples, retries=retries,
+            split_files=split_files)
             
 
 
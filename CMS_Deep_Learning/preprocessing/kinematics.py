@@ -0,0 +1,83 @@
+'''
+kinematics.py
+Vectorized relativistic kinematics for whole collections of objects. Everything is in natural
+units (c = 1) and follows the conventions of ROOT's TLorentzVector so that columns computed here
+match the ones the parser used to build one particle at a time.
+'''
+
+import sys
+import numpy as np
+
+#Column names can be unicode in python 2
+if(sys.version_info[0] > 2):
+    _string_types = (str,)
+else:
+    _string_types = (str, unicode)
+
+
+def fourMomentum(PT, Eta, Phi, M):
+    '''Computes the four-momentum of a collection of objects, like TLorentzVector.SetPtEtaPhiM
+        #Arguments
+            #consider N = # of objects
+            PT  -- A numpy array of shape (N,) of the transverse momenta (or energies) of the objects
+            Eta -- A numpy array of shape (N,) of the pseudorapidities of the objects
+            Phi -- A numpy array of shape (N,) of the azimuthal angles of the objects
+            M   -- The mass of the objects, either a single number or a numpy array of shape (N,)
+        #Returns E, Px, Py, Pz
+            numpy arrays of shape (N,) with the energy and the three components of momentum
+    '''
+    PT = np.abs(np.asarray(PT, dtype='float64'))
+    Eta = np.asarray(Eta, dtype='float64')
+    Phi = np.asarray(Phi, dtype='float64')
+    M = np.asarray(M, dtype='float64')
+
+    Px = PT * np.cos(Phi)
+    Py = PT * np.sin(Phi)
+    Pz = PT * np.sinh(Eta)
+    Psq = Px*Px + Py*Py + Pz*Pz
+    #TLorentzVector treats negative masses as spacelike vectors
+    E = np.where(M >= 0.0, np.sqrt(Psq + M*M), np.sqrt(np.maximum(Psq - M*M, 0.0)))
+    return E, Px, Py, Pz
+
+def PtEtaPhiM(E, Px, Py, Pz):
+    '''Computes the transverse momentum, pseudorapidity, azimuthal angle and mass of a collection of four-vectors
+        #Arguments
+            #consider N = # of objects
+            E, Px, Py, Pz -- numpy arrays of shape (N,) with the energy and the three components of momentum
+        #Returns PT, Eta, Phi, M
+            numpy arrays of shape (N,). Eta is +/-inf for objects moving along the beam axis.
+    '''
+    E = np.asarray(E, dtype='float64')
+    Px = np.asarray(Px, dtype='float64')
+    Py = np.asarray(Py, dtype='float64')
+    Pz = np.asarray(Pz, dtype='float64')
+
+    PT = np.hypot(Px, Py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Eta = np.arcsinh(Pz / PT)
+    Eta = np.where(PT == 0.0, np.copysign(np.inf, Pz), Eta)
+    Phi = np.arctan2(Py, Px)
+    return PT, Eta, Phi, invariantMass(E, Px, Py, Pz)
+
+def invariantMass(E, Px, Py, Pz):
+    '''Computes the invariant mass of a collection of four-vectors, negative for spacelike vectors like TLorentzVector.M'''
+    E = np.asarray(E, dtype='float64')
+    Msq = E*E - (np.asarray(Px, dtype='float64')**2 + np.asarray(Py, dtype='float64')**2 + np.asarray(Pz, dtype='float64')**2)
+    return np.sign(Msq) * np.sqrt(np.abs(Msq))
+
+def addFourMomentumColumns(df, M, PT_column="PT_ET", Eta_column="Eta", Phi_column="Phi",
+                            output_columns=("E/c", "Px", "Py", "Pz")):
+    '''Adds energy and momentum columns to a table of objects in one array operation
+        #Arguments
+            df -- A pandas DataFrame with transverse momentum, Eta and Phi columns
+            M -- The mass of the objects, either a single number or the name of a column of df
+            PT_column, Eta_column, Phi_column -- The columns to read from
+            output_columns -- The names of the (E, Px, Py, Pz) columns to write
+        #Returns
+            df with the added columns
+    '''
+    if(isinstance(M, _string_types)): M = df[M].values
+    four_momentum = fourMomentum(df[PT_column].values, df[Eta_column].values, df[Phi_column].values, M)
+    for column, values in zip(output_columns, four_momentum):
+        df[column] = values
+    return df
@@ -1,8 +1,9 @@
 import glob
+import itertools
+import multiprocessing
 import os
 import re
 import sys
-import threading
 import time
 
 import numpy as np
@@ -10,6 +11,10 @@ import pandas as pd
 
 from CMS_Deep_Learning.storage.archiving import DataProcedure
 from CMS_Deep_Learning.storage.meta import msgpack_assertMeta
+from CMS_Deep_Learning.storage.columnar import readParquetFrame, readParquetNumValues, parquetColumns, PARQUET_EXT
+from CMS_Deep_Learning.storage.entry_index import loadEntryIndex
+from CMS_Deep_Learning.storage.dataset_stats import directoryStats, mergeStats, multiplicityQuantile
+from CMS_Deep_Learning.storage.prefetch import DataPrefetcher
 
 DEFAULT_PROFILE = {
                         "name" : " ",
@@ -23,6 +28,12 @@ DEFAULT_PROFILE = {
                         "addColumns" : None}
 class ObjectProfile():
     
+    #The numpy dtype of the preprocessed array for this object type, None to use the dtype of the preprocessing
+    #function. Only stored on the profile when it is set, so that it does not change the hash of older procedures.
+    dtype = None
+    #The fraction of events whose objects must all fit when max_size is resolved, None to fit every event.
+    #Like dtype it is only stored on the profile when it is set.
+    quantile = None
 
 
     def __init__(self, *args, **kargs):
@@ -39,6 +50,9 @@ class ObjectProfile():
                 shuffle     -- Whether or not to shuffle the data
                 addColumns -- A dictionary with single constant floats or integers to fill an additional column in the table.
                              This column should be in observ_types if it is used with preprocessFromPandas_label_dir_pairs
+                dtype -- The numpy dtype (i.e. 'float32') of the preprocessed array for this object type. Ignored if single_list.
+                quantile -- If max_size is unresolved (-1), resolve it to the smallest size that holds all of the objects
+                            of this fraction of the events (i.e. 0.995) instead of the largest event (See resolveProfileMaxes)
         '''
         d = {}
         if(isinstance(args[0], dict)):
@@ -56,6 +70,13 @@ class ObjectProfile():
 
         if (isinstance(self.pre_sort_columns, str)): self.pre_sort_columns = [self.pre_sort_columns]
         if (isinstance(self.sort_columns, str)): self.sort_columns = [self.sort_columns]
+        dtype = kargs.get("dtype", d.get("dtype", None))
+        if(dtype != None): self.dtype = np.dtype(dtype).name
+        quantile = kargs.get("quantile", d.get("quantile", None))
+        if(quantile != None):
+            if(quantile <= 0.0 or quantile > 1.0):
+                raise ValueError("quantile must be in (0, 1]. Got %r" % quantile)
+            self.quantile = float(quantile)
 
         if(self.max_size < -1):
             raise ValueError("max_size cannot be less than -1. Got %r" % self.max_size)
@@ -79,15 +100,23 @@ class ObjectProfile():
         if(self.query != None):
             query_clause = 'query=%r ' % (self.query)
         shuffle_clause = 'shuffle=%r' % self.shuffle
-
-        return main_clause + sort_clause + query_clause + shuffle_clause
+        dtype_clause = ''
+        if(self.dtype != None):
+            dtype_clause = ' dtype=%r' % self.dtype
+        quantile_clause = ''
+        if(self.quantile != None):
+            quantile_clause = ' quantile=%r' % self.quantile
+
+        return main_clause + sort_clause + query_clause + shuffle_clause + dtype_clause + quantile_clause
     
     __repr__ = __str__
 
 def resolveProfileMaxes(object_profiles, label_dir_pairs, padding_multiplier = 1.0):
     '''Resolves the maximum number of objects for each ObjectProfile. Only runs if ObjectProfile.max_size
         is equal to -1 or None indicating that the value is unresolved. By resolving our max_size(s) we
-        can make our preprocessing data sets as small as possible without truncating any data.
+        can make our preprocessing data sets as small as possible without truncating any data. Profiles with
+        a quantile are resolved to fit that fraction of the events of all the labels together, truncating the
+        rest (See truncationReport).
         #Arguments:
             object_profiles -- The list of ObjectProfile(s) to resolve
             label_dir_pairs -- A list of tuples of the form (label, data_directory) that contain
@@ -106,30 +135,61 @@ def resolveProfileMaxes(object_profiles, label_dir_pairs, padding_multiplier = 1
                 maxes[profile.name] = 0
     if(len(unresolved) == 0): return
     
-    for (label,data_dir) in label_dir_pairs:
-        files, storeType = getFiles_StoreType(data_dir)
-        # files = glob.glob(data_dir+"*.h5")
-        files.sort()
-        
-         #Loop the files associated with the current label
-        for f in files:
-          
-            # #Get the HDF Store for the file
-            # store = pd.HDFStore(f)
-
-            # #Get the NumValues frame which lists the number of values for each entry
-            # try:
-            #     num_val_frame = store.get('/NumValues')
-            # except KeyError as e:
-            #     raise KeyError(str(e) + " " + f)
-            num_val_frame = getNumValFrame(f,storeType)
-
-            for profile in unresolved:
-                maxes[profile.name] = max(num_val_frame[profile.name].max(), maxes[profile.name])
+    stats = _labelStats(label_dir_pairs, [p.name for p in unresolved])
+    for profile in unresolved:
+        if(profile.quantile != None):
+            maxes[profile.name] = multiplicityQuantile(stats["objects"][profile.name], profile.quantile)
+        else:
+            maxes[profile.name] = stats["objects"][profile.name]["max"]
     
     for profile in unresolved:
         profile.max_size = int(np.ceil(maxes[profile.name] * padding_multiplier))
 
+def _labelStats(label_dir_pairs, names):
+    '''Helper Function - the statistics of all of the label directories together. Raises a KeyError if any of
+        them has no objects of a type in names.'''
+    stats_list = []
+    for (label,data_dir) in label_dir_pairs:
+        stats = getDatasetStats(data_dir)
+        for name in names:
+            if(not name in stats["objects"]):
+                raise KeyError("No object type %r in %r" % (name, data_dir))
+        stats_list.append(stats)
+    return mergeStats(stats_list)
+
+def truncationReport(object_profiles, label_dir_pairs, verbose=1):
+    '''Computes how much data is lost by cutting each object type at the max_size of its ObjectProfile. Since it is
+        computed from the multiplicities in NumValues it does not account for queries, which can only lower it.
+        #Arguments:
+            object_profiles -- The list of ObjectProfile(s), with resolved max_sizes
+            label_dir_pairs -- A list of tuples of the form (label, data_directory)
+            verbose -- If 1 or more print the report
+        #Returns
+            A dictionary keyed by object type like {"max_size":, "events":, "truncated_events":, "objects":,
+            "truncated_objects":} where truncated_events is how many events have more than max_size objects
+            and truncated_objects is how many objects are cut from them
+    '''
+    stats = _labelStats(label_dir_pairs, [p.name for p in object_profiles])
+    report = {}
+    for profile in object_profiles:
+        if(profile.max_size == -1 or profile.max_size == None):
+            raise ValueError("ObjectProfile max_sizes must be resolved before computing truncation")
+        hist = np.array(stats["objects"][profile.name]["hist"], dtype='int64')
+        over = np.arange(len(hist)) - profile.max_size
+        report[profile.name] = {"max_size" : profile.max_size,
+                                "events" : int(hist.sum()),
+                                "truncated_events" : int(hist[over > 0].sum()),
+                                "objects" : stats["objects"][profile.name]["rows"],
+                                "truncated_objects" : int((hist * np.maximum(over, 0)).sum())}
+    if(verbose >= 1):
+        for profile in object_profiles:
+            r = report[profile.name]
+            print("%s: max_size=%r truncates %r/%r events (%.3f%%) and %r/%r objects (%.3f%%)" %
+                  (profile.name, r["max_size"], r["truncated_events"], r["events"],
+                   100.0 * r["truncated_events"] / max(r["events"], 1), r["truncated_objects"], r["objects"],
+                   100.0 * r["truncated_objects"] / max(r["objects"], 1)))
+    return report
+
 def label_dir_pairs_args_decoder(*args, **kargs):
     '''Decodes the arguments to preprocessFromPandas_label_dir_pairs so that the ObjectProfile(s) are 
         properly reconstituted'''
@@ -159,18 +219,16 @@ def getFiles_StoreType(data_dir):
     '''Gets a list of files from a directory in the filesystem and the type of data stored in it. Asserts that the directory is not empty.'''
     if(not os.path.isdir(data_dir)):
             raise IOError("Directory %r does not exist." % data_dir)
-    msgFiles = glob.glob(data_dir+"*.msg")
-    hdfFiles = glob.glob(data_dir+"*.h5")
-    if(len(msgFiles) == 0):
-        files = hdfFiles
-        storeType = "hdf5"
-    elif(len(hdfFiles) == 0):
-        files = msgFiles
-        storeType = "msgpack"
-    else:
-        raise IOError("Directory %r contains both .msg files and .h5 files, please use only one \
+    files_by_type = {"msgpack" : glob.glob(data_dir+"*.msg"),
+                     "hdf5" : glob.glob(data_dir+"*.h5"),
+                     "parquet" : glob.glob(data_dir+"*"+PARQUET_EXT)}
+    found = [key for key, files in files_by_type.items() if len(files) > 0]
+    if(len(found) > 1):
+        raise IOError("Directory %r contains more than one type of file %r, please use only one \
                         filetype when generating pandas files, to avoid data repetition issues\
-                        " % data_dir)
+                        " % (data_dir, sorted(found)))
+    storeType = found[0] if len(found) == 1 else "hdf5"
+    files = files_by_type[storeType]
 
     #files = glob.glob(data_dir+"*.h5")
     if(len(files) < 1):
@@ -181,7 +239,7 @@ def getNumValFrame(filename, storeType):
     '''Finds the num_val_frame frame in a pandas file in either msg or h5 format'''
     if(storeType == "hdf5"):
         #Get the HDF Store for the file
-        store = pd.HDFStore(filename)
+        store = pd.HDFStore(filename, mode="r")
 
         #Get the NumValues frame which lists the number of values for each entry
         try:
@@ -197,13 +255,36 @@ def getNumValFrame(filename, storeType):
         num_val_frame = meta_frames["NumValues"]
         # frames = pd.read_msgpack(f)
         # num_val_frame = frames["NumValues"]
+    elif(storeType == "parquet"):
+        num_val_frame = readParquetNumValues(filename)
     return num_val_frame
 
+def getDatasetStats(data_dir, per_file=False):
+    '''Gets the statistics of a directory of pandas files (see CMS_Deep_Learning.storage.dataset_stats). They are
+        read from the manifest of the directory when they are there, otherwise they are computed from the NumValues
+        frames of the files and stored for next time.
+        #Arguments
+            data_dir -- The directory of pandas files
+            per_file -- If True return a dictionary of the statistics of each file keyed by its path, otherwise
+                        the statistics of all of the files together'''
+    files, storeType = getFiles_StoreType(data_dir)
+    stats = directoryStats(data_dir, sorted(files), lambda f: getNumValFrame(f, storeType))
+    if(per_file): return stats
+    return mergeStats(stats.values())
+
+def getEntryIndex(data_dir):
+    '''Gets the EntryIndex of a directory of pandas files (see CMS_Deep_Learning.storage.entry_index), only reading
+        the NumValues of files that are new or changed since the directory was last indexed
+        #Returns (index, storeType)'''
+    files, storeType = getFiles_StoreType(data_dir)
+    index = loadEntryIndex(data_dir, files, lambda f: getNumValFrame(f, storeType))
+    return index, storeType
+
 def _getStore(f, storeType):
     '''Helper Function - Gets the HDFStore or frames for the file and storeType'''
-    frames = None
+    store, frames = None, None
     if(storeType == "hdf5"):
-        store = pd.HDFStore(f)
+        store = pd.HDFStore(f, mode="r")
     elif(storeType == "msgpack"):
         print("Bulk reading .msg. Be patient, reading in slices not supported.")
         sys.stdout.flush()
@@ -212,10 +293,14 @@ def _getStore(f, storeType):
             frames = pd.read_msgpack(f)
         except UnicodeDecodeError as e:
             frames = pd.read_msgpack(f, encoding='latin-1')
+    elif(storeType == "parquet"):
+        #Parquet files are read lazily, so the store is just the path
+        store = f
     return store,frames
 def _getFrame(store, storeType, key, select_start, select_stop,
-              samples_to_read, file_total_entries, frames):
-    '''Helper Function - gets '''
+              samples_to_read, file_total_entries, frames, columns=None):
+    '''Helper Function - gets the rows in [select_start, select_stop) of the table for key. If columns is not None
+        storeTypes that support it only read those columns.'''
     if(storeType == "hdf5"):
         #If we are reading all the samples use get since it might be faster
         #TODO: check if it is actually faster
@@ -226,35 +311,60 @@ def _getFrame(store, storeType, key, select_start, select_stop,
     elif(storeType == "msgpack"):
         frame = frames[key]
         frame = frame[select_start:select_stop]
+    elif(storeType == "parquet"):
+        frame = readParquetFrame(store, key, select_start, select_stop, columns=columns)
     return frame
 
-def _groupsByEntry(f, storeType, samples_per_label, samples_to_read, file_total_entries, num_val_frame,file_start_read,object_profiles):
-    '''Helper Function - produces dict keyed by object type and filled with groupBy objects w.r.t Entry'''
+def _profileColumns(profile, observ_types, available):
+    '''Helper Function - the columns of the table for profile that are needed to preprocess it: Entry, observ_types,
+        the columns it is presorted on, and any column whose name appears in its query'''
+    needed = set(["Entry"]) | set(observ_types)
+    for columns in [profile.pre_sort_columns, profile.sort_columns]:
+        if(columns != None):
+            needed |= set([columns] if isinstance(columns, str) else columns)
+    if(profile.query != None):
+        needed |= set(re.findall(r"[A-Za-z_][A-Za-z0-9_]*", profile.query))
+    return [c for c in available if c in needed]
+
+def _framesByProfile(f, storeType, samples_to_read, file_total_entries, row_ranges, file_start_read, object_profiles,
+                     observ_types=None):
+    '''Helper Function - reads the rows of every profile's table that belong to the entries in
+        [file_start_read, file_start_read+samples_to_read), which are given by row_ranges (see EntryIndex.rowRanges).
+        Produces a dict of DataFrames keyed by object type. If observ_types is not None storeTypes that support it
+        only read the columns that are needed.'''
     store, frames = _getStore(f, storeType)
 
-    #Get information about how many rows there are for each entry for the rows we want to skip and read
-    skip_val_frame = num_val_frame[:file_start_read]
-    num_val_frame = num_val_frame[file_start_read : file_start_read+samples_to_read]
-
-
-    groupBys = {}
+    frames_by_profile = {}
     #Loop over every profile and read the corresponding tables in the pandas file
     for index, profile in enumerate(object_profiles):
         key = profile.name                
-        #Where to start reading the table based on the sum of the selection start 
-        select_start = int(skip_val_frame[key].sum())
-        select_stop = select_start + int(num_val_frame[key].sum())
-
-        frame = _getFrame(store, storeType, key, select_start, select_stop,
-                          samples_to_read, file_total_entries,frames)
-        #Group by Entry
-        groupBys[key] = frame.groupby(["Entry"], group_keys=True)
+        select_start, select_stop = row_ranges[key]
+
+        columns = None
+        if(storeType == "parquet" and observ_types != None):
+            columns = _profileColumns(profile, observ_types, parquetColumns(store, key))
+        frames_by_profile[key] = _getFrame(store, storeType, key, select_start, select_stop,
+                                           samples_to_read, file_total_entries,frames, columns=columns)
+    return frames_by_profile, store
+
+def _groupsByEntry(f, storeType, samples_per_label, samples_to_read, file_total_entries, row_ranges,file_start_read,object_profiles,
+                   observ_types=None):
+    '''Helper Function - produces dict keyed by object type and filled with groupBy objects w.r.t Entry. If observ_types
+        is not None storeTypes that support it only read the columns that are needed.'''
+    frames_by_profile, store = _framesByProfile(f, storeType, samples_to_read, file_total_entries, row_ranges,
+                                                file_start_read, object_profiles, observ_types)
+    #Group by Entry
+    groupBys = {key : frame.groupby(["Entry"], group_keys=True) for key, frame in frames_by_profile.items()}
     return groupBys, store
 
+def _preSort(df, profile):
+    '''Helper Function - sorts the rows of an entry by the pre_sort_columns of a profile'''
+    return df.sort(profile.pre_sort_columns, ascending=profile.pre_sort_ascending)
+
 def _applyCuts(df, profile,vecsize, observ_types):
     '''Helper Function - presorts, applies queries, adds columns, and makes cuts'''
     if(profile.pre_sort_columns != None):
-        df = df.sort(profile.pre_sort_columns, ascending=profile.pre_sort_ascending)
+        df = _preSort(df, profile)
     if(profile.query != None):
         df = df.query(profile.query)
     #Add any additional columns
@@ -267,6 +377,15 @@ def _applyCuts(df, profile,vecsize, observ_types):
     df = df[observ_types]
     return df
     
+def _sortRows(x, sort_locs, sort_ascending):
+    '''Helper Function - sorts the rows of an entry on each of the columns at sort_locs in turn'''
+    for loc in reversed(sort_locs):
+        if(sort_ascending == True):
+            x = x[x[:,loc].argsort()]
+        else:
+            x = x[x[:,loc].argsort()[::-1]]
+    return x
+
 def _padAndSort(df, profile,vecsize):
     '''Helper Function - pads the data and sorts it'''
     if(isinstance(df, type(None))):
@@ -284,34 +403,169 @@ def _padAndSort(df, profile,vecsize):
         x = df.values
         
         if(sort_locs != None):
-            for loc in reversed(sort_locs):
-                if(profile.sort_ascending == True):
-                    x = x[x[:,loc].argsort()]
-                else:
-                    x = x[x[:,loc].argsort()[::-1]]
+            x = _sortRows(x, sort_locs, profile.sort_ascending)
     
         #pad the array
         x = np.append(x ,np.array(np.zeros((profile.max_size - len(x), vecsize))), axis=0)
     return x    
 
-def _initializeXY(single_list, label_dir_pairs, num_object_profiles, samples_per_label, num_labels):
-    '''Helper Function - Generates the initial data structures for the X (data) and Y (target)'''
+def _segmentRanks(segments):
+    '''Helper Function - the position of every row within its run of equal (contiguous) segment ids'''
+    n = len(segments)
+    if(n == 0): return np.zeros((0,), dtype='int64')
+    starts = np.flatnonzero(np.concatenate([[True], segments[1:] != segments[:-1]]))
+    return np.arange(n) - np.repeat(starts, np.diff(np.append(starts, n)))
+
+def _reverseSegments(segments):
+    '''Helper Function - an index array that reverses the order of rows within each run of equal segment ids'''
+    n = len(segments)
+    if(n == 0): return np.zeros((0,), dtype='int64')
+    starts = np.flatnonzero(np.concatenate([[True], segments[1:] != segments[:-1]]))
+    lengths = np.diff(np.append(starts, n))
+    seg_starts = np.repeat(starts, lengths)
+    rank = np.arange(n) - seg_starts
+    return seg_starts + np.repeat(lengths, lengths) - 1 - rank
+
+def _tiedSegments(segments, keys):
+    '''Helper Function - the segment ids with rows that tie on every one of keys. The rows are sorted by
+        segment and then by keys, so that ties are next to each other. NaNs tie with each other.'''
+    if(len(segments) < 2): return np.zeros((0,), dtype=segments.dtype)
+    tie = segments[1:] == segments[:-1]
+    for k in keys:
+        tie &= (k[1:] == k[:-1]) | (np.isnan(k[1:]) & np.isnan(k[:-1]))
+    return np.unique(segments[1:][tie])
+
+def _segmentBounds(segments, segment):
+    '''Helper Function - the slice of the rows of a segment, in segments sorted in ascending order'''
+    return slice(np.searchsorted(segments, segment, 'left'), np.searchsorted(segments, segment, 'right'))
+
+def _columnValues(frame, column):
+    '''Helper Function - the values of a column as float64 for sorting'''
+    return frame[column].values.astype('float64')
+
+def _cutProfile(frame, profile, observ_types, file_start_read, samples_to_read):
+    '''Helper Function - applies the same presorts, queries, added columns, and cuts as _applyCuts() to
+        the rows of every entry at once.
+        #Returns (segments, values)
+            segments -- The entry of each row that was kept, relative to file_start_read, in ascending order
+            values -- A numpy array of shape (# of rows kept, len(observ_types)) with the rows kept. The rows of
+                        each entry are in the same order as _applyCuts() would leave them.
+    '''
+    segments = frame["Entry"].values.astype('int64') - file_start_read
+    keep = (segments >= 0) & (segments < samples_to_read)
+    if(profile.query != None and len(frame.index) > 0):
+        keep &= frame.eval(profile.query).values.astype('bool')
+
+    #Sort by entry and then by pre_sort_columns. Like DataFrame.sort this is stable and puts NaNs last.
+    sort_keys = []
+    if(profile.pre_sort_columns != None):
+        ascending = profile.pre_sort_ascending
+        if(not isinstance(ascending, list)): ascending = [ascending] * len(profile.pre_sort_columns)
+        for column, asc in reversed(list(zip(profile.pre_sort_columns, ascending))):
+            k = _columnValues(frame, column)
+            sort_keys.append(k if asc else -k)
+    sort_keys.append(segments)
+    order = np.lexsort(sort_keys)
+
+    #DataFrame.sort may order rows that tie differently, so entries with ties are presorted like _applyCuts.
+    #Ties are rare in measured values, so this is only done for a few entries.
+    if(profile.pre_sort_columns != None):
+        sorted_segments = segments[order]
+        keys = [_columnValues(frame, column)[order] for column in profile.pre_sort_columns]
+        for segment in _tiedSegments(sorted_segments, keys):
+            if(segment < 0 or segment >= samples_to_read): continue
+            rows = _segmentBounds(sorted_segments, segment)
+            entry_rows = np.sort(order[rows])
+            entry = pd.DataFrame({column : frame[column].values[entry_rows] for column in profile.pre_sort_columns})
+            order[rows] = entry_rows[_preSort(entry, profile).index.values]
+    order = order[keep[order]]
+    segments = segments[order]
+
+    #Make cut, preserving only profile.max_size of top of each entry
+    in_cut = _segmentRanks(segments) < profile.max_size
+    order, segments = order[in_cut], segments[in_cut]
+
+    values = np.zeros((len(order), len(observ_types)), dtype='float64')
+    for i, column in enumerate(observ_types):
+        if(profile.addColumns != None and column in profile.addColumns):
+            values[:, i] = profile.addColumns[column]
+        else:
+            values[:, i] = frame[column].values[order]
+    return segments, values
+
+def _sortAndScatter(X, positions, start, segments, values, sort_locs, sort_ascending):
+    '''Helper Function - sorts the rows of each entry like _padAndSort() and writes them into X, which is
+        already filled with zeros (i.e the padding)
+        #Arguments
+            X -- A numpy array of shape (samples, max_size, vecsize)
+            positions -- A numpy array with the index in X to write each sample to (i.e. a permutation)
+            start -- The sample number of the first entry (segment 0)
+            segments, values -- As returned by _cutProfile, with at most max_size rows for each segment
+            sort_locs -- The indicies of the columns to sort by, or None
+            sort_ascending -- Whether to sort ascending or descending
+    '''
+    if(sort_locs != None):
+        #argsort() may order rows that tie differently, so entries with ties are sorted by _sortRows like _padAndSort
+        tied = np.unique(np.concatenate([_tiedSegments(segments[order], [values[order, loc]])
+                                         for order in [np.lexsort((values[:, loc], segments)) for loc in sort_locs]]))
+        unsorted = values
+        #Sort on each column in turn, like _padAndSort. Descending sorts reverse the ascending order.
+        for loc in reversed(sort_locs):
+            order = np.lexsort((values[:, loc], segments))
+            values = values[order]
+            if(sort_ascending != True):
+                values = values[_reverseSegments(segments)]
+        for segment in tied:
+            rows = _segmentBounds(segments, segment)
+            values[rows] = _sortRows(unsorted[rows], sort_locs, sort_ascending)
+    X[positions[start + segments], _segmentRanks(segments)] = values
+
+def _fillVectorized(X_train, positions, X_train_index, frames_by_profile, object_profiles, observ_types, file_start_read, samples_to_read,
+                    single_list=False, sort_columns=None, sort_ascending=True):
+    '''Helper Function - cuts, sorts, and pads the objects of every entry read from a file at once and writes them into
+        X_train starting at sample X_train_index, in the order given by positions. Produces the same values as running _applyCuts() and _padAndSort() on
+        each entry.'''
+    cut = [_cutProfile(frames_by_profile[profile.name], profile, observ_types, file_start_read, samples_to_read)
+                for profile in object_profiles]
+    if(single_list):
+        #Join the rows of every profile, keeping the profiles in order within each entry
+        segments = np.concatenate([c[0] for c in cut])
+        values = np.concatenate([c[1] for c in cut])
+        order = np.argsort(segments, kind='mergesort')
+        if(isinstance(sort_columns, str)): sort_columns = [sort_columns]
+        sort_locs = None
+        if(sort_columns != None and not None in sort_columns):
+            sort_locs = [observ_types.index(s) for s in sort_columns]
+        _sortAndScatter(X_train, positions, X_train_index, segments[order], values[order], sort_locs, sort_ascending)
+    else:
+        for index, profile in enumerate(object_profiles):
+            segments, values = cut[index]
+            sort_locs = None
+            if(profile.sort_columns != None and not None in profile.sort_columns):
+                sort_locs = [observ_types.index(s) for s in profile.sort_columns]
+            _sortAndScatter(X_train[index], positions, X_train_index, segments, values, sort_locs, profile.sort_ascending)
+
+def _profileDtype(profile, dtype):
+    '''Helper Function - The dtype of the preprocessed array of an ObjectProfile'''
+    return profile.dtype if(profile.dtype != None) else dtype
+
+def _initializeXY(single_list, label_dir_pairs, object_profiles, samples_per_label, num_labels, vecsize, dtype='float64'):
+    '''Helper Function - Generates the initial data structures for the X (data) and Y (target). X is filled with
+        zeros, which are the padding for any object that is not filled in. Y is filled in by label.'''
     label_vecs = {}
     for i, (label, data_dir) in enumerate(label_dir_pairs):
         arr = np.zeros((num_labels,))
         arr[i] = 1
         label_vecs[label] = arr
         
+    num_samples = samples_per_label * num_labels
     if(single_list):
-        X_train = [None] * (samples_per_label * num_labels)
-        #global_profile = ObjectProfile("list", max_size="")
+        X_train = np.zeros((num_samples, sum([p.max_size for p in object_profiles]), vecsize), dtype=dtype)
     else:
-        X_train = [None] * (num_object_profiles)
         #Prefill the arrays so that we don't waste time resizing lists
-        for index in range(num_object_profiles):
-            X_train[index] = [None] * (samples_per_label * num_labels)
+        X_train = [np.zeros((num_samples, p.max_size, vecsize), dtype=_profileDtype(p, dtype)) for p in object_profiles]
             
-    y_train = [None] * (samples_per_label * num_labels)
+    y_train = np.zeros((num_samples, num_labels), dtype=dtype)
     return X_train, y_train, label_vecs
    
 def _check_Object_Profiles(object_profiles, observ_types):
@@ -339,8 +593,79 @@ def _check_inputs(label_dir_pairs, observ_types):
     if("Entry" in observ_types):
         raise ValueError("Using Entry in observ_types can result in skewed training results. Just don't.")
         
+def _readPlan(data_dir, start, samples_per_label, chunk_entries=None):
+    '''Helper Function - Generates the reads needed to get samples_per_label samples starting at start from the
+        files in data_dir (as if they are one long list), as tuples like
+        (filename, storeType, file_total_entries, file_start_read, samples_to_read, row_ranges). If chunk_entries
+        is not None reads are split so that none of them is longer. Raises an IOError if there are not enough samples.'''
+    index, storeType = getEntryIndex(data_dir)
+    reads = index.locate(start, samples_per_label)
+    if(sum([r[2] for r in reads]) != samples_per_label):
+        raise IOError("Not enough data in %r to read in range(%r, %r)" % (data_dir, start, samples_per_label+start))
+    for (file_number, file_start_read, samples_to_read) in reads:
+        step = samples_to_read if chunk_entries == None else chunk_entries
+        for read_start in range(file_start_read, file_start_read+samples_to_read, step):
+            read_samples = min(step, file_start_read+samples_to_read-read_start)
+            yield (index.files[file_number], storeType, index.fileEntries(file_number), read_start, read_samples,
+                   index.rowRanges(file_number, read_start, read_samples))
+
+#How many entries of a file each worker preprocesses at a time when num_workers > 1
+PREPROCESS_CHUNK_ENTRIES = 2000
+
+def _preprocessUnit(unit):
+    '''Helper Function - Preprocesses a range of entries of one file in a worker process. Returns the
+        preprocessed samples in the order of the entries, like X_train but only for this range.'''
+    (f, storeType, file_total_entries, file_start_read, samples_to_read, row_ranges, object_profiles, observ_types,
+        single_list, sort_columns, sort_ascending, dtype) = unit
+    frames_by_profile, store = _framesByProfile(f, storeType, samples_to_read, file_total_entries,
+                                                row_ranges, file_start_read, object_profiles, observ_types)
+    if(storeType == "hdf5"):
+        store.close()
+    X_unit, y_unit, label_vecs = _initializeXY(single_list, [], object_profiles, samples_to_read, 1,
+                                               len(observ_types), dtype)
+    _fillVectorized(X_unit, np.arange(samples_to_read), 0, frames_by_profile, object_profiles, observ_types,
+                    file_start_read, samples_to_read, single_list, sort_columns, sort_ascending)
+    return X_unit
+
+def _fillParallel(X_train, positions, label_dir_pairs, start, samples_per_label, object_profiles, observ_types,
+                  single_list, sort_columns, sort_ascending, dtype, num_workers, verbose=1, chunk_entries=None):
+    '''Helper Function - Fills X_train like the serial loop in preprocessFromPandas_label_dir_pairs, but splits the
+        reads into ranges of at most chunk_entries entries that are preprocessed by a pool of num_workers processes.
+        Each range is written to its own samples of X_train, so the result is the same as the serial one.'''
+    if(chunk_entries == None): chunk_entries = PREPROCESS_CHUNK_ENTRIES
+    units = []
+    destinations = []
+    X_train_index = 0
+    for (label,data_dir) in label_dir_pairs:
+        for read in _readPlan(data_dir, start, samples_per_label, chunk_entries):
+            unit_samples = read[4]
+            units.append(read + (object_profiles, observ_types, single_list, sort_columns, sort_ascending, dtype))
+            destinations.append(positions[X_train_index:X_train_index+unit_samples])
+            X_train_index += unit_samples
+    if(verbose >= 1): print("Preprocessing %r samples in %r ranges with %r workers" % (X_train_index, len(units), num_workers))
+
+    pool = multiprocessing.Pool(min(num_workers, max(len(units), 1)))
+    try:
+        samples_done = 0
+        for dest, X_unit in zip(destinations, pool.imap(_preprocessUnit, units)):
+            if(single_list):
+                X_train[dest] = X_unit
+            else:
+                for arr, x in zip(X_train, X_unit):
+                    arr[dest] = x
+            samples_done += len(dest)
+            if(verbose >= 1):
+                sys.stdout.write('\r')
+                sys.stdout.write("[%-20s] %r/%r" % ('='*int(20*samples_done/max(X_train_index, 1)), samples_done, X_train_index))
+                sys.stdout.flush()
+        if(verbose >= 1): print("")
+    finally:
+        pool.close()
+        pool.join()
+
 def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_label, object_profiles, observ_types,
-                                         single_list=False, sort_columns=None, sort_ascending=True,verbose=1):
+                                         single_list=False, sort_columns=None, sort_ascending=True,verbose=1, vectorized=True,
+                                         dtype='float64', num_workers=1):
     '''Gets training data from folders of pandas tables
         #Arguements:
             label_dir_pairs -- a list of tuples of the form (label, directory) where the directory contains
@@ -353,6 +678,12 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
             single_list -- If True all object types are joined into a single list.
             sort_columns -- If single_list the columns to sort by.
             sort_ascending -- If True sort in ascending order, false decending  
+            vectorized -- If True process all of the entries read from a file at once with numpy, otherwise
+                            process the entries one at a time with pandas. Both give the same result.
+            dtype -- The numpy dtype of the returned arrays (i.e. 'float32' to match keras floatX). ObjectProfiles
+                        with their own dtype override it unless single_list.
+            num_workers -- If greater than 1 the files are split into ranges of entries that are preprocessed in
+                            parallel by this many processes (always vectorized). Gives the same result as num_workers=1.
         #Returns:
             Training data with its correspoinding labels
             (X_train, Y_train)
@@ -365,121 +696,98 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
     num_labels = len(label_dir_pairs)
     
     #Build vectors in the form [1,0,0], [0,1,0], [0, 0, 1] corresponding to each label
-    X_train, y_train, label_vecs = _initializeXY(single_list, label_dir_pairs, len(object_profiles), samples_per_label, num_labels)
+    X_train, y_train, label_vecs = _initializeXY(single_list, label_dir_pairs, object_profiles, samples_per_label, num_labels, vecsize, dtype)
+
+    #Shuffle the samples just in case, by writing each sample directly to its shuffled position.
+    #Although, we probably don't need to shuffle since keras shuffles by default.
+    indices = np.arange(len(y_train))
+    np.random.shuffle(indices)
+    positions = np.empty_like(indices)
+    positions[indices] = np.arange(len(indices))
+
+    #Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1]
+    for i, (label,data_dir) in enumerate(label_dir_pairs):
+        y_train[positions[i*samples_per_label:(i+1)*samples_per_label]] = label_vecs[label]
+
+    if(num_workers > 1):
+        _fillParallel(X_train, positions, label_dir_pairs, start, samples_per_label, object_profiles, observ_types,
+                      single_list, sort_columns, sort_ascending, dtype, num_workers, verbose)
+        return X_train, y_train
+
     X_train_index = 0
     
     #Loop over label dir pairs and get the file list for each directory
-    y_train_start = 0
     for (label,data_dir) in label_dir_pairs:
-        files, storeType = getFiles_StoreType(data_dir)
-        files.sort()
         samples_read = 0
-        location = 0
         
          #Loop the files associated with the current label
-        for f in files:
-            num_val_frame = getNumValFrame(f,storeType)
-
-            file_total_entries = len(num_val_frame.index)
-
-            assert file_total_entries > 0, "num_val_frame has zero values"
-            
-            if(location + file_total_entries <= start):
-                location += file_total_entries
-                continue
-            
-            #Determine what row to start reading the num_val table which contains
-            #information about how many rows there are for each entry
-            file_start_read = start-location if start > location else 0
-            
-            #How many rows we will read from this table each corresponds to one entry
-            samples_to_read = min(samples_per_label-samples_read, file_total_entries-file_start_read)
-            assert samples_to_read >= 0
-            
+        for (f, storeType, file_total_entries, file_start_read, samples_to_read, row_ranges) in _readPlan(data_dir, start, samples_per_label):
             if(verbose >= 1): print("Reading %r samples from %r:" % (samples_to_read,f))
             
-            groupBys,store = _groupsByEntry(f, storeType, samples_per_label,samples_to_read, file_total_entries,
-                                            num_val_frame,file_start_read,object_profiles)
+            if(vectorized):
+                frames_by_profile, store = _framesByProfile(f, storeType, samples_to_read, file_total_entries,
+                                                    row_ranges, file_start_read, object_profiles, observ_types)
+                if(verbose >= 1): print("Values/Sample from: %r" % {p.name: p.max_size for p in object_profiles})
+                _fillVectorized(X_train, positions, X_train_index, frames_by_profile, object_profiles, observ_types,
+                                file_start_read, samples_to_read, single_list, sort_columns, sort_ascending)
+            else:
+                groupBys,store = _groupsByEntry(f, storeType, samples_per_label,samples_to_read, file_total_entries,
+                                                row_ranges,file_start_read,object_profiles, observ_types)
                 
-            if(verbose >= 1): print("Values/Sample from: %r" % {p.name: p.max_size for p in object_profiles})
+                if(verbose >= 1): print("Values/Sample from: %r" % {p.name: p.max_size for p in object_profiles})
             
-            cut_tables = [None] * len(object_profiles)
-            last_time = time.clock()-1.0
-            prev_entry = file_start_read
-            for entry in range(file_start_read, file_start_read+samples_to_read):
-                #Make a pretty progress bar in the terminal
-                if(verbose >= 1):      
-                    c = time.clock() 
-                    if(c > last_time + .25):
-                        percent = float(entry-file_start_read)/float(samples_to_read)
-                        sys.stdout.write('\r')
-                        sys.stdout.write("[%-20s] %r/%r  %r(Entry/sec)" % ('='*int(20*percent), entry, int(samples_to_read), 4 * (entry-prev_entry)))
-                        sys.stdout.flush()
-                        last_time = c
-                        prev_entry = entry
+                cut_tables = [None] * len(object_profiles)
+                last_time = time.clock()-1.0
+                prev_entry = file_start_read
+                for entry in range(file_start_read, file_start_read+samples_to_read):
+                    #Make a pretty progress bar in the terminal
+                    if(verbose >= 1):      
+                        c = time.clock() 
+                        if(c > last_time + .25):
+                            percent = float(entry-file_start_read)/float(samples_to_read)
+                            sys.stdout.write('\r')
+                            sys.stdout.write("[%-20s] %r/%r  %r(Entry/sec)" % ('='*int(20*percent), entry, int(samples_to_read), 4 * (entry-prev_entry)))
+                            sys.stdout.flush()
+                            last_time = c
+                            prev_entry = entry
                         
-                for index, profile in enumerate(object_profiles):
-                        #print(groupBys.keys())
-                        groupBy = groupBys[profile.name]
-                        if(entry in groupBy.groups):
-                            df = _applyCuts(groupBy.get_group(entry), profile, vecsize, observ_types)
-                            cut_tables[index] = df
-                        else:
-                            cut_tables[index] = None
-                if(single_list):
-                    df = pd.concat(cut_tables)
-                    list_profile = ObjectProfile("single_list",
-                                                sum([profile.max_size for profile in object_profiles]),
-                                                sort_columns=sort_columns,
-                                                sort_ascending=sort_ascending)    
-                                                    
-                    x  = _padAndSort(df,list_profile,vecsize)
-                    X_train[X_train_index + entry - file_start_read] = x
-                else:
                     for index, profile in enumerate(object_profiles):
-                        arr = X_train[index]
-                        df = cut_tables[index]
-                        x  = _padAndSort(df,profile, vecsize)
-                        arr[X_train_index + entry - file_start_read] = x
+                            #print(groupBys.keys())
+                            groupBy = groupBys[profile.name]
+                            if(entry in groupBy.groups):
+                                df = _applyCuts(groupBy.get_group(entry), profile, vecsize, observ_types)
+                                cut_tables[index] = df
+                            else:
+                                cut_tables[index] = None
+                    if(single_list):
+                        df = pd.concat(cut_tables)
+                        list_profile = ObjectProfile("single_list",
+                                                    sum([profile.max_size for profile in object_profiles]),
+                                                    sort_columns=sort_columns,
+                                                    sort_ascending=sort_ascending)    
+                                                    
+                        x  = _padAndSort(df,list_profile,vecsize)
+                        X_train[positions[X_train_index + entry - file_start_read]] = x
+                    else:
+                        for index, profile in enumerate(object_profiles):
+                            arr = X_train[index]
+                            df = cut_tables[index]
+                            x  = _padAndSort(df,profile, vecsize)
+                            arr[positions[X_train_index + entry - file_start_read]] = x
             
             X_train_index += samples_to_read
             
-            #Free this (probably not necessary)
-            num_val_frame = None
             if(storeType == "hdf5"):
                 store.close()
-            location     += file_total_entries
             samples_read += samples_to_read
             if(verbose >= 1): print("*Read %r Samples of %r in range(%r, %r)" % (samples_read, samples_per_label, start, samples_per_label+start))
             if(samples_read >= samples_per_label):
                 if(verbose >= 1): print('-' * 50)
-                assert samples_read == samples_per_label
-                break
-        if(samples_read != samples_per_label):
-            raise IOError("Not enough data in %r to read in range(%r, %r)" % (data_dir, start, samples_per_label+start))
-        
-        #Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1]
-        for i in range(samples_per_label):
-            y_train[y_train_start+i] = label_vecs[label]
-        y_train_start += samples_per_label
     
-    #Turn everything into numpy arrays and shuffle them just in case.
-    #Although, we probably don't need to shuffle since keras shuffles by default.
-    y_train = np.array(y_train)
-    
-    indices = np.arange(len(y_train))
-    np.random.shuffle(indices)
-    if(single_list):
-        X_train = np.array(X_train)[indices]
-    else:
-        for index in range(len(X_train)):
-            X_train[index] = np.array(X_train[index])[indices]
-
-    y_train = y_train[indices]
     return X_train, y_train
     
 
-def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir_pairs, observ_types, single_list=False, sort_columns=None, sort_ascending=True, batch_size=100, megabytes=500, verbose=1):
+def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir_pairs, observ_types, single_list=False, sort_columns=None, sort_ascending=True, batch_size=100, megabytes=500, verbose=1, dtype='float64', num_workers=1, ragged=False, bucket_by_length=False, prefetch=0, lazy=False, archive_layout=None):
     '''Creates a set of DataProcedures that return generators and their coressponding lengths. Each generator consists of a list DataProcedures that preprocess data
         from a set of label_dir_pairs in a given range. The size of the archived files for each DP is set by 'megabytes' so that each one is not too big. Each generator
         reads a number of samples per label type set by 'splits' and 'length', and feeds data in batches of 'batch_size' into training.
@@ -500,6 +808,17 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
                         disk reads. 
             verbose -- Determines whether or not information is printed out as the generators are formed and as they are used. (TODO: the implementation of this might need some work, the specifics
                         of how this information is passed along the the DPs and their dependant functions might not be implemented correctly at the moment, leading to printouts even if verbose=0)
+            dtype -- The numpy dtype of the preprocessed data (i.e. 'float32'). Smaller dtypes make smaller archives, so each one holds more samples.
+            num_workers -- How many processes each DataProcedure preprocesses with (see preprocessFromPandas_label_dir_pairs)
+            ragged -- If True the DataProcedures are archived without their zero padding, and each batch is only padded to
+                        its longest sample (see genFromDPs). Models must then accept a variable number of timesteps.
+            bucket_by_length -- If True the generators batch together samples with similar numbers of objects and pad each
+                        batch only to its longest sample (see genFromDPs). Models must then accept a variable number of timesteps.
+            prefetch -- If greater than 0 the generators load this many DataProcedures ahead in background threads (see genFromDPs),
+                        keeping up to that many more DataProcedures in memory.
+            lazy -- If True the generators only read the samples of each batch from the archives (see genFromDPs)
+            archive_layout -- The chunking and compression of the archives (See CMS_Deep_Learning.storage.archiving.archiveLayout).
+                        If it does not set chunk_samples the chunks hold batch_size samples.
         #Returns (all_dps, all_datasets)
             all_dps -- A list of DataProcedures, this can be passed to CMS_Deep_Learning.utils.batch.batchAssertArchived to make sure that all the DPs are archived before proceeding to training
             all_datasets -- A list like [(generator1,num_samples1), (generator2, num_samples2), ... , max_q_size], where max_q_size designates how large the keras generator queue should be so that
@@ -508,8 +827,10 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
     assert isinstance(object_profiles, list)
     assert isinstance(label_dir_pairs, list)
     assert isinstance(observ_types, list)
-    stride = strideFromTargetSize(object_profiles, label_dir_pairs, observ_types, megabytes=megabytes)
+    stride = strideFromTargetSize(object_profiles, label_dir_pairs, observ_types, megabytes=megabytes, dtype=dtype)
     SNs = start_num_fromSplits(splits, length)
+    if(archive_layout != None and archive_layout.get("chunk_samples", None) == None):
+        archive_layout = dict(archive_layout, chunk_samples=batch_size)
     all_dps = []
     all_datasets = []
     for s in SNs:
@@ -523,12 +844,22 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
                                         single_list=single_list,
                                         sort_columns=sort_columns,
                                         sort_ascending=sort_ascending,
-                                        verbose=verbose)
-        gen_DP = DataProcedure(archive_dir, False,genFromDPs,dps, batch_size, threading = False, verbose=verbose)
+                                        verbose=verbose,
+                                        dtype=dtype,
+                                        num_workers=num_workers,
+                                        ragged=ragged,
+                                        archive_layout=archive_layout)
+        #Only pass pad_batches when it is used, so that existing generators keep their hashes
+        gen_kargs = {"pad_batches" : True} if ragged else {}
+        if(bucket_by_length): gen_kargs["bucket_by_length"] = True
+        if(prefetch > 0): gen_kargs["prefetch"] = prefetch
+        if(lazy): gen_kargs["lazy"] = True
+        gen_DP = DataProcedure(archive_dir, False,genFromDPs,dps, batch_size, threading = prefetch > 0, verbose=verbose, **gen_kargs)
         num_samples = len(label_dir_pairs)*s[1]
         all_datasets += [(gen_DP, num_samples)]
         all_dps += dps
-    #Calculate a good max_q_size and add it to the all_datasets list
+    #Calculate a good max_q_size and add it to the all_datasets list. The keras queue holds about one DataProcedure of batches,
+    #  the DataPrefetcher (if any) holds the next DataProcedures.
     all_datasets += [max(np.ceil(stride/float(batch_size)), 1)]
     return (all_dps,all_datasets)
 
@@ -537,10 +868,12 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
        
             
 
-def strideFromTargetSize(object_profiles, num_labels, observ_types, megabytes=100):
-    '''Computes how large a stride is required to get DPs with archives of size megabytes'''
+def strideFromTargetSize(object_profiles, num_labels, observ_types, megabytes=100, dtype='float64'):
+    '''Computes how large a stride is required to get DPs with archives of size megabytes. Each value is
+        budgeted at 3 times the size of its dtype (24 bytes for float64).'''
     if(isinstance(num_labels, list)): num_labels = len(num_labels)
-    megabytes_per_sample = sum(o.max_size for o in object_profiles) * len(observ_types) * 24.0 / (1000.0 * 1000.0)
+    bytes_per_sample = sum(o.max_size * np.dtype(_profileDtype(o, dtype)).itemsize * 3 for o in object_profiles) * len(observ_types)
+    megabytes_per_sample = bytes_per_sample / (1000.0 * 1000.0)
     return int(megabytes/megabytes_per_sample)
 
 def maxMutualLength(label_dir_pairs, object_profiles):
@@ -548,62 +881,16 @@ def maxMutualLength(label_dir_pairs, object_profiles):
         label_dir_pairs. Must also input object_profiles so that it knows what keys to check '''
     label_totals = {}
     for (label,data_dir) in label_dir_pairs:
-
-        files, storeType = getFiles_StoreType(data_dir)
-
-        files.sort()
-        
-        keys = None
-        if(object_profiles != None):
-            keys = ["/" + o.name for o in object_profiles]
-        
+        stats_by_file = getDatasetStats(data_dir, per_file=True)
         label_totals[label] = 0
-         #Loop the files associated with the current label
-        
-        for f in files:
-            #Get the HDF Store for the file
-            if(storeType == "hdf5"):
-                #Get the HDF Store for the file
-                store = pd.HDFStore(f)
-
-                #Get the NumValues frame which lists the number of values for each entry
-
-                if(keys != None and set(keys).issubset(set(store.keys())) == False):
+        for f, stats in sorted(stats_by_file.items()):
+            if(object_profiles != None):
+                missing = [o.name for o in object_profiles if not o.name in stats["objects"]]
+                if(len(missing) > 0):
                     raise KeyError('File: ' + f + ' may be corrupted:' + os.linesep + 
-                                    'Requested keys: ' + str(keys) + os.linesep + 
-                                    'But found keys: ' + str(store.keys()) )
-                
-                try:
-                    num_val_frame = store.get('/NumValues')
-                except KeyError as e:
-                    raise KeyError(str(e) + " " + f)
-            elif(storeType == "msgpack"):
-                print("Bulk reading .msg. Be patient, reading in slices not supported.")
-                sys.stdout.flush()
-
-                #Need to check for latin encodings due to weird pandas default
-                try:
-                    frames = pd.read_msgpack(f)
-                except UnicodeDecodeError as e:
-                    frames = pd.read_msgpack(f, encoding='latin-1')
-                num_val_frame = frames["NumValues"]
-                    # store = pd.HDFStore(f)
-                    # #print(keys)
-                    # #print(store.keys())
-                    # #print(set(keys).issubset(set(store.keys())))
-                    # if(keys != None and set(keys).issubset(set(store.keys())) == False):
-                    #     raise KeyError('File: ' + f + ' may be corrupted:' + os.linesep + 
-                    #                     'Requested keys: ' + str(keys) + os.linesep + 
-                    #                     'But found keys: ' + str(store.keys()) )
-                    
-                    # #Get file_total_entries
-                    # try:
-                    #     num_val_frame = store.get('/NumValues')
-                    # except KeyError as e:
-                    #     raise KeyError(str(e) + " " + f)
-            file_total_entries = len(num_val_frame.index)
-            label_totals[label] += file_total_entries
-    #print(label_totals)
+                                    'Requested keys: ' + str([o.name for o in object_profiles]) + os.linesep + 
+                                    'But found keys: ' + str(sorted(stats["objects"].keys())) )
+            label_totals[label] += stats["entries"]
     return min(label_totals.values())
 
 def start_num_fromSplits(splits, length):
@@ -636,7 +923,7 @@ def start_num_fromSplits(splits, length):
 
 
 
-def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,label_dir_pairs, object_profiles, observ_types, single_list=False, sort_columns=None, sort_ascending=True, verbose=1):
+def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,label_dir_pairs, object_profiles, observ_types, single_list=False, sort_columns=None, sort_ascending=True, verbose=1, dtype='float64', num_workers=1, ragged=False, archive_layout=None):
     '''Gets a list of DataProcedures that use preprocessFromPandas_label_dir_pairs to read from the unjoined pandas files
         #Arguments
             start -- Where to start reading in the filesystem (if we treat it as one long list for each directory)
@@ -650,8 +937,17 @@ def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,labe
             object_profiles -- A list of ObjectProfiles, used to determine what preprocessing steps need to be taken
             observ_types -- A list of the observable quantities in our pandas tables i.e ['E/c', "Px" ,,,etc.]
             verbose -- Whether or not to print
+            dtype -- The numpy dtype of the preprocessed data
+            num_workers -- How many processes each DataProcedure preprocesses with. Does not change its hash.
+            ragged -- Whether the DataProcedures archive X without its zero padding (See DataProcedure.archive). Does not change their hashes.
+            archive_layout -- The chunking and compression of the archives (See CMS_Deep_Learning.storage.archiving.archiveLayout).
+                        Does not change their hashes.
     '''
     procs = []
+    #Only pass dtype when it is not the default, so that existing archives keep their hashes
+    kargs = {}
+    if(np.dtype(dtype) != np.dtype('float64')): kargs["dtype"] = np.dtype(dtype).name
+    if(num_workers > 1): kargs["num_workers"] = num_workers
     end = start+samples_per_label
     if(verbose >= 1): print("Generating DataProcedure in range(%r,%r):" % (start, end))
     for proc_start in range(start, end, stride):
@@ -668,8 +964,11 @@ def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,labe
                 single_list=single_list,
                 sort_columns=sort_columns,
                 sort_ascending=sort_ascending,
-                verbose=verbose
+                verbose=verbose,
+                **kargs
             )
+        if(ragged): dp.ragged_archive = True
+        if(archive_layout != None): dp.archive_layout = archive_layout
         procs.append(dp)
         #print(proc_start, samples_per_label, stride)
         if(verbose >= 1):
@@ -679,61 +978,71 @@ def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,labe
     #print([p.hash() for p in procs])
     return procs
 
-class dataFetchThread(threading.Thread):
-
-    def __init__(self, proc, group=None, target=None, name=None,
-                 args=(), kwargs=None, verbose=None):
-        threading.Thread.__init__(self, group=group, target=target, name=name,
-                                  verbose=verbose)
-        self.proc = proc
-        self.args = args
-        self.kwargs = kwargs
-        self.X = None
-        self.Y = None
-        return
-
-    def run(self):
-        self.X, self.Y = self.proc.getData()
-        return
+def _padBatch(X, samples):
+    '''Helper Function - Gets the samples (a slice or an array of indices) of a list of RaggedArrays, each padded to
+        the length of its longest sample (at least 1)'''
+    out = []
+    for x in X:
+        batch = x[samples] if isinstance(samples, slice) else x.take(samples)
+        lengths = batch.lengths()
+        out.append(batch.toPadded(max(int(lengths.max()) if len(lengths) > 0 else 0, 1)))
+    return out
 
-def genFromDPs(dps, batch_size, threading=False, verbose=1):
+def _lengthBatches(X, batch_size):
+    '''Helper Function - Splits the samples of a list of RaggedArrays into batches of samples with similar lengths
+        (summed over the list). Returns a list of arrays of sample indices, in random order.'''
+    lengths = np.sum([x.lengths() for x in X], axis=0)
+    order = np.argsort(lengths, kind='mergesort')
+    batches = [order[start:start+batch_size] for start in range(0, len(order), batch_size)]
+    np.random.shuffle(batches)
+    return batches
+
+def genFromDPs(dps, batch_size, threading=False, verbose=1, pad_batches=False, bucket_by_length=False,
+               prefetch=2, num_loaders=1, prefetch_megabytes=None, lazy=False):
     '''Gets a generator that generates data of batch_size from a list of DataProcedures.
-        Optionally uses threading to apply getData in parellel, although this may be obsolete
-        with the proper fit_generator settings'''
+        If threading the DataProcedures are loaded ahead of time by a DataPrefetcher, so that training
+        does not wait for getData(). If pad_batches the data is read as RaggedArrays
+        and each batch is only padded to the length of its longest sample instead of max_size.
+        If bucket_by_length the samples of each DataProcedure are also grouped into batches of
+        samples with similar numbers of objects, which are generated in random order.
+        If lazy the archived DataProcedures are read with getData(lazy=True), so only the samples of
+        the current batch are in memory and the first batch does not wait for the whole archive.
+        Otherwise archives are read through the DataCache, so later epochs do not decode them again,
+        and the batches are read only.
+        #Arguments
+            prefetch -- With threading, how many DataProcedures to keep loaded ahead of the one in use
+            num_loaders -- With threading, how many threads load DataProcedures
+            prefetch_megabytes -- With threading, stop loading ahead once the data loaded ahead takes up this many megabytes
+    '''
+    pad_batches = pad_batches or bucket_by_length
     for dp in dps:
         if(isinstance(dp, DataProcedure) == False):
             raise TypeError("Only takes DataProcedure got" % type(dp))
-            
-    
-    while True:
-        if(threading == True):
-            print("THREADING ENABLED")
-            datafetch = dataFetchThread(dps[0])
-            datafetch.start()
-        for i in range(0,len(dps)):
-            if(threading == True):
-                #Wait for the data to come in
-                while(datafetch.isAlive()):
-                    pass
-                X,Y = datafetch.X, datafetch.Y
-
-                #Start the next dataFetch
-                if(i != len(dps)-1):
-                    datafetch = dataFetchThread(dps[i+1])
-                else:
-                    datafetch = dataFetchThread(dps[0])
-                datafetch.start()
-            else:
-                X,Y = dps[i].getData(verbose=verbose)
-                                   
+
+    if(threading == True):
+        datas = DataPrefetcher(dps, prefetch=prefetch, num_loaders=num_loaders, megabytes=prefetch_megabytes,
+                               verbose=verbose, ragged=pad_batches, lazy=lazy, cache=True)
+    else:
+        datas = (dp.getData(verbose=verbose, ragged=pad_batches, lazy=lazy, cache=True) for dp in itertools.cycle(dps))
+    try:
+        for X,Y in datas:
             if(isinstance(X,list) == False): X = [X]
             if(isinstance(Y,list) == False): Y = [Y]
             tot = Y[0].shape[0]
-            assert tot == X[0].shape[0]
+            assert tot == len(X[0])
+            if(bucket_by_length):
+                for samples in _lengthBatches(X, batch_size):
+                    yield _padBatch(X, samples), [y[samples] for y in Y]
+                continue
             for start in range(0, tot, batch_size):
                 end = start+min(batch_size, tot-start)
-                yield [x[start:end] for x in X], [y[start:end] for y in Y]
-                
+                if(pad_batches):
+                    yield _padBatch(X, slice(start, end)), [y[start:end] for y in Y]
+                else:
+                    yield [x[start:end] for x in X], [y[start:end] for y in Y]
+    finally:
+        if(threading == True): datas.close()
+
 
 def genFrom_label_dir_pairs(start, samples_per_label, stride, batch_size, archive_dir,label_dir_pairs, object_profiles, observ_types, verbose=1):
     '''Gets a data generator that use DataProcedures and preprocessFromPandas_label_dir_pairs to read from the unjoined pandas files
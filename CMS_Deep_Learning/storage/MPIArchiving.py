@@ -34,6 +34,16 @@ MPI_INPUT_DEFAULTS = { "masters" : 1,
 
 }
 
+def _countSamples(dps):
+    '''Helper Function - the total number of samples in the archives of a list of DataProcedures, read from their records'''
+    num = 0
+    for dp in dps:
+        n = dp.num_samples()
+        if(n == None):
+            raise ValueError("DataProcedure %r is not archived in %r, so its samples can't be counted" % (dp.hash(), dp.archive_dir))
+        num += n
+    return num
+
 class MPI_KerasTrial(KerasTrial):
     
     def __init__(self,*args, **kargs):
@@ -219,7 +229,8 @@ class MPI_KerasTrial(KerasTrial):
 
         data = H5Data( train_list, batch_size=self.batch_size, 
                 features_name="X", labels_name="Y")
-        num_train = data.count_data()
+        #Count from the records of the archives instead of opening every one of them
+        num_train = _countSamples(train_dps)
         
 
 
@@ -258,9 +269,7 @@ class MPI_KerasTrial(KerasTrial):
             if(not "num_train" in record):
                 self.to_record({"num_train": num_train})
             if(not "num_val" in record):
-                val_data = H5Data( val_list, batch_size=self.batch_size,
-                features_name="X", labels_name="Y")
-                self.to_record({"num_val": val_data.count_data()})
+                self.to_record({"num_val": _countSamples(val_dps)})
 
             print(custom_objects)
             
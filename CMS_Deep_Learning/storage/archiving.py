@@ -16,6 +16,19 @@ import h5py
 import json
 import numpy as np
 
+from CMS_Deep_Learning.storage.ragged import RaggedArray
+from CMS_Deep_Learning.storage.lazy import LazyArray, closeFile
+from CMS_Deep_Learning.storage.data_cache import getDataCache
+from CMS_Deep_Learning.storage.catalog import updateCatalog, removeFromCatalog, queryCatalog
+
+#Importing hdf5plugin registers the blosc filter with HDF5, which is needed to read and write blosc compressed archives
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+#The compression filters that archives can be written with (See archiveLayout)
+ARCHIVE_COMPRESSIONS = [None, "lzf", "gzip", "blosc"]
 
 class Storable( object ):
     """An object that we can hash, archive as a json String, and reconstitute"""
@@ -59,6 +72,7 @@ class Storable( object ):
                 shutil.rmtree(parentfolder)
         except Exception as e:
             print(e)
+        removeFromCatalog(self.archive_dir, self.hash())
 
 
     def read_record(self, verbose=0):
@@ -72,6 +86,7 @@ class Storable( object ):
         if(not isinstance(obj, dict)):
             raise TypeError("obj must be type dict, but got %r" % type(obj))
         write_json_obj(obj, self.get_path(),'record.json',verbose=verbose)
+        updateCatalog(self.archive_dir, self.hash())
 
     def remove_from_record(self, key, verbose=0):
         '''Remove a key from the record. Returns 1 if sucessfully removed 0 if does not exist'''
@@ -85,9 +100,12 @@ class Storable( object ):
 
     @staticmethod
     def get_all_paths(archive_dir):
-        '''Get a list of all the blob paths of the Storables in the given archive_dir'''
+        '''Get a list of all the blob paths of the Storables in the given archive_dir, from its catalog if it has one'''
         if(archive_dir[-1] != "/"):
             archive_dir += "/"
+        rows = queryCatalog(archive_dir)
+        if(rows != None):
+            return [get_blob_path(hashcode=row["hash"], archive_dir=archive_dir) for row in rows]
         directories = glob.glob(archive_dir + "blobs/*")
         paths = []
         for d in directories:
@@ -98,6 +116,9 @@ class Storable( object ):
     @classmethod
     def get_all_records(cls,archive_dir,verbose=0):
         '''Get a dicionary of all the records in the archive_dir keyed by their hashcodes'''
+        rows = queryCatalog(archive_dir, blob_type=_catalogType(cls), recorded=True)
+        if(rows != None):
+            return {row["hash"] : row["record"] for row in rows}
         paths = cls.get_all_paths(archive_dir)
         records = {}
         for path in paths:
@@ -133,6 +154,13 @@ class Storable( object ):
 class DataProcedure(Storable):
     '''A wrapper for archiving the results of data grabbing and preprocessing functions of the type X,Y getData where are X is the training
         data and Y contains the labels/targets for each entry'''
+
+    #Whether X is archived as RaggedArrays without its zero padding. Both formats give the same data, so it is
+    #stored in procedure.json but does not change the hash. Only set on the instance when it is True.
+    ragged_archive = False
+    #The chunking and compression that the archive is written with (See archiveLayout). Like ragged_archive it is
+    #stored in procedure.json but does not change the hash. Only set on the instance when it is not None.
+    archive_layout = None
     def __init__(self, _archive_dir,archive_getData, func,  *args, **kargs):
         Storable.__init__(self)
         if(isinstance(_archive_dir, str) == False and isinstance(_archive_dir, unicode) == False):
@@ -170,9 +198,13 @@ class DataProcedure(Storable):
         '''Gets a string that uniquely defines an object as far as its model, complilation, and training parameters are concerned'''
 
         d = self._genJsonableDict()
+        if("ragged_archive" in d): del d["ragged_archive"]
+        if("archive_layout" in d): del d["archive_layout"]
         #Don't hash on verbose or verbosity if they are in the function
         if("verbose" in d.get("kargs", [])): del d['kargs']["verbose"]
         if("verbosity" in d.get("kargs", [])): del d['kargs']["verbosity"]
+        #Or on how many processes are used, which doesn't change the result
+        if("num_workers" in d.get("kargs", [])): del d['kargs']["num_workers"]
 
         return self.encoder.encode(d)
 
@@ -188,6 +220,44 @@ class DataProcedure(Storable):
         json_str = self.to_json()
         blob_path = self.get_path()
         write_object(blob_path, 'procedure.json', json_str, verbose=verbose)
+        updateCatalog(self.archive_dir, self.hash())
+
+    def remove_from_archive(self):
+        '''Removes the archived data of the DataProcedure, its entries in the DataCache and its open lazy archive'''
+        getDataCache().evict(self.hash())
+        closeFile(self.get_path() + 'archive.h5')
+        Storable.remove_from_archive(self)
+
+    def _readMeta(self):
+        '''Helper Function - the record with the num_samples, shapes and dtypes of the archive. If it was archived
+            before they were recorded they are read from the headers of archive.h5, without changing the record.'''
+        record = self.read_record()
+        if(not all([k in record for k in ["num_samples", "shapes", "dtypes"]])):
+            h5f = h5py.File(self.get_path() + 'archive.h5', 'r')
+            try:
+                record.update(_archiveMeta(h5f))
+            finally:
+                h5f.close()
+        return record
+
+    def num_samples(self):
+        '''Returns the number of samples in the archive without reading the data, or None if the DataProcedure is not archived'''
+        if(not self.is_archived()): return None
+        return self._readMeta()["num_samples"]
+
+    def shapes(self):
+        '''Returns a dictionary like {"X" : [shape of X[0], ...], "Y" : [shape of Y[0], ...]} of the archived arrays
+            without reading the data, or None if the DataProcedure is not archived. Ragged X have their padded shapes.'''
+        if(not self.is_archived()): return None
+        shapes = self._readMeta()["shapes"]
+        return {key: [tuple(shape) for shape in shapes[key]] for key in shapes}
+
+    def dtypes(self):
+        '''Returns a dictionary like {"X" : [dtype of X[0], ...], "Y" : [dtype of Y[0], ...]} of the archived arrays
+            without reading the data, or None if the DataProcedure is not archived'''
+        if(not self.is_archived()): return None
+        dtypes = self._readMeta()["dtypes"]
+        return {key: [np.dtype(dtype) for dtype in dtypes[key]] for key in dtypes}
 
     def is_archived(self):
         '''Returns True if this procedure is already archived'''
@@ -198,8 +268,16 @@ class DataProcedure(Storable):
         else:
             return False
 
-    def archive(self, X, Y):
-        '''Store the DataProcedure in a directory computed by its hashcode'''
+    def archive(self, X, Y, dtype=None, ragged=None, layout=None):
+        '''Store the DataProcedure in a directory computed by its hashcode. If dtype is given X and Y are
+            stored as that dtype (i.e. 'float32'), otherwise as their own dtypes. If ragged (ragged_archive if None)
+            each X is stored as the values and offsets of a RaggedArray, leaving out its zero padding. The datasets
+            are chunked and compressed as set by layout (archive_layout if None, See archiveLayout). The layout is
+            recorded in the attributes of the archive, and is read back transparently by h5py.'''
+        if(ragged == None): ragged = self.ragged_archive
+        if(layout == None): layout = self.archive_layout
+        getDataCache().evict(self.hash())
+        closeFile(self.get_path() + 'archive.h5')
         if((not X is None) and (not Y is None)):
             blob_path = self.get_path()
             if( os.path.exists(blob_path) == False):
@@ -210,13 +288,24 @@ class DataProcedure(Storable):
             if(isinstance(X, list) == False): X = [X]
             if(isinstance(Y, list) == False): Y = [Y]
             h5f = h5py.File(self.get_path() + 'archive.h5', 'w')
+            if(layout != None): h5f.attrs['layout'] = json.dumps(layout, sort_keys=True)
             h5f.create_group("X")
             for i, x in enumerate(X):
-                h5f.create_dataset('X/'+str(i), data=x)
+                if(ragged or isinstance(x, RaggedArray)):
+                    if(not isinstance(x, RaggedArray)): x = RaggedArray.fromPadded(x)
+                    group = h5f.create_group('X/'+str(i))
+                    #Chunk the values so that a chunk holds about as many samples as the padded chunks would
+                    rows_per_sample = len(x.values) / float(max(len(x), 1))
+                    group.create_dataset('values', data=x.values, dtype=dtype,
+                                         **_datasetOptions(x.values.shape, layout, rows_per_sample))
+                    group.create_dataset('offsets', data=x.offsets)
+                    group.attrs['max_length'] = x.max_length
+                else:
+                    h5f.create_dataset('X/'+str(i), data=x, dtype=dtype, **_datasetOptions(np.shape(x), layout))
             h5f.create_group("Y")
             for i, y in enumerate(Y):
-                h5f.create_dataset('Y/'+str(i), data=y)
-            
+                h5f.create_dataset('Y/'+str(i), data=y, dtype=dtype, **_datasetOptions(np.shape(y), layout))
+            meta = _archiveMeta(h5f)
             h5f.close()
 
             #TODO: this is a really backward way of doing this
@@ -228,6 +317,7 @@ class DataProcedure(Storable):
             record_dict['module'] = d['func_module']
             record_dict['args'] = d['args']
             record_dict['kargs'] = d['kargs']
+            record_dict.update(meta)
 
             self.write_record(record_dict)
                 
@@ -235,10 +325,26 @@ class DataProcedure(Storable):
             raise ValueError("Cannot archive DataProcedure with NoneType X or Y")
         
 
-    def getData(self, archive=True, redo=False, verbose=1):
-        '''Apply the DataProcedure returning X,Y from the archive or generating them from func'''
+    def getData(self, archive=True, redo=False, verbose=1, dtype=None, ragged=False, lazy=False, cache=False):
+        '''Apply the DataProcedure returning X,Y from the archive or generating them from func. If dtype is
+            given X and Y are returned as that dtype, archives are converted as they are read. If ragged each
+            X is returned as a RaggedArray (See CMS_Deep_Learning.storage.ragged) instead of a padded array.
+            If lazy and the DataProcedure is archived X and Y are returned as LazyArrays (See
+            CMS_Deep_Learning.storage.lazy) that only read the samples that they are indexed with.
+            If cache (and not lazy) the data read from the archive is kept in the process wide DataCache
+            (See CMS_Deep_Learning.storage.data_cache) and returned as read only arrays, which later calls with
+            cache get back while the archive is unchanged.'''
 
         if(self.is_archived() and redo == False):
+            cache_key = None
+            if(cache and not lazy):
+                archive_path = self.get_path() + 'archive.h5'
+                cache_key = (self.hash(), archive_path, os.path.getmtime(archive_path),
+                             None if dtype == None else np.dtype(dtype).name, bool(ragged))
+                out = getDataCache().get(cache_key)
+                if(out != None):
+                    if(verbose >= 1): print("DataProcedure results %r read from cache" % self.hash())
+                    return out
             h5f = None
             try:
                 h5f = h5py.File(self.get_path() + 'archive.h5', 'r')
@@ -247,7 +353,7 @@ class DataProcedure(Storable):
                 keys = list(X_group.keys())
                 keys.sort()
                 for key in keys:
-                    X.append(X_group[key][:])
+                    X.append(_readX(X_group[key], dtype, ragged, lazy))
 
 
                 Y = []
@@ -255,16 +361,17 @@ class DataProcedure(Storable):
                 keys = list(Y_group.keys())
                 keys.sort()
                 for key in keys:
-                    Y.append(Y_group[key][:])
+                    Y.append(_readDataset(Y_group[key], dtype, lazy))
 
                 h5f.close()
                 out = (X, Y)
+                if(cache_key != None): getDataCache().put(cache_key, out)
                 if(verbose >= 1): print("DataProcedure results %r read from archive" % self.hash())
             except Exception as e:
                 print(e)
                 if(h5f != None): h5f.close()
                 if(verbose >= 1): print("Failed to load archive %r running from scratch" % self.hash())
-                return self.getData(archive=archive, redo=True, verbose=verbose)
+                return self.getData(archive=archive, redo=True, verbose=verbose, dtype=dtype, ragged=ragged, lazy=lazy, cache=cache)
         else:
             prep_func = self.get_func(self.func, self.func_module)
 
@@ -278,6 +385,11 @@ class DataProcedure(Storable):
                         if(self.archive_getData == True or archive == True):
                             self.archive(out[0], out[1])
                             if(verbose >= 1): print("ARCHIVE SUCCESSFUL %r" % self.hash())
+                        if(dtype != None):
+                            out = (_castArrays(out[0], dtype), _castArrays(out[1], dtype))
+                        if(ragged):
+                            X = out[0] if isinstance(out[0], list) else [out[0]]
+                            out = ([x if isinstance(x, RaggedArray) else RaggedArray.fromPadded(x) for x in X], out[1])
                 else:
                     raise ValueError("getData returned too many arguments expected 2 got %r" % len(out))
             elif(isinstance(out, types.GeneratorType)):
@@ -347,6 +459,8 @@ class DataProcedure(Storable):
 
         archive_getData = d['archive_getData']
         dp = cls(archive_dir, archive_getData, func, *args, **kargs)
+        if(d.get('ragged_archive', False)): dp.ragged_archive = True
+        if(d.get('archive_layout', None) != None): dp.archive_layout = d['archive_layout']
         if(func == temp):
             dp.func = d['func']
             dp.func_module = d['func_module']
@@ -1103,6 +1217,102 @@ def decodeCallback(d):
 
 
 
+def archiveLayout(chunk_samples=None, compression="lzf", level=None, shuffle=True):
+    '''Makes an archive layout for DataProcedure.archive, or for the archive_layout of a DataProcedure. The layout
+        is lossless, so it does not change the data that is read back.
+        #Arguments
+            chunk_samples -- How many samples each chunk holds, usually the batch_size used in training so that
+                            a batch is read from as few chunks as possible. If None h5py picks the chunk shape.
+            compression -- One of None, 'lzf', 'gzip' or 'blosc'. Zero padded arrays compress well with any of them.
+                            'blosc' requires hdf5plugin to write and to read the archive.
+            level -- The compression level of 'gzip' or 'blosc' (0-9), their default if None
+            shuffle -- Whether to byte shuffle the data before compressing it, which helps compress floats
+        #Returns
+            A dictionary of the layout
+    '''
+    if(not compression in ARCHIVE_COMPRESSIONS):
+        raise ValueError("compression must be one of %r, but got %r" % (ARCHIVE_COMPRESSIONS, compression))
+    if(compression == "blosc" and hdf5plugin == None):
+        raise ImportError("blosc compression requires hdf5plugin, please install it (pip install hdf5plugin)")
+    if(chunk_samples != None and chunk_samples < 1):
+        raise ValueError("chunk_samples must be at least 1, but got %r" % chunk_samples)
+    layout = {"compression" : compression, "shuffle" : shuffle}
+    if(chunk_samples != None): layout["chunk_samples"] = int(chunk_samples)
+    if(level != None): layout["level"] = int(level)
+    return layout
+
+def _datasetOptions(shape, layout, rows_per_sample=1.0):
+    '''Helper Function - The keyword arguments of h5py's create_dataset for a dataset of a given shape with
+        an archive layout. rows_per_sample is how many rows of the dataset one sample takes up on average.'''
+    if(layout == None or len(shape) == 0 or shape[0] == 0):
+        return {}
+    options = {"chunks" : True}
+    if(layout.get("chunk_samples", None) != None):
+        rows = int(np.ceil(layout["chunk_samples"] * rows_per_sample))
+        options["chunks"] = (min(max(rows, 1), shape[0]),) + tuple(shape[1:])
+    compression = layout.get("compression", None)
+    shuffle = layout.get("shuffle", True)
+    if(compression == "blosc"):
+        if(hdf5plugin == None):
+            raise ImportError("blosc compression requires hdf5plugin, please install it (pip install hdf5plugin)")
+        options.update(hdf5plugin.Blosc(cname='lz4', clevel=layout.get("level", 5),
+                                        shuffle=hdf5plugin.Blosc.SHUFFLE if shuffle else hdf5plugin.Blosc.NOSHUFFLE))
+    elif(compression != None):
+        options["compression"] = compression
+        if(compression == "gzip" and layout.get("level", None) != None): options["compression_opts"] = layout["level"]
+        options["shuffle"] = shuffle
+    return options
+
+def _archiveMeta(h5f):
+    '''Helper Function - Reads the number of samples and the shapes and dtypes of the arrays of an open archive from
+        their headers, as a dictionary that can be stored in a record'''
+    meta = {"shapes" : {}, "dtypes" : {}}
+    for name in ["X", "Y"]:
+        group = h5f[name]
+        keys = list(group.keys())
+        keys.sort()
+        meta["shapes"][name] = []
+        meta["dtypes"][name] = []
+        for key in keys:
+            node = group[key]
+            if(isinstance(node, h5py.Group)):
+                shape = (node['offsets'].shape[0] - 1, int(node.attrs['max_length'])) + node['values'].shape[1:]
+                dtype = node['values'].dtype
+            else:
+                shape, dtype = node.shape, node.dtype
+            meta["shapes"][name].append([int(d) for d in shape])
+            meta["dtypes"][name].append(np.dtype(dtype).name)
+    shapes = meta["shapes"]["Y"] + meta["shapes"]["X"]
+    meta["num_samples"] = shapes[0][0] if len(shapes) > 0 else 0
+    return meta
+
+def _readDataset(dataset, dtype=None, lazy=False):
+    '''Helper Function - Reads a whole h5py dataset, converting it to dtype while it is read if dtype is given.
+        If lazy returns a LazyArray of the dataset instead.'''
+    if(lazy):
+        return LazyArray(dataset.file.filename, dataset.name, dtype)
+    if(dtype == None or np.dtype(dtype) == dataset.dtype):
+        return dataset[:]
+    out = np.empty(dataset.shape, dtype=dtype)
+    if(out.size > 0): dataset.read_direct(out)
+    return out
+
+def _readX(node, dtype=None, ragged=False, lazy=False):
+    '''Helper Function - Reads an X array from an archive that is either a dataset of the padded array or a
+        group with the values and offsets of a RaggedArray. Returns a RaggedArray if ragged, otherwise the padded array.
+        If lazy the padded array or the values of the RaggedArray are a LazyArray, unless they have to be converted.'''
+    if(isinstance(node, h5py.Group)):
+        x = RaggedArray(_readDataset(node['values'], dtype, lazy and ragged), node['offsets'][:], int(node.attrs['max_length']))
+        return x if ragged else x.toPadded()
+    x = _readDataset(node, dtype, lazy and not ragged)
+    return RaggedArray.fromPadded(x) if ragged else x
+
+def _castArrays(arrs, dtype):
+    '''Helper Function - Casts an array or a list of arrays to dtype, without copying arrays that already have it'''
+    if(isinstance(arrs, list)):
+        return [np.asarray(a).astype(dtype, copy=False) for a in arrs]
+    return np.asarray(arrs).astype(dtype, copy=False)
+
 def compute_hash(inp):
     '''Computes a SHA1 hash string from a json string or Storable'''
     hashable_str = inp
@@ -1209,16 +1419,41 @@ def get_all_data(archive_dir,verbose=0):
     '''Gets all the DataProcedure in the data_archive'''
     return get_data_by_function('.', archive_dir,verbose=verbose)
 
+def _catalogType(cls):
+    '''Helper Function - the type in the catalog of the blobs of a Storable class, None for any type'''
+    if(issubclass(cls, KerasTrial)):
+        return "trial"
+    elif(issubclass(cls, DataProcedure)):
+        return "procedure"
+    return None
+
+def _fromCatalog(cls, archive_dir, rows, verbose=0):
+    '''Helper Function - makes the Storables of rows from the catalog without opening their blobs'''
+    out = []
+    for row in rows:
+        try:
+            storable = cls.from_json(archive_dir, row["json"])
+        except ValueError as e:
+            if(verbose >= 1): print("Failed to load %r from the catalog: %r" % (row["hash"], e))
+            continue
+        storable.hashcode = row["hash"]
+        out.append(storable)
+    return out
+
 def get_data_by_function(func, archive_dir,verbose=0):
     '''Gets a list of DataProcedure that use a certain function'''
-    record = DataProcedure.get_all_records(archive_dir)
-    out = []
     if(isinstance(func, str)):
         func_name = func
         func_module = None
     else:
         func_name = func.__name__
         func_module = func.__module__
+    rows = queryCatalog(archive_dir, blob_type="procedure", func=func_name, func_module=func_module, regex=True, recorded=True)
+    if(rows != None):
+        return _fromCatalog(DataProcedure, archive_dir, rows, verbose=verbose)
+
+    record = DataProcedure.get_all_records(archive_dir)
+    out = []
 
     for key in record:
         t_func = record[key].get("func", 'unknown')
@@ -1237,6 +1472,9 @@ def get_all_trials(archive_dir, verbose=0):
 
 def get_trials_by_name(name, archive_dir, verbose=0):
     '''Get all the trials with a particluar name or that match a given regular expression'''
+    rows = queryCatalog(archive_dir, blob_type="trial", name=name, regex=True, recorded=True)
+    if(rows != None):
+        return _fromCatalog(KerasTrial, archive_dir, rows, verbose=verbose)
     record = KerasTrial.get_all_records(archive_dir)
     out = []
     for key in record:
@@ -0,0 +1,305 @@
+'''
+catalog.py
+An SQLite catalog of the blobs in an archive directory, stored as <archive_dir>/catalog.sqlite. For every
+blob it keeps its hash, whether it is a trial or a procedure, its json, its names, its function, its record
+and whether it is complete, so that archives can be searched without globbing and opening every blob.
+
+The catalog is kept up to date by Storable.write_record, the write() of DataProcedures and KerasTrials and
+Storable.remove_from_archive. It is created with the first blob of a new archive, from every blob in the
+archive at the time, while holding a lock so that processes writing their first blobs at once don't leave
+any out. Archives that already have blobs only get a catalog from rebuildCatalog(), so that an incomplete
+catalog is never used. Blobs added by other means (i.e. rsync) need a rebuildCatalog() to be found.
+'''
+
+import json
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+CATALOG_NAME = "catalog.sqlite"
+LOCK_NAME = ".catalog.lock"
+
+#The characters that make a name or function a regular expression rather than a plain prefix
+_REGEX_CHARS = set(".^$*+?{}[]\\|()")
+
+#Whether each archive directory has blobs that are not in a catalog, found the first time it is written to by this process
+_uncataloged = {}
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, type TEXT, json TEXT, func TEXT,
+                                         func_module TEXT, complete INTEGER, record TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS names (hash TEXT, name TEXT)''',
+    '''CREATE TABLE IF NOT EXISTS record_values (hash TEXT, key TEXT, value TEXT)''',
+    '''CREATE INDEX IF NOT EXISTS blobs_type ON blobs (type)''',
+    '''CREATE INDEX IF NOT EXISTS blobs_func ON blobs (func)''',
+    '''CREATE INDEX IF NOT EXISTS names_name ON names (name)''',
+    '''CREATE INDEX IF NOT EXISTS names_hash ON names (hash)''',
+    '''CREATE INDEX IF NOT EXISTS record_values_key_value ON record_values (key, value)''',
+    '''CREATE INDEX IF NOT EXISTS record_values_hash ON record_values (hash)''',
+]
+
+
+def catalogPath(archive_dir):
+    '''Returns the path of the catalog of an archive directory'''
+    return os.path.join(archive_dir, CATALOG_NAME)
+
+def hasCatalog(archive_dir):
+    '''Returns whether an archive directory has a catalog'''
+    return os.path.isfile(catalogPath(archive_dir))
+
+def _regexp(pattern, value):
+    '''Helper Function - the REGEXP of the catalog, which matches like re.match'''
+    return value != None and re.match(pattern, value) != None
+
+@contextmanager
+def _catalogLock(archive_dir):
+    '''Helper Function - holds an exclusive lock on creating the catalog of an archive directory, so that
+        only one process creates it. Does nothing on platforms without fcntl.'''
+    if(fcntl == None):
+        yield
+        return
+    with open(os.path.join(archive_dir, LOCK_NAME), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def _connect(archive_dir, path=None):
+    '''Helper Function - opens the catalog of an archive directory (or the catalog file at path), creating its
+        tables if they don't exist'''
+    conn = sqlite3.connect(path or catalogPath(archive_dir), timeout=60)
+    conn.create_function("REGEXP", 2, _regexp)
+    for statement in _SCHEMA:
+        conn.execute(statement)
+    return conn
+
+def _blobPath(archive_dir, hashcode):
+    '''Helper Function - the blob path of a hash (See archiving.get_blob_path)'''
+    return os.path.join(archive_dir, "blobs", hashcode[:5], hashcode[5:]) + "/"
+
+def _readJson(path):
+    '''Helper Function - reads a json file, or returns None if it can't be read'''
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _blobRow(archive_dir, hashcode):
+    '''Helper Function - reads the files of a blob and returns its row of the blobs table, its names and its
+        record, or None if the blob is not a trial or procedure'''
+    blob_path = _blobPath(archive_dir, hashcode)
+    record = _readJson(blob_path + "record.json") or {}
+    func = func_module = complete = None
+    names = []
+    if(os.path.isfile(blob_path + "trial.json")):
+        blob_type = "trial"
+        with open(blob_path + "trial.json", "r") as f:
+            json_str = f.read()
+        #Trials without a name are listed as 'unknown' like in get_trials_by_name
+        names = record.get("name", "unknown")
+        if(not isinstance(names, list)): names = [names]
+        history = _readJson(blob_path + "history.json") or {}
+        complete = int(len(history.get("stops", [])) > 0)
+    elif(os.path.isfile(blob_path + "procedure.json")):
+        blob_type = "procedure"
+        with open(blob_path + "procedure.json", "r") as f:
+            json_str = f.read()
+        d = json.loads(json_str)
+        func, func_module = d.get("func", None), d.get("func_module", None)
+    else:
+        return None
+    return (hashcode, blob_type, json_str, func, func_module, complete, json.dumps(record, sort_keys=True)), names, record
+
+def _recordValues(record):
+    '''Helper Function - the (key, value) pairs of a record for the record_values table. Lists give a pair for each item.'''
+    pairs = []
+    for key, value in record.items():
+        for v in (value if isinstance(value, list) else [value]):
+            if(not isinstance(v, (dict, list))):
+                pairs.append((key, json.dumps(v)))
+    return pairs
+
+def _store(conn, archive_dir, hashcode):
+    '''Helper Function - replaces the rows of a blob with what is in its files'''
+    for table in ["blobs", "names", "record_values"]:
+        conn.execute("DELETE FROM %s WHERE hash = ?" % table, (hashcode,))
+    row = _blobRow(archive_dir, hashcode)
+    if(row == None):
+        return
+    blob, names, record = row
+    conn.execute("INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?)", blob)
+    conn.executemany("INSERT INTO names VALUES (?, ?)", [(hashcode, str(n)) for n in names])
+    conn.executemany("INSERT INTO record_values VALUES (?, ?, ?)", [(hashcode, k, v) for k, v in _recordValues(record)])
+
+def _isNewArchive(archive_dir, hashcode):
+    '''Helper Function - whether the only blob in an archive directory is the one with the given hash'''
+    blobs_dir = os.path.join(archive_dir, "blobs")
+    if(not os.path.isdir(blobs_dir)):
+        return True
+    blob_dirs = os.listdir(blobs_dir)
+    if(len(blob_dirs) == 0):
+        return True
+    if(blob_dirs != [hashcode[:5]]):
+        return False
+    return set(os.listdir(os.path.join(blobs_dir, hashcode[:5]))) <= set([hashcode[5:]])
+
+def _allHashcodes(archive_dir):
+    '''Helper Function - the hashes of every blob in an archive directory'''
+    blobs_dir = os.path.join(archive_dir, "blobs")
+    hashcodes = []
+    if(os.path.isdir(blobs_dir)):
+        for blob_dir in sorted(os.listdir(blobs_dir)):
+            if(os.path.isdir(os.path.join(blobs_dir, blob_dir))):
+                hashcodes += [blob_dir + blob for blob in sorted(os.listdir(os.path.join(blobs_dir, blob_dir)))]
+    return hashcodes
+
+def _storeAll(conn, archive_dir, verbose=0):
+    '''Helper Function - replaces the rows of the catalog with every blob in the archive directory. The blobs are
+        listed after taking the write lock of the catalog, so that an updateCatalog() of another process either
+        commits before the blobs are listed or waits until they are all stored.'''
+    isolation_level = conn.isolation_level
+    #Begin the transaction explicitly, because sqlite3 only begins one on the first DELETE
+    conn.isolation_level = None
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        hashcodes = _allHashcodes(archive_dir)
+        for table in ["blobs", "names", "record_values"]:
+            conn.execute("DELETE FROM %s" % table)
+        for i, hashcode in enumerate(hashcodes):
+            _store(conn, archive_dir, hashcode)
+            if(verbose >= 1 and (i+1) % 1000 == 0): print("Cataloged %r of %r blobs" % (i+1, len(hashcodes)))
+        conn.execute("COMMIT")
+    except:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.isolation_level = isolation_level
+    return conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+def _createCatalog(archive_dir):
+    '''Helper Function - creates the catalog of a new archive directory from every blob in it. It is written to a
+        temporary file that is renamed when it is done, so that other processes never see it partly written.'''
+    tmp_path = "%s.%d.tmp" % (catalogPath(archive_dir), os.getpid())
+    try:
+        conn = _connect(archive_dir, tmp_path)
+        _storeAll(conn, archive_dir)
+        conn.close()
+        os.rename(tmp_path, catalogPath(archive_dir))
+    finally:
+        if(os.path.exists(tmp_path)): os.remove(tmp_path)
+
+def updateCatalog(archive_dir, hashcode):
+    '''Updates the entry of a blob in the catalog of its archive directory from its files, or removes it if the blob
+        is gone. Creates the catalog if the blob is the first in the archive directory, and does nothing for archives
+        with blobs and no catalog.'''
+    if(not hasCatalog(archive_dir)):
+        key = os.path.abspath(archive_dir)
+        if(_uncataloged.get(key, False)):
+            return
+        try:
+            #Decide whether to create the catalog while holding the lock, so that a process that writes its first
+            #blob while another creates the catalog either sees the catalog or has its blob in it
+            with _catalogLock(archive_dir):
+                if(not hasCatalog(archive_dir)):
+                    _uncataloged[key] = not _isNewArchive(archive_dir, hashcode)
+                    if(not _uncataloged[key]):
+                        _createCatalog(archive_dir)
+                    return
+        except (sqlite3.Error, IOError, OSError) as e:
+            print("Failed to create catalog %r: %r" % (catalogPath(archive_dir), e))
+            return
+    try:
+        conn = _connect(archive_dir)
+        with conn:
+            _store(conn, archive_dir, hashcode)
+        conn.close()
+    except sqlite3.Error as e:
+        print("Failed to update catalog %r: %r" % (catalogPath(archive_dir), e))
+
+def removeFromCatalog(archive_dir, hashcode):
+    '''Removes a blob from the catalog of its archive directory, if it has one'''
+    if(hasCatalog(archive_dir)):
+        updateCatalog(archive_dir, hashcode)
+
+def rebuildCatalog(archive_dir, verbose=0):
+    '''Creates or recreates the catalog of an archive directory by reading every blob in it
+        #Returns
+            The number of trials and procedures in the catalog
+    '''
+    with _catalogLock(archive_dir):
+        conn = _connect(archive_dir)
+        num = _storeAll(conn, archive_dir, verbose=verbose)
+        conn.close()
+    _uncataloged.pop(os.path.abspath(archive_dir), None)
+    if(verbose >= 1): print("Cataloged %r trials and procedures in %r" % (num, archive_dir))
+    return num
+
+def _matchCondition(column, value, regex):
+    '''Helper Function - the condition and parameters that match a column to a value. Regular expressions match like
+        re.match, and those without special characters are plain prefixes that are matched with the index.'''
+    if(not regex):
+        return "%s = ?" % column, [value]
+    if(len(value) > 0 and len(set(value) & _REGEX_CHARS) == 0 and ord(value[-1]) < 127):
+        #Everything that starts with value sorts between it and value with its last character incremented
+        return "%s >= ? AND %s < ?" % (column, column), [value, value[:-1] + chr(ord(value[-1]) + 1)]
+    return "%s REGEXP ?" % column, [value]
+
+def queryCatalog(archive_dir, blob_type=None, name=None, func=None, func_module=None, record=None, complete=None, regex=False,
+                 recorded=False):
+    '''Finds blobs in the catalog of an archive directory. Exact matches on name, func and record values use indices.
+        #Arguments
+            blob_type -- "trial" or "procedure", either if None
+            name -- A name of the trial
+            func, func_module -- The function of the procedure and its module
+            record -- A dictionary of values that the record must have, i.e. {"num_train" : 1000}. A list in the record
+                        matches if any of its items match.
+            complete -- True or False to only find trials that are or are not complete
+            regex -- If True name, func and func_module are regular expressions that match like re.match. Those
+                        without special characters still use indices.
+            recorded -- If True only find blobs with a non-empty record.json, like get_all_records()
+        #Returns
+            A list of dictionaries like {"hash" : hashcode, "type" : blob_type, "json" : the trial.json or procedure.json
+            string, "record" : the record}, or None if the archive directory has no catalog or it can't be read
+    '''
+    if(not hasCatalog(archive_dir)):
+        return None
+    conditions, params = [], []
+    if(blob_type != None):
+        conditions.append("type = ?")
+        params.append(blob_type)
+    if(name != None):
+        condition, values = _matchCondition("name", name, regex)
+        conditions.append("hash IN (SELECT hash FROM names WHERE %s)" % condition)
+        params += values
+    for column, value in [("func", func), ("func_module", func_module)]:
+        if(value != None):
+            condition, values = _matchCondition(column, value, regex)
+            conditions.append(condition)
+            params += values
+    for key, value in (record or {}).items():
+        conditions.append("hash IN (SELECT hash FROM record_values WHERE key = ? AND value = ?)")
+        params += [key, json.dumps(value)]
+    if(complete != None):
+        conditions.append("complete = ?")
+        params.append(int(complete))
+    if(recorded):
+        conditions.append("record != ?")
+        params.append(json.dumps({}))
+    query = "SELECT hash, type, json, record FROM blobs"
+    if(len(conditions) > 0): query += " WHERE " + " AND ".join(conditions)
+    try:
+        conn = _connect(archive_dir)
+        rows = conn.execute(query + " ORDER BY hash", params).fetchall()
+        conn.close()
+    except sqlite3.Error as e:
+        print("Failed to query catalog %r, scanning the archive instead: %r" % (catalogPath(archive_dir), e))
+        return None
+    return [{"hash" : str(h), "type" : str(t), "json" : j, "record" : json.loads(r)} for h, t, j, r in rows]
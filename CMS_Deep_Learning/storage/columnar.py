@@ -0,0 +1,108 @@
+'''
+columnar.py
+Reading and writing parsed Delphes frames in Parquet format. A file is stored as a directory
+<name>.parquet/ with one <key>.parquet file for each frame (i.e. Electron.parquet, NumValues.parquet).
+Row groups are aligned to ranges of entries, so a range of entries can be read without decoding the
+rest of the file, and only the requested columns are read.
+Requires pyarrow.
+'''
+
+import os
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_EXT = ".parquet"
+
+#How many entries are in each row group
+ROW_GROUP_ENTRIES = 1000
+
+
+def _checkPyarrow():
+    '''Helper Function - raises an ImportError if pyarrow is not installed'''
+    if(pa == None):
+        raise ImportError("Reading and writing Parquet files requires pyarrow, please install it (pip install pyarrow)")
+
+def _keyPath(path, key):
+    '''Helper Function - the path to the file of a frame in a Parquet directory'''
+    return os.path.join(path, key.strip("/") + PARQUET_EXT)
+
+def writeParquetFrames(path, frames, row_group_entries=ROW_GROUP_ENTRIES, compression='snappy'):
+    '''Writes a dictionary of frames as returned by delphes_to_pandas() to a Parquet directory
+        #Arguments
+            path -- The directory to write to, usually ending in .parquet
+            frames -- A dictionary keyed by object type of DataFrames with an Entry column, and
+                        a DataFrame keyed by "NumValues" with one row per entry
+            row_group_entries -- How many entries to put in each row group
+            compression -- The Parquet compression codec to use
+    '''
+    _checkPyarrow()
+    if not os.path.exists(path):
+        os.makedirs(path)
+    num_val_frame = frames["NumValues"]
+    num_entries = len(num_val_frame.index)
+    first_entry = num_val_frame.index[0] if num_entries > 0 else 0
+    bounds = np.append(np.arange(0, num_entries, row_group_entries), num_entries)
+    for key, frame in frames.items():
+        #Find the first row of every range of entries
+        if(key == "NumValues"):
+            row_bounds = bounds
+        else:
+            row_bounds = np.searchsorted(frame["Entry"].values - first_entry, bounds, side='left')
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        writer = pq.ParquetWriter(_keyPath(path, key), table.schema, compression=compression)
+        try:
+            if(len(frame.index) == 0):
+                writer.write_table(table)
+            for start, stop in zip(row_bounds[:-1], row_bounds[1:]):
+                if(stop > start):
+                    group = pa.Table.from_pandas(frame.iloc[start:stop], preserve_index=False)
+                    writer.write_table(group, row_group_size=stop-start)
+        finally:
+            writer.close()
+
+def parquetColumns(path, key):
+    '''Returns the names of the columns of a frame in a Parquet directory'''
+    _checkPyarrow()
+    return list(pq.ParquetFile(_keyPath(path, key)).schema.names)
+
+def readParquetFrame(path, key, start=None, stop=None, columns=None):
+    '''Reads a range of rows of a frame in a Parquet directory, only decoding the row groups that
+        overlap with the range
+        #Arguments
+            path -- The Parquet directory
+            key -- The name of the frame (i.e. Electron, NumValues)
+            start, stop -- The range of rows to read, None for the whole frame
+            columns -- The columns to read, None for all of them
+        #Returns
+            A DataFrame with the rows in [start, stop) indexed from 0
+    '''
+    _checkPyarrow()
+    pf = pq.ParquetFile(_keyPath(path, key))
+    group_rows = [pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups)]
+    group_starts = np.concatenate([[0], np.cumsum(group_rows)]).astype('int64')
+    if(start == None): start = 0
+    if(stop == None): stop = int(group_starts[-1])
+    if(columns != None): columns = list(columns)
+
+    if(pf.num_row_groups == 0):
+        return pf.read(columns=columns).to_pandas()
+
+    #Only read the row groups that overlap with [start, stop)
+    first = int(np.searchsorted(group_starts, start, side='right')) - 1
+    first = min(max(first, 0), pf.num_row_groups - 1)
+    last = int(np.searchsorted(group_starts, stop, side='left'))
+    last = min(max(last, first + 1), pf.num_row_groups)
+    tables = [pf.read_row_group(i, columns=columns) for i in range(first, last)]
+    frame = pa.concat_tables(tables).to_pandas()
+    offset = int(group_starts[first])
+    return frame.iloc[start-offset:stop-offset].reset_index(drop=True)
+
+def readParquetNumValues(path):
+    '''Reads the NumValues frame of a Parquet directory'''
+    return readParquetFrame(path, "NumValues")
@@ -0,0 +1,118 @@
+'''
+data_cache.py
+A process wide cache of the (X, Y) that DataProcedures read from their archives, so that reading the same
+archive again in the same session does not decode it from disk. Entries are keyed by the hash of the
+DataProcedure, the path and mtime of its archive and how it was read (dtype, ragged). The least recently used
+entries are evicted to keep the cache within a budget of megabytes. The cache keeps the arrays it is given
+without copying them and makes them read only, since they are shared by every getData() that hits them.
+DataIterator and genFromDPs read through it with getData(cache=True).
+'''
+
+import threading
+from collections import OrderedDict
+
+from CMS_Deep_Learning.storage.prefetch import dataBytes
+from CMS_Deep_Learning.storage.ragged import RaggedArray
+
+#The default budget of the process wide cache, 0 disables it
+DEFAULT_CACHE_MEGABYTES = 1000
+
+
+def _freeze(a):
+    '''Helper Function - makes an array or RaggedArray read only in place'''
+    if(isinstance(a, RaggedArray)):
+        _freeze(a.values)
+        _freeze(a.offsets)
+    else:
+        a.flags.writeable = False
+
+def _freezeData(data):
+    '''Helper Function - makes the arrays (or RaggedArrays) of an (X, Y) read only in place'''
+    for d in data:
+        for a in (d if isinstance(d, (list, tuple)) else [d]):
+            _freeze(a)
+
+
+class DataCache(object):
+    '''A thread safe least recently used cache of (X, Y) with a budget of megabytes'''
+    def __init__(self, megabytes=DEFAULT_CACHE_MEGABYTES):
+        self.max_bytes = megabytes * 1000.0 * 1000.0
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''Returns the (X, Y) cached under key with read only arrays, or None if it is not cached'''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if(entry == None):
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+        X, Y = entry[0]
+        #New lists so that callers can change them without changing the cache
+        return (list(X) if isinstance(X, list) else X, list(Y) if isinstance(Y, list) else Y)
+
+    def put(self, key, data):
+        '''Caches an (X, Y) under key, a tuple of the hash, archive path and archive mtime of its DataProcedure
+            and then how it was read. The arrays of data are cached without copying them and are made read only,
+            so the caller can keep using them but not change them. Replaces the entry of key and removes the
+            entries of older versions of the archive. Returns whether it was cached, which it is not if it is bigger
+            than the whole budget.'''
+        nbytes = dataBytes(data)
+        if(nbytes > self.max_bytes):
+            return False
+        _freezeData(data)
+        data = tuple([list(d) if isinstance(d, (list, tuple)) else d for d in data])
+        with self._lock:
+            self._remove([k for k in self._entries if k == key or (k[:2] == key[:2] and k[2] != key[2])])
+            self._entries[key] = (data, nbytes)
+            self.nbytes += nbytes
+            self._shrink(self.max_bytes)
+        return True
+
+    def evict(self, hashcode=None):
+        '''Removes the entries of the DataProcedure with the given hash, or every entry if hashcode is None.
+            Returns how many entries were removed.'''
+        with self._lock:
+            keys = [k for k in self._entries if hashcode == None or k[0] == hashcode]
+            self._remove(keys)
+            self.evictions += len(keys)
+        return len(keys)
+
+    def resize(self, megabytes):
+        '''Changes the budget, evicting the least recently used entries until the cache fits in it'''
+        with self._lock:
+            self.max_bytes = megabytes * 1000.0 * 1000.0
+            self._shrink(self.max_bytes)
+
+    def stats(self):
+        '''Returns a dictionary of the hits, misses, evictions, entries, megabytes and max_megabytes of the cache'''
+        with self._lock:
+            return {"hits" : self.hits, "misses" : self.misses, "evictions" : self.evictions,
+                    "entries" : len(self._entries), "megabytes" : self.nbytes / (1000.0 * 1000.0),
+                    "max_megabytes" : self.max_bytes / (1000.0 * 1000.0)}
+
+    def _remove(self, keys):
+        '''Helper Function - removes entries. Call while holding _lock.'''
+        for k in keys:
+            self.nbytes -= self._entries.pop(k)[1]
+
+    def _shrink(self, max_bytes):
+        '''Helper Function - evicts the least recently used entries until the cache fits in max_bytes. Call while holding _lock.'''
+        while(self.nbytes > max_bytes and len(self._entries) > 0):
+            key, (data, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+
+#The cache that DataProcedure.getData uses
+_cache = DataCache()
+
+def getDataCache():
+    '''Returns the process wide DataCache that DataProcedure.getData uses'''
+    return _cache
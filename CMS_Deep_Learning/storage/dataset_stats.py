@@ -0,0 +1,101 @@
+'''
+dataset_stats.py
+Summary statistics of directories of pandas files: how many entries each file has, and for every object
+type how many rows there are and a histogram of how many objects each entry has. The statistics of each
+file are kept in the manifest of its directory (see manifest.py). They are written when the file is
+converted, or computed from its NumValues frame the first time they are needed, so sizing a dataset does
+not require opening every file.
+'''
+
+import os
+import numpy as np
+
+from CMS_Deep_Learning.storage.manifest import readManifest, updateManifest, pathSize
+
+
+def numValuesStats(num_val_frame):
+    '''Computes the statistics of a file from its NumValues frame
+        #Arguments
+            num_val_frame -- A DataFrame with one row per entry and a column for each object type with how
+                             many of that object the entry has
+        #Returns
+            A dictionary like {"entries" : #entries, "objects" : {object_type : {"rows" : #rows, "max" : max
+            objects per entry, "hist" : [#entries with 0 objects, #entries with 1 object, ...]}}}
+    '''
+    objects = {}
+    for key in num_val_frame.columns:
+        counts = num_val_frame[key].values.astype('int64')
+        hist = np.bincount(counts) if len(counts) > 0 else np.zeros((1,), dtype='int64')
+        objects[str(key)] = {"rows" : int(counts.sum()),
+                             "max" : int(counts.max()) if len(counts) > 0 else 0,
+                             "hist" : [int(x) for x in hist]}
+    return {"entries" : int(len(num_val_frame.index)), "objects" : objects}
+
+def mergeStats(stats_list):
+    '''Combines the statistics of several files into the statistics of all of them together'''
+    out = {"entries" : 0, "objects" : {}}
+    for stats in stats_list:
+        out["entries"] += stats["entries"]
+        for key, obj in stats["objects"].items():
+            merged = out["objects"].get(key, None)
+            if(merged == None):
+                out["objects"][key] = {"rows" : obj["rows"], "max" : obj["max"], "hist" : list(obj["hist"])}
+                continue
+            merged["rows"] += obj["rows"]
+            merged["max"] = max(merged["max"], obj["max"])
+            hist = merged["hist"] + [0] * (len(obj["hist"]) - len(merged["hist"]))
+            for i, n in enumerate(obj["hist"]):
+                hist[i] += n
+            merged["hist"] = hist
+    return out
+
+def multiplicityQuantile(object_stats, q):
+    '''Returns the smallest number of objects per entry that at least a fraction q of the entries do not exceed
+        #Arguments
+            object_stats -- The statistics of one object type, i.e. stats["objects"]["EFlowTrack"]
+            q -- A number between 0 and 1
+    '''
+    if(q < 0.0 or q > 1.0):
+        raise ValueError("Quantile must be between 0 and 1, but got %r" % q)
+    cumulative = np.cumsum(object_stats["hist"])
+    if(len(cumulative) == 0 or cumulative[-1] == 0):
+        return 0
+    return int(np.searchsorted(cumulative, q * cumulative[-1], side='left'))
+
+def _outputStat(path):
+    '''Helper Function - the size and mtime of an output file, used to tell if its statistics are current'''
+    return pathSize(path), os.stat(path).st_mtime
+
+def fileStatsRecord(path, num_val_frame):
+    '''Returns the manifest fields that hold the statistics of an output file'''
+    size, mtime = _outputStat(path)
+    return {"stats" : numValuesStats(num_val_frame), "stats_size" : size, "stats_mtime" : mtime}
+
+def directoryStats(directory, files, read_num_values, save=True):
+    '''Gets the statistics of every file in a directory, computing and storing those that are not in the
+        manifest or that are out of date
+        #Arguments
+            directory -- The directory containing the files
+            files -- The paths of the files
+            read_num_values -- A function that takes the path of a file and returns its NumValues DataFrame
+            save -- Whether or not to store newly computed statistics in the manifest
+        #Returns
+            A dictionary of the statistics of each file keyed by its path
+    '''
+    manifest = readManifest(directory)
+    out = {}
+    for f in files:
+        filename = os.path.basename(os.path.normpath(f))
+        record = manifest.get(filename, {})
+        size, mtime = _outputStat(f)
+        if("stats" in record and record.get("stats_size") == size and record.get("stats_mtime") == mtime):
+            out[f] = record["stats"]
+            continue
+        fields = fileStatsRecord(f, read_num_values(f))
+        if(save):
+            try:
+                updateManifest(directory, filename, **fields)
+            except (IOError, OSError):
+                pass
+        out[f] = fields["stats"]
+    return out
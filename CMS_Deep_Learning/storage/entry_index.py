@@ -0,0 +1,181 @@
+'''
+entry_index.py
+A persistent index of where the entries of a directory of pandas files are. For every file it keeps the
+number of entries and, for every object type, how many rows come before each entry (from the NumValues
+frames). A range of entries can then be mapped to files and row ranges with a binary search without opening
+any files. The index is stored in the directory as .entry_index.npz, and files are reindexed when their
+size or mtime changes.
+'''
+
+import os
+import numpy as np
+
+from CMS_Deep_Learning.storage.manifest import tempPath
+
+INDEX_NAME = ".entry_index.npz"
+
+#Indicies already loaded by this process keyed by directory
+_loaded = {}
+
+
+class EntryIndex(object):
+    '''The entry and row offsets of the files in a directory'''
+    def __init__(self, files, sizes, mtimes, keys, entry_offsets, row_offsets):
+        '''
+            #Arguments
+                #consider F = # of files, N = # of entries in all the files, K = # of object types
+                files -- The paths of the files in the order that their entries are numbered
+                sizes, mtimes -- The size and mtime of each file when it was indexed
+                keys -- The object types (columns of NumValues) that rows are counted for
+                entry_offsets -- A numpy array of shape (F+1,) with the number of entries before each file
+                row_offsets -- A numpy array of shape (N+F, K). For each file the number of rows of each object
+                                type before each of its entries, and then the total number of rows in the file.
+        '''
+        self.files = list(files)
+        self.sizes = list(sizes)
+        self.mtimes = list(mtimes)
+        self.keys = list(keys)
+        self.entry_offsets = np.asarray(entry_offsets, dtype='int64')
+        self.row_offsets = np.asarray(row_offsets, dtype='int64').reshape(-1, len(self.keys))
+
+    def numEntries(self):
+        '''The total number of entries in all of the files'''
+        return int(self.entry_offsets[-1])
+
+    def fileEntries(self, file_number):
+        '''The number of entries in a file'''
+        return int(self.entry_offsets[file_number+1] - self.entry_offsets[file_number])
+
+    def _fileRows(self, file_number):
+        '''Helper Function - the rows of row_offsets that belong to a file'''
+        start = self.entry_offsets[file_number] + file_number
+        stop = self.entry_offsets[file_number+1] + file_number + 1
+        return self.row_offsets[start:stop]
+
+    def numValues(self, file_number):
+        '''Returns a numpy array of shape (entries, K) with the number of rows of each object type in each entry of a file'''
+        return np.diff(self._fileRows(file_number), axis=0)
+
+    def locate(self, start, num):
+        '''Maps the entries in range(start, start+num), counting the files as one long list, to the files they are in
+            #Returns
+                A list of tuples like (file_number, file_start, num_entries). Covers less than num entries if
+                there are not enough entries after start.
+        '''
+        out = []
+        stop = min(start + num, self.numEntries())
+        file_number = max(int(np.searchsorted(self.entry_offsets, start, side='right')) - 1, 0)
+        while(start < stop):
+            file_stop = int(self.entry_offsets[file_number+1])
+            if(file_stop > start):
+                n = min(stop, file_stop) - start
+                out.append((file_number, start - int(self.entry_offsets[file_number]), n))
+                start += n
+            file_number += 1
+        return out
+
+    def rowRanges(self, file_number, file_start, num):
+        '''Returns a dictionary keyed by object type of the (select_start, select_stop) rows of a file that
+            belong to its entries in range(file_start, file_start+num)'''
+        rows = self._fileRows(file_number)
+        return {key: (int(rows[file_start, k]), int(rows[file_start+num, k])) for k, key in enumerate(self.keys)}
+
+
+def _readIndex(directory):
+    '''Helper Function - reads the index stored in a directory, or returns None if there isn't a readable one'''
+    path = os.path.join(directory, INDEX_NAME)
+    if(not os.path.isfile(path)):
+        return None
+    try:
+        npz = np.load(path)
+        files = [os.path.join(directory, str(f)) for f in npz["files"]]
+        index = EntryIndex(files, npz["sizes"].tolist(), npz["mtimes"].tolist(), [str(k) for k in npz["keys"]],
+                           npz["entry_offsets"], npz["row_offsets"])
+        npz.close()
+        return index
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+def _writeIndex(directory, index):
+    '''Helper Function - atomically writes an index to a directory. Does nothing if the directory is read only.'''
+    path = os.path.join(directory, INDEX_NAME)
+    tmp_path = tempPath(path)
+    try:
+        with open(tmp_path, "wb") as out:
+            np.savez(out,
+                     files=np.array([os.path.basename(f) for f in index.files]),
+                     sizes=np.array(index.sizes, dtype='int64'),
+                     mtimes=np.array(index.mtimes, dtype='float64'),
+                     keys=np.array(index.keys),
+                     entry_offsets=index.entry_offsets,
+                     row_offsets=index.row_offsets)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        if(os.path.exists(tmp_path)): os.remove(tmp_path)
+
+def _isCurrent(index, files, sizes, mtimes):
+    '''Helper Function - whether an index is of the given files, and none of them changed since they were indexed'''
+    return (index != None and [os.path.basename(f) for f in index.files] == [os.path.basename(f) for f in files]
+            and index.sizes == sizes and index.mtimes == mtimes)
+
+def loadEntryIndex(directory, files, read_num_values, save=True):
+    '''Gets the EntryIndex of a directory, only reading the NumValues of the files that are not indexed
+        or that changed since they were indexed
+        #Arguments
+            directory -- The directory containing the files
+            files -- The paths of the files to index. Their entries are numbered in sorted order.
+            read_num_values -- A function that takes the path of a file and returns its NumValues DataFrame
+            save -- Whether or not to store the index in the directory when it changes
+        #Returns
+            The EntryIndex of the files
+    '''
+    directory = os.path.abspath(directory)
+    files = sorted(files)
+    stats = [os.stat(f) for f in files]
+    sizes = [st.st_size for st in stats]
+    mtimes = [st.st_mtime for st in stats]
+
+    #Check the index loaded by this process, and then the one in the directory in case another process updated it
+    old = _loaded.get(directory, None)
+    if(not _isCurrent(old, files, sizes, mtimes)):
+        on_disk = _readIndex(directory)
+        if(on_disk != None): old = on_disk
+    if(_isCurrent(old, files, sizes, mtimes)):
+        old.files = files
+        _loaded[directory] = old
+        return old
+
+    #Reuse the NumValues of the files that have not changed
+    indexed = {}
+    if(old != None):
+        for i, f in enumerate(old.files):
+            indexed[os.path.basename(f)] = (old.sizes[i], old.mtimes[i], old.keys, old.numValues(i))
+    num_values = []
+    for f, size, mtime in zip(files, sizes, mtimes):
+        prev = indexed.get(os.path.basename(f), None)
+        if(prev != None and prev[0] == size and prev[1] == mtime):
+            num_values.append((prev[2], prev[3]))
+        else:
+            frame = read_num_values(f)
+            num_values.append((list(frame.columns), frame.values.astype('int64')))
+
+    keys = []
+    for file_keys, values in num_values:
+        keys += [k for k in file_keys if not k in keys]
+    entry_offsets = np.zeros(len(files) + 1, dtype='int64')
+    row_offsets = []
+    for i, (file_keys, values) in enumerate(num_values):
+        entry_offsets[i+1] = entry_offsets[i] + len(values)
+        #Object types that are not in a file have no rows in it
+        counts = np.zeros((len(values), len(keys)), dtype='int64')
+        for j, key in enumerate(file_keys):
+            counts[:, keys.index(key)] = values[:, j]
+        rows = np.zeros((len(values) + 1, len(keys)), dtype='int64')
+        np.cumsum(counts, axis=0, out=rows[1:])
+        row_offsets.append(rows)
+    row_offsets = np.concatenate(row_offsets) if len(row_offsets) > 0 else np.zeros((0, len(keys)), dtype='int64')
+
+    index = EntryIndex(files, sizes, mtimes, keys, entry_offsets, row_offsets)
+    if(save): _writeIndex(directory, index)
+    _loaded[directory] = index
+    return index
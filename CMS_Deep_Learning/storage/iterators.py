@@ -13,9 +13,9 @@ else:
 class DataIterator:
     def __init__(self, proc, num_samples=None, return_X=False, return_Y=True, accumilate=None, prediction_model=None):
         if (isinstance(proc, list)):
-            first_data = proc[0].getData()
+            first_data = proc[0].getData(cache=True)
         else:
-            first_data = proc.getData()
+            first_data = proc.getData(cache=True)
         if (isinstance(first_data, types.GeneratorType)):
             proc = first_data
 
@@ -45,7 +45,12 @@ class DataIterator:
             num_samples = 0
             for p in self.proc:
                 if (isinstance(p, DataProcedure)):
-                    X, Y = p.getData()
+                    #Archived DataProcedures know their length without reading their data
+                    n = p.num_samples()
+                    if (n != None):
+                        num_samples += n
+                        continue
+                    X, Y = p.getData(cache=True)
                 else:
                     X, Y = p
                 if (not isinstance(Y, list)): Y = [Y]
@@ -61,7 +66,7 @@ class DataIterator:
         acc_out = None
         pos = 0
         for p in self.proc:
-            X, Y = p.getData()
+            X, Y = p.getData(cache=True)
 
             if (not isinstance(Y, list)): Y = [Y]
             L = Y[0].shape[0]
@@ -0,0 +1,121 @@
+'''
+lazy.py
+Arrays backed by the datasets of an archive.h5 file that only read the samples that are indexed.
+Uncompressed contiguous datasets (the default layout of DataProcedure archives) are memory mapped, so
+processes reading the same archive share its pages in the OS cache. Other datasets are read through
+h5py one selection at a time. The files are kept open until closeFile() is called for them, which
+DataProcedure.archive and remove_from_archive do.
+'''
+
+import os
+import numpy as np
+import h5py
+
+#h5py files opened by this process keyed by path, with the pid and mtime they were opened with
+_open_files = {}
+
+
+def _openFile(path):
+    '''Helper Function - gets an open read only h5py File, reopening it if it changed or was opened by another process'''
+    mtime = os.stat(path).st_mtime
+    entry = _open_files.get(path, None)
+    if(entry != None and entry[0] == os.getpid()):
+        if(entry[1] == mtime):
+            return entry[2]
+        entry[2].close()
+    h5f = h5py.File(path, 'r')
+    _open_files[path] = (os.getpid(), mtime, h5f)
+    return h5f
+
+def closeFile(path):
+    '''Closes the h5py File that LazyArrays of the file at path read through, if this process has it open.
+        LazyArrays of the file that are read again reopen it.'''
+    entry = _open_files.pop(path, None)
+    if(entry != None and entry[0] == os.getpid()):
+        entry[2].close()
+
+def _mappableOffset(dataset):
+    '''Helper Function - the offset in its file of a dataset that can be memory mapped, or None if it can't be'''
+    if(dataset.chunks != None or dataset.dtype.kind not in "biuf" or dataset.size == 0):
+        return None
+    offset = dataset.id.get_offset()
+    return None if offset == None else int(offset)
+
+
+class LazyArray(object):
+    '''A read only array-like view of an h5py dataset. Indexing it with an int, slices or an array of indices
+        on the first axis reads only the selected part of the dataset and returns it as a numpy array.'''
+    def __init__(self, path, name, dtype=None):
+        '''
+            #Arguments
+                path -- The path of the h5 file
+                name -- The name of the dataset in the file (i.e. 'X/0')
+                dtype -- The dtype that selections are returned as, the dtype of the dataset if None
+        '''
+        self.path = path
+        self.name = name
+        dataset = _openFile(path)[name]
+        self.shape = dataset.shape
+        self.file_dtype = dataset.dtype
+        self.dtype = dataset.dtype if dtype == None else np.dtype(dtype)
+        self._offset = _mappableOffset(dataset)
+        self._memmap = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memmap'] = None
+        return state
+
+    def _source(self):
+        '''Helper Function - the memory map or h5py dataset to read from'''
+        if(self._offset == None):
+            return _openFile(self.path)[self.name]
+        if(self._memmap is None):
+            self._memmap = np.memmap(self.path, dtype=self.file_dtype, mode='r', offset=self._offset, shape=self.shape)
+        return self._memmap
+
+    def close(self):
+        '''Closes the memory map and the h5py File that the array reads through. Reading it again reopens them.'''
+        self._memmap = None
+        closeFile(self.path)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        '''The number of bytes that the whole array takes up once it is read'''
+        return self.size * self.dtype.itemsize
+
+    def __getitem__(self, key):
+        rest = ()
+        if(isinstance(key, tuple) and len(key) > 0 and not isinstance(key[0], (slice, int, np.integer))):
+            key, rest = key[0], key[1:]
+        source = self._source()
+        if(isinstance(key, (list, np.ndarray))):
+            key = np.asarray(key)
+            if(key.dtype == bool): key = np.flatnonzero(key)
+            key = np.where(key < 0, key + len(self), key)
+            #h5py only reads increasing lists of indices
+            unique, inverse = np.unique(key, return_inverse=True)
+            out = np.asarray(source[unique.tolist()] if len(unique) > 0 else source[0:0])[inverse]
+        else:
+            out = np.array(source[key])
+        if(len(rest) > 0):
+            out = out[(slice(None),) + rest]
+        return out.astype(self.dtype, copy=False)
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        return out if dtype == None else out.astype(dtype, copy=False)
+
+    def __repr__(self):
+        return "LazyArray(%r, %r, shape=%r, dtype=%r)" % (self.path, self.name, self.shape, str(self.dtype))
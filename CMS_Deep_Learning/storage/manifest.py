@@ -0,0 +1,147 @@
+'''
+manifest.py
+Keeps track of which source files have been converted into a directory of output files, so that
+conversions can be resumed without reopening the files that are already done. Each output directory
+has a manifest.json keyed by output filename.
+'''
+
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MANIFEST_NAME = "manifest.json"
+LOCK_NAME = ".manifest.lock"
+
+#Checksums computed by this process keyed by (path, size, mtime), so that a file is hashed at most once per version
+_checksums = {}
+
+
+def pathSize(path):
+    '''Returns the size of a file, or the total size of the files in a directory'''
+    if(os.path.isdir(path)):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, dirs, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def fileChecksum(filepath, blocksize=1 << 20):
+    '''Returns the sha1 hex digest of the contents of a file'''
+    h = hashlib.sha1()
+    with open(filepath, "rb") as f:
+        block = f.read(blocksize)
+        while(len(block) > 0):
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+def _sourceChecksum(source, st):
+    '''Helper Function - the checksum of a source file with the given os.stat, hashing it only if this process has
+        not already hashed that version of it'''
+    key = (os.path.abspath(source), st.st_size, st.st_mtime)
+    if(not key in _checksums):
+        _checksums[key] = fileChecksum(source)
+    return _checksums[key]
+
+@contextmanager
+def _manifestLock(directory):
+    '''Helper Function - holds an exclusive lock on the manifest of a directory, so that several processes
+        can update it at once. Does nothing on platforms without fcntl.'''
+    if(fcntl == None):
+        yield
+        return
+    with open(os.path.join(directory, LOCK_NAME), "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def readManifest(directory):
+    '''Returns the manifest of a directory, a dictionary keyed by output filename of the records written by
+        recordConversion(), or an empty dictionary if there is no manifest.'''
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME), "r") as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def _writeManifest(directory, manifest):
+    '''Helper Function - atomically replaces the manifest of a directory'''
+    path = os.path.join(directory, MANIFEST_NAME)
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, sort_keys=True, indent=4)
+    os.rename(tmp_path, path)
+
+def updateManifest(directory, filename, **fields):
+    '''Sets fields of the manifest record of an output file, creating the record if it does not exist
+        #Arguments
+            directory -- The directory containing the output file and the manifest
+            filename -- The name of the output file (not its full path)
+            fields -- The fields to set in the file's record
+        #Returns
+            The updated record
+    '''
+    with _manifestLock(directory):
+        manifest = readManifest(directory)
+        record = manifest.get(filename, {})
+        record.update(fields)
+        manifest[filename] = record
+        _writeManifest(directory, manifest)
+    return record
+
+def recordConversion(directory, filename, source, entries, start=0, stop=None, **fields):
+    '''Records that an output file was completely written from a source file
+        #Arguments
+            directory -- The directory containing the output file and the manifest
+            filename -- The name of the output file (not its full path)
+            source -- The path to the source file that was converted
+            entries -- The number of entries (samples) in the output file
+            start, stop -- The range of entries of the source file that were converted
+            fields -- Any other fields to record (i.e. the statistics from dataset_stats.fileStatsRecord)
+        #Returns
+            The record written to the manifest
+    '''
+    st = os.stat(source)
+    return updateManifest(directory, filename,
+                          source=os.path.abspath(source),
+                          source_size=st.st_size,
+                          source_mtime=st.st_mtime,
+                          checksum=_sourceChecksum(source, st),
+                          entries=int(entries),
+                          start=start,
+                          stop=stop,
+                          output_size=pathSize(os.path.join(directory, filename)),
+                          converted=time.time(),
+                          **fields)
+
+def isConverted(directory, filename, source):
+    '''Returns the manifest record of an output file if it was completely written from the current version of
+        the source file, otherwise None. Unchanged files are recognized by their size and mtime without reading
+        them. Only if the size is the same and the mtime changed is the file hashed and the checksum compared,
+        and the record is updated if the contents are the same.'''
+    record = readManifest(directory).get(filename, None)
+    if(record == None):
+        return None
+    out_path = os.path.join(directory, filename)
+    if(not os.path.exists(out_path) or pathSize(out_path) != record.get("output_size")):
+        return None
+    st = os.stat(source)
+    if(st.st_size != record.get("source_size")):
+        return None
+    if(st.st_mtime != record.get("source_mtime")):
+        if(_sourceChecksum(source, st) != record.get("checksum")):
+            return None
+        record = updateManifest(directory, filename, source_mtime=st.st_mtime)
+    return record
+
+def tempPath(path):
+    '''Returns a path to write a file to before moving it to path with os.rename(). It is in the same
+        directory so that the rename is atomic, and unique to this process.'''
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, ".%s.%d.tmp" % (filename, os.getpid()))
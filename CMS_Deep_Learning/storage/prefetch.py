@@ -0,0 +1,141 @@
+'''
+prefetch.py
+Loads the data of a list of DataProcedures ahead of time. Loader threads call getData() on the
+DataProcedures that come next, cycling through the list, and keep up to a fixed number of them (and
+optionally a fixed number of megabytes) loaded before they are used. The data comes out in the same
+order as calling getData() on each DataProcedure in turn, and errors raised while loading are raised
+again when their data is asked for. HDF5 reads release the GIL, so threads are enough to keep the
+trainer from waiting on reads.
+'''
+
+import sys
+import threading
+
+
+def dataBytes(data):
+    '''Returns how many bytes the arrays (or RaggedArrays) of the (X, Y) returned by getData() take up'''
+    total = 0
+    for d in data:
+        for a in (d if isinstance(d, (list, tuple)) else [d]):
+            total += getattr(a, "nbytes", 0)
+    return total
+
+
+class DataPrefetcher(object):
+    '''An iterator over the (X, Y) of a list of DataProcedures that loads them in the background'''
+    def __init__(self, dps, prefetch=2, num_loaders=1, megabytes=None, cycle=True, **kwargs):
+        '''
+            #Arguments
+                dps -- The DataProcedures to load, in order
+                prefetch -- The most DataProcedures that are loaded or loading ahead of the one in use
+                num_loaders -- How many threads load DataProcedures. At most prefetch of them are busy at once.
+                megabytes -- If not None the loaders wait while the data loaded ahead, and the data that the
+                            DataProcedures being loaded are expected to take up, is this many megabytes or more.
+                            The expected size is the average of those loaded so far, so the bound is approximate.
+                            One DataProcedure is always loaded ahead regardless.
+                cycle -- If True start again from the first DataProcedure after the last, otherwise stop
+                **kwargs -- Passed to getData()
+        '''
+        if(len(dps) == 0):
+            raise ValueError("Cannot prefetch from an empty list of DataProcedures")
+        if(prefetch < 1 or num_loaders < 1):
+            raise ValueError("prefetch and num_loaders must be at least 1, but got %r, %r" % (prefetch, num_loaders))
+        self.dps = list(dps)
+        self.prefetch = prefetch
+        self.max_bytes = None if megabytes == None else megabytes * 1000.0 * 1000.0
+        self.cycle = cycle
+        self.kwargs = kwargs
+
+        self._cond = threading.Condition()
+        self._next_load = 0
+        self._next_out = 0
+        self._ready = {}
+        self._ready_bytes = 0
+        self._loading = 0
+        self._loaded_bytes = 0
+        self._num_loaded = 0
+        self._closed = False
+        self._loaders = []
+        for i in range(num_loaders):
+            loader = threading.Thread(target=self._load, name="DataPrefetcher-%r" % i)
+            loader.daemon = True
+            loader.start()
+            self._loaders.append(loader)
+
+    def _end(self):
+        '''Helper Function - the number of loads in one pass, or None if cycling forever'''
+        return None if self.cycle else len(self.dps)
+
+    def _canLoad(self):
+        '''Helper Function - whether a loader may start on the next DataProcedure. Call while holding _cond.'''
+        ahead = self._next_load - self._next_out
+        if(self._end() != None and self._next_load >= self._end()):
+            return False
+        if(ahead >= self.prefetch):
+            return False
+        if(self.max_bytes != None and ahead > 0):
+            #Until a DataProcedure has been loaded its size is unknown, so only load one at a time
+            if(self._num_loaded == 0):
+                return self._loading == 0
+            estimate = self._loaded_bytes / float(self._num_loaded)
+            if(self._ready_bytes + (self._loading + 1) * estimate > self.max_bytes):
+                return False
+        return True
+
+    def _load(self):
+        '''Helper Function - the loop that each loader thread runs'''
+        while True:
+            with self._cond:
+                while(not self._closed and not self._canLoad()):
+                    self._cond.wait()
+                if(self._closed):
+                    return
+                seq = self._next_load
+                self._next_load += 1
+                self._loading += 1
+            try:
+                data = self.dps[seq % len(self.dps)].getData(**self.kwargs)
+                result = (data, dataBytes(data), None)
+            except Exception:
+                result = (None, 0, sys.exc_info()[1])
+            with self._cond:
+                if(self._closed):
+                    return
+                self._loading -= 1
+                if(result[2] == None):
+                    self._loaded_bytes += result[1]
+                    self._num_loaded += 1
+                self._ready[seq] = result
+                self._ready_bytes += result[1]
+                self._cond.notify_all()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._cond:
+            if(self._closed or (self._end() != None and self._next_out >= self._end())):
+                raise StopIteration()
+            #Wait with a timeout so that KeyboardInterrupt is not blocked in python 2
+            while(not self._next_out in self._ready):
+                self._cond.wait(1.0)
+                if(self._closed):
+                    raise StopIteration()
+            data, nbytes, error = self._ready.pop(self._next_out)
+            self._next_out += 1
+            self._ready_bytes -= nbytes
+            self._cond.notify_all()
+        if(error != None):
+            self.close()
+            raise error
+        return data
+
+    next = __next__
+
+    def close(self):
+        '''Stops the loaders and frees the data loaded ahead. Loaders in the middle of getData() stop when it returns.'''
+        with self._cond:
+            self._closed = True
+            self._ready = {}
+            self._ready_bytes = 0
+            self._cond.notify_all()
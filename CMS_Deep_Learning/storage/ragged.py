@@ -0,0 +1,96 @@
+'''
+ragged.py
+A compact representation of zero padded preprocessed data. Each sample of an array of shape
+(samples, max_length, vecsize) is a list of at most max_length vectors followed by zero padding. A
+RaggedArray keeps only the vectors before the padding, as one array of values and the offsets of each
+sample, and can pad them again to any length.
+'''
+
+import numpy as np
+
+
+class RaggedArray(object):
+    '''A list of variable length sequences of vectors'''
+    def __init__(self, values, offsets, max_length=None):
+        '''
+            #Arguments
+                #consider N = # of samples, R = # of vectors in all samples
+                values -- A numpy array of shape (R, vecsize) with the vectors of every sample one after the other
+                offsets -- A numpy array of shape (N+1,) where sample i is values[offsets[i]:offsets[i+1]]
+                max_length -- The length that the samples are padded to by default, at least the longest sample
+        '''
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype='int64')
+        lengths = self.lengths()
+        longest = int(lengths.max()) if len(lengths) > 0 else 0
+        self.max_length = longest if max_length == None else int(max_length)
+        if(self.max_length < longest):
+            raise ValueError("max_length %r is less than the longest sample %r" % (self.max_length, longest))
+
+    @classmethod
+    def fromPadded(cls, X):
+        '''Makes a RaggedArray from a numpy array of shape (N, max_length, vecsize), dropping the rows of zeros at the
+            end of each sample. toPadded() gives back X exactly.'''
+        X = np.asarray(X)
+        nonzero = np.any(X != 0, axis=2)
+        #The length of each sample is one more than the position of its last nonzero row
+        last = X.shape[1] - np.argmax(nonzero[:, ::-1], axis=1)
+        lengths = np.where(nonzero.any(axis=1), last, 0)
+        keep = np.arange(X.shape[1])[None, :] < lengths[:, None]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        return cls(X[keep], offsets, X.shape[1])
+
+    def lengths(self):
+        '''The number of vectors in each sample'''
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def vecsize(self):
+        return self.values.shape[-1]
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.offsets.nbytes
+
+    def __getitem__(self, key):
+        '''Gets the samples in a slice (with step 1) as a RaggedArray'''
+        if(not isinstance(key, slice) or key.step not in (None, 1)):
+            raise TypeError("RaggedArray only supports slices with step 1, use take() for other selections")
+        start, stop, step = key.indices(len(self))
+        stop = max(start, stop)
+        values = self.values[self.offsets[start]:self.offsets[stop]]
+        return RaggedArray(values, self.offsets[start:stop+1] - self.offsets[start], self.max_length)
+
+    def take(self, indices):
+        '''Gets the samples at the given indices as a RaggedArray'''
+        indices = np.asarray(indices, dtype='int64')
+        lengths = self.lengths()[indices]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype('int64')
+        #The position in values of every vector of the selected samples
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return RaggedArray(self.values[rows], offsets, self.max_length)
+
+    def toPadded(self, length=None, dtype=None):
+        '''Pads every sample with zeros
+            #Arguments
+                length -- The length to pad to, max_length if None. Must be at least the longest sample.
+                dtype -- The dtype of the output, the dtype of the values if None
+            #Returns
+                A numpy array of shape (N, length, vecsize)
+        '''
+        if(length == None): length = self.max_length
+        lengths = self.lengths()
+        if(len(lengths) > 0 and lengths.max() > length):
+            raise ValueError("Cannot pad samples of length %r to length %r" % (int(lengths.max()), length))
+        X = np.zeros((len(self), length, self.vecsize), dtype=self.dtype if dtype == None else dtype)
+        samples = np.repeat(np.arange(len(self)), lengths)
+        positions = np.arange(len(self.values)) - np.repeat(self.offsets[:-1], lengths)
+        X[samples, positions] = np.asarray(self.values)
+        return X
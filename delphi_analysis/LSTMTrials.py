@@ -31,15 +31,17 @@ DEFAULT_LABEL_DIR_PAIRS = \
 
             ]
 def genModel(name,object_profiles,out_dim, depth, vecsize
-            ,lstm_activation="relu", lstm_dropout = 0.0, dropout=0.0,output_activation="softmax", single_list=False):
+            ,lstm_activation="relu", lstm_dropout = 0.0, dropout=0.0,output_activation="softmax", single_list=False,
+            variable_length=False):
+    #With variable_length the inputs accept any number of objects, for batches from genFromDPs(bucket_by_length=True)
     inputs = []
     if(single_list):
-        a = Input(shape=(sum([p.max_size for p in object_profiles]) , vecsize), name="input")
+        a = Input(shape=(None if variable_length else sum([p.max_size for p in object_profiles]) , vecsize), name="input")
         inputs.append(a)
     else:
         mergelist = []
         for i, profile in enumerate(object_profiles):
-            inp = a = Input(shape=(profile.max_size , vecsize), name="input_" + str(i))
+            inp = a = Input(shape=(None if variable_length else profile.max_size , vecsize), name="input_" + str(i))
             inputs.append(inp)
             mergelist.append(a)
         a = merge(mergelist, mode='concat', concat_axis=1, name="merge")
@@ -0,0 +1,15 @@
+import sys
+
+repo_outerdir = sys.argv[1]+"../"
+if(not repo_outerdir in sys.path):
+    sys.path.append(repo_outerdir)
+
+from CMS_Deep_Learning.storage.catalog import rebuildCatalog
+
+
+def main(archive_dir):
+    rebuildCatalog(archive_dir, verbose=1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[2])
@@ -0,0 +1,38 @@
+import threading
+import time
+import numpy as np
+import pandas as pd
+
+
+#Functions for DataProcedures, which must be importable
+def numberedData(i, size, fail=False):
+    if(fail): raise ValueError("Failed to load %r" % i)
+    return [np.full((size, 3, 2), i, dtype='float64')], [np.full((size, 2), i, dtype='float64')]
+
+#How many slowData() calls are running at once, and the most there have been
+loading = {"now" : 0, "max" : 0}
+loading_lock = threading.Lock()
+
+def slowData(i, size, delay):
+    with loading_lock:
+        loading["now"] += 1
+        loading["max"] = max(loading["max"], loading["now"])
+    time.sleep(delay)
+    with loading_lock:
+        loading["now"] -= 1
+    return numberedData(i, size)
+
+def paddedData(size):
+    X = np.zeros((size, 4, 2), dtype='float32')
+    for i in range(size):
+        X[i, :i % 5] = i + 1
+    return [X], [np.arange(size * 2, dtype='float64').reshape(size, 2)]
+
+def storeNumValues(path, counts):
+    '''Writes an h5 file with only a NumValues frame, with a column of counts for each object type'''
+    store = pd.HDFStore(path, mode='w')
+    store.put("NumValues", pd.DataFrame(counts), format='table')
+    store.close()
+
+def readNumValues(path):
+    return pd.read_hdf(path, "NumValues", mode="r")
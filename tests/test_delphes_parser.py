@@ -1,6 +1,8 @@
 import os
 import sys
 import unittest
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
 from numpy.testing import assert_almost_equal
@@ -9,7 +11,10 @@ if __package__ is None:
     sys.path.append(os.path.realpath("../"))
     sys.path.append(os.path.realpath("../../"))
 import CMS_Deep_Learning
-from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, ISO_TYPES, Iso
+from CMS_Deep_Learning.preprocessing import delphes_parser
+from CMS_Deep_Learning.storage import dataset_stats
+from CMS_Deep_Learning.preprocessing.delphes_parser import delphes_to_pandas, ISO_TYPES, Iso, trackMatch, \
+                                                            batchIso, batchTrackMatch
 
 def checkOmission(t,particles, tracks):
     for entry, part_df in particles:
@@ -39,6 +44,105 @@ class TestDelphesParser(unittest.TestCase):
 
         assert_almost_equal(Iso(A_Eta, A_Phi, A_PT, B_Eta, B_Phi),np.array([0.01]))
 
+    def test_batch(self):
+        rng = np.random.RandomState(7)
+        A_counts = rng.randint(0, 4, size=20)
+        B_counts = rng.randint(0, 6, size=20)
+        A_offsets = np.concatenate([[0], np.cumsum(A_counts)])
+        B_offsets = np.concatenate([[0], np.cumsum(B_counts)])
+        A_Eta, A_Phi = rng.uniform(-.5, .5, size=A_offsets[-1]), rng.uniform(-np.pi, np.pi, size=A_offsets[-1])
+        B_Eta, B_Phi = rng.uniform(-.5, .5, size=B_offsets[-1]), rng.uniform(-np.pi, np.pi, size=B_offsets[-1])
+        A_PT = rng.uniform(1.0, 10.0, size=A_offsets[-1])
+
+        #Use a small max_pairs so that the entries are split into several chunks
+        iso = batchIso(A_offsets, A_Eta, A_Phi, A_PT, B_offsets, B_Eta, B_Phi, max_pairs=10)
+        matches = batchTrackMatch(A_offsets, A_Eta, A_Phi, B_offsets, B_Eta, B_Phi, max_pairs=10)
+        for maxdist in [0.3, 2.5, 5.0]:
+            self.assertTrue((batchIso(A_offsets, A_Eta, A_Phi, A_PT, B_offsets, B_Eta, B_Phi, maxdist=maxdist) ==
+                             batchIso(A_offsets, A_Eta, A_Phi, A_PT, B_offsets, B_Eta, B_Phi, maxdist=maxdist,
+                                      use_grid=True)).all())
+        for entry in range(20):
+            a, b = slice(A_offsets[entry], A_offsets[entry+1]), slice(B_offsets[entry], B_offsets[entry+1])
+            if(A_counts[entry] == 0): continue
+            assert_almost_equal(iso[a], Iso(A_Eta[a], A_Phi[a], A_PT[a], B_Eta[b], B_Phi[b]))
+            if(B_counts[entry] == 0):
+                self.assertTrue((matches[a] == -1).all())
+            else:
+                expected = B_offsets[entry] + trackMatch(A_Eta[a], A_Phi[a], B_Eta[b], B_Phi[b])
+                self.assertTrue((matches[a] == expected).all())
+
+    def test_retries(self):
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, "sample.root")
+        with open(source, "w") as f:
+            f.write("not really a ROOT file")
+        out_dir = os.path.join(directory, "pandas") + "/"
+        os.makedirs(out_dir)
+        attempts = []
+        failures = [1]
+        def flakyParse(filepath, start, stop, num_workers):
+            attempts.append(filepath)
+            if(len(attempts) <= failures[0]):
+                raise IOError("Failed to read %r" % filepath)
+            return {"NumValues" : pd.DataFrame({"Electron" : [1, 0, 2]}),
+                    "Electron" : pd.DataFrame({"Entry" : [0, 2, 2], "PT" : [1.0, 2.0, 3.0]})}
+        parse = delphes_parser._parseForStore
+        delphes_parser._parseForStore = flakyParse
+        try:
+            #The first attempt fails and the retry stores the file
+            self.assertEqual(delphes_parser.doJob((source, out_dir, "hdf5"), retries=1), 3)
+            self.assertEqual(len(attempts), 2)
+            self.assertTrue(os.path.exists(out_dir + "sample.h5"))
+
+            #Every attempt fails, so the file is skipped
+            del attempts[:]
+            failures[0] = 2
+            self.assertEqual(delphes_parser.doJob((source, out_dir, "hdf5"), redo=True, retries=1), 0)
+            self.assertEqual(len(attempts), 2)
+            self.assertEqual([f for f in os.listdir(out_dir) if f.endswith(".tmp")], [])
+        finally:
+            delphes_parser._parseForStore = parse
+            shutil.rmtree(directory)
+
+    def test_adopt(self):
+        directory = tempfile.mkdtemp()
+        source = os.path.join(directory, "sample.root")
+        with open(source, "w") as f:
+            f.write("not really a ROOT file")
+        out_dir = os.path.join(directory, "pandas") + "/"
+        os.makedirs(out_dir)
+        #An output written before there was a manifest
+        store = pd.HDFStore(out_dir + "sample.h5", mode='w')
+        store.put("NumValues", pd.DataFrame({"Electron" : [1, 0, 2, 1]}), format='table')
+        store.put("Electron", pd.DataFrame({"Entry" : [0, 2, 2, 3], "PT" : [1.0, 2.0, 3.0, 4.0]}), format='table')
+        store.close()
+        attempts = []
+        def countedParse(filepath, start, stop, num_workers):
+            attempts.append(filepath)
+            raise IOError("Failed to read %r" % filepath)
+        parse = delphes_parser._parseForStore
+        delphes_parser._parseForStore = countedParse
+        try:
+            self.assertEqual(delphes_parser.store(source, out_dir), 4)
+            self.assertEqual(attempts, [])
+            record = delphes_parser.readManifest(out_dir)["sample.h5"]
+            self.assertEqual(record["entries"], 4)
+            self.assertEqual(record["stats"]["objects"]["Electron"]["rows"], 4)
+            self.assertEqual(delphes_parser.store(source, out_dir), 4)
+            self.assertEqual(attempts, [])
+
+            #Outputs whose manifest records only have statistics are adopted too
+            os.remove(out_dir + "manifest.json")
+            dataset_stats.directoryStats(out_dir, [out_dir + "sample.h5"],
+                                         lambda f: delphes_parser.getNumValFrame(f, "hdf5"))
+            self.assertFalse("source" in delphes_parser.readManifest(out_dir)["sample.h5"])
+            self.assertEqual(delphes_parser.store(source, out_dir), 4)
+            self.assertEqual(attempts, [])
+            self.assertEqual(delphes_parser.readManifest(out_dir)["sample.h5"]["source"], os.path.abspath(source))
+        finally:
+            delphes_parser._parseForStore = parse
+            shutil.rmtree(directory)
+
     def test_sanity(self):
         p = os.path.dirname(os.path.abspath(CMS_Deep_Learning.__file__))
         loc = p + "/../data/qcd_lepFilter_13TeV_2.root"
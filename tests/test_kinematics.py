@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+import pandas as pd
+import numpy as np
+from numpy.testing import assert_almost_equal
+
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+    sys.path.append(os.path.realpath("../../"))
+from CMS_Deep_Learning.preprocessing.kinematics import fourMomentum, PtEtaPhiM, invariantMass, addFourMomentumColumns
+
+mass_of_muon = 0.1056583715
+
+class TestKinematics(unittest.TestCase):
+    def test_fourMomentum(self):
+        PT = np.array([10.0, 25.0, 3.0])
+        Eta = np.array([0.0, 1.5, -2.0])
+        Phi = np.array([0.0, np.pi/2, -np.pi/4])
+        E, Px, Py, Pz = fourMomentum(PT, Eta, Phi, mass_of_muon)
+
+        assert_almost_equal(Px, PT*np.cos(Phi))
+        assert_almost_equal(Py, PT*np.sin(Phi))
+        assert_almost_equal(Pz, PT*np.sinh(Eta))
+        assert_almost_equal(E, np.sqrt((PT*np.cosh(Eta))**2 + mass_of_muon**2))
+
+        #Massless objects have E = |P|
+        E, Px, Py, Pz = fourMomentum(PT, Eta, Phi, 0)
+        assert_almost_equal(E, PT*np.cosh(Eta))
+
+    def test_roundtrip(self):
+        PT = np.array([10.0, 25.0, 3.0])
+        Eta = np.array([0.0, 1.5, -2.0])
+        Phi = np.array([0.0, np.pi/2, -np.pi/4])
+        M = np.array([mass_of_muon, 0.0, 5.0])
+        pt, eta, phi, m = PtEtaPhiM(*fourMomentum(PT, Eta, Phi, M))
+        assert_almost_equal(pt, PT)
+        assert_almost_equal(eta, Eta)
+        assert_almost_equal(phi, Phi)
+        assert_almost_equal(m, M, decimal=5)
+        assert_almost_equal(invariantMass(1.0, 0.0, 0.0, 2.0), -np.sqrt(3.0))
+
+    def test_addFourMomentumColumns(self):
+        df = pd.DataFrame({"PT_ET": [1.0, 2.0], "Eta": [0.5, -0.5], "Phi": [0.1, 3.0]})
+        df = addFourMomentumColumns(df, 0.0)
+        E, Px, Py, Pz = fourMomentum(df["PT_ET"].values, df["Eta"].values, df["Phi"].values, 0.0)
+        assert_almost_equal(df["E/c"].values, E)
+        assert_almost_equal(df["Pz"].values, Pz)
+
+        #The mass can be read from a column, whose name may be unicode
+        df["M"] = [mass_of_muon, 1.0]
+        df = addFourMomentumColumns(df, u"M")
+        E, Px, Py, Pz = fourMomentum(df["PT_ET"].values, df["Eta"].values, df["Phi"].values, df["M"].values)
+        assert_almost_equal(df["E/c"].values, E)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,7 +8,14 @@ else:
 import tempfile
 import numpy as np
 import pandas as pd
-from CMS_Deep_Learning.preprocessing.preprocessing import ObjectProfile, preprocessFromPandas_label_dir_pairs,procsFrom_label_dir_pairs
+from CMS_Deep_Learning.preprocessing.preprocessing import ObjectProfile, preprocessFromPandas_label_dir_pairs,procsFrom_label_dir_pairs, strideFromTargetSize, \
+                                                        resolveProfileMaxes, maxMutualLength, truncationReport, genFromDPs
+from CMS_Deep_Learning.preprocessing import preprocessing
+from CMS_Deep_Learning.storage import columnar
+from CMS_Deep_Learning.storage.ragged import RaggedArray
+from CMS_Deep_Learning.storage.archiving import DataProcedure
+from CMS_Deep_Learning.storage.data_cache import getDataCache
+from storage_helpers import numberedData, paddedData
 gen_observ_types = ['PT_ET','Eta', 'Phi']
 observ_types = gen_observ_types + ["ObjType"]
 
@@ -296,8 +303,258 @@ class PreprocessingTests(unittest.TestCase):
         x_check, y_check = np.array([x[0][0] for x in X]), np.array([y.tolist().index(1.0) for y in Y])
         self.assertTrue(np.array_equal(x_check, y_check))
 
-if __name__ == '__main__':
-    unittest.main()
+    def test_vectorized(self):
+        NUM = 20
+        pairs = [(l, temp_dir + "vec_" + l + "/") for l in ["ttbar", "wjet"]]
+        for i, (l, d) in enumerate(pairs):
+            store_fake(d, NUM, 2, object_profiles1)
+        queried = [ObjectProfile("EFlowPhoton", 3, pre_sort_columns=["Phi", "PT_ET"], pre_sort_ascending=[True, False],
+                                 query="Eta > -0.5 and PT_ET < 1.0", addColumns={"ObjType": 1}),
+                   ObjectProfile("EFlowTracks", 2, query="Phi > 0", sort_columns=["Eta", "PT_ET"], sort_ascending=False,
+                                 addColumns={"ObjType": 2})]
+        for object_profiles in [object_profiles1, queried]:
+            for single_list in [False, True]:
+                out = []
+                for vectorized in [False, True]:
+                    np.random.seed(RANDOM_SEED)
+                    out.append(preprocessFromPandas_label_dir_pairs(pairs, 13, 20, object_profiles, observ_types,
+                                                                    single_list=single_list, sort_columns=["Phi"],
+                                                                    sort_ascending=False, verbose=0, vectorized=vectorized))
+                (X_ref, Y_ref), (X_vec, Y_vec) = out
+                self.assertTrue(np.array_equal(Y_ref, Y_vec))
+                if(single_list): X_ref, X_vec = [X_ref], [X_vec]
+                for x_ref, x_vec in zip(X_ref, X_vec):
+                    self.assertEqual(x_ref.shape, x_vec.shape)
+                    self.assertTrue(np.array_equal(x_ref, x_vec))
+
+    def test_vectorized_ties(self):
+        #Entries longer than 16 rows with many ties, which the unstable sorts of the per-entry path reorder
+        rng = np.random.RandomState(3)
+        num, rows = 4, 30
+        frame = pd.DataFrame({"Entry" : np.repeat(np.arange(num), rows),
+                              "PT_ET" : rng.randint(0, 3, size=num * rows).astype('float64'),
+                              "Eta" : rng.uniform(-1.0, 1.0, size=num * rows),
+                              "Phi" : rng.uniform(-np.pi, np.pi, size=num * rows)})
+        profiles = [ObjectProfile("A", 10, pre_sort_columns="PT_ET", pre_sort_ascending=False, addColumns={"ObjType" : 1}),
+                    ObjectProfile("B", 25, pre_sort_columns=["PT_ET"], sort_columns=["PT_ET"], sort_ascending=False,
+                                  addColumns={"ObjType" : 2}),
+                    ObjectProfile("C", 40, sort_columns=["PT_ET"], addColumns={"ObjType" : 3})]
+        for profile in profiles:
+            x_ref = np.array([preprocessing._padAndSort(preprocessing._applyCuts(frame[frame["Entry"] == e].copy(), profile,
+                                                                                 len(observ_types), observ_types),
+                                                        profile, len(observ_types)) for e in range(num)])
+            x_vec = np.zeros((num, profile.max_size, len(observ_types)))
+            segments, values = preprocessing._cutProfile(frame, profile, observ_types, 0, num)
+            sort_locs = None if profile.sort_columns == None else [observ_types.index(c) for c in profile.sort_columns]
+            preprocessing._sortAndScatter(x_vec, np.arange(num), 0, segments, values, sort_locs, profile.sort_ascending)
+            self.assertTrue(np.array_equal(x_ref, x_vec))
+
+    def test_dtype(self):
+        NUM = 20
+        pairs = [(l, temp_dir + "vec_" + l + "/") for l in ["ttbar", "wjet"]]
+        for i, (l, d) in enumerate(pairs):
+            store_fake(d, NUM, 2, object_profiles1)
+        for single_list in [False, True]:
+            out = []
+            for dtype in ['float64', 'float32']:
+                np.random.seed(RANDOM_SEED)
+                out.append(preprocessFromPandas_label_dir_pairs(pairs, 0, 20, object_profiles1, observ_types,
+                                                                single_list=single_list, sort_columns=["Phi"],
+                                                                verbose=0, dtype=dtype))
+            (X_64, Y_64), (X_32, Y_32) = out
+            self.assertEqual(Y_32.dtype, np.float32)
+            self.assertTrue(np.array_equal(Y_64.astype('float32'), Y_32))
+            if(single_list): X_64, X_32 = [X_64], [X_32]
+            for x_64, x_32 in zip(X_64, X_32):
+                self.assertEqual(x_32.dtype, np.float32)
+                self.assertTrue(np.array_equal(x_64.astype('float32'), x_32))
+
+        profiles = [ObjectProfile("EFlowPhoton", 2, addColumns={"ObjType": 1}),
+                    ObjectProfile("MET", 1, addColumns={"ObjType": 4}, dtype='float16')]
+        X, Y = preprocessFromPandas_label_dir_pairs(pairs, 0, 5, profiles, observ_types, verbose=0, dtype='float32')
+        self.assertEqual([x.dtype for x in X], [np.float32, np.float16])
+
+        self.assertAlmostEqual(strideFromTargetSize(object_profiles1, 2, observ_types, megabytes=100, dtype='float32'),
+                               2 * strideFromTargetSize(object_profiles1, 2, observ_types, megabytes=100), delta=1)
+        #The default dtype should not change the hashes of DataProcedures
+        dps_default = procsFrom_label_dir_pairs(0, 10, 10, temp_dir, pairs, object_profiles1, observ_types, verbose=0)
+        dps_64 = procsFrom_label_dir_pairs(0, 10, 10, temp_dir, pairs, object_profiles1, observ_types, verbose=0, dtype='float64')
+        dps_32 = procsFrom_label_dir_pairs(0, 10, 10, temp_dir, pairs, object_profiles1, observ_types, verbose=0, dtype='float32')
+        self.assertEqual(dps_default[0].hash(), dps_64[0].hash())
+        self.assertNotEqual(dps_default[0].hash(), dps_32[0].hash())
+
+    def test_num_workers(self):
+        NUM = 20
+        pairs = [(l, temp_dir + "vec_" + l + "/") for l in ["ttbar", "wjet"]]
+        for i, (l, d) in enumerate(pairs):
+            store_fake(d, NUM, 2, object_profiles1)
+        chunk_entries = preprocessing.PREPROCESS_CHUNK_ENTRIES
+        preprocessing.PREPROCESS_CHUNK_ENTRIES = 3
+        try:
+            for single_list in [False, True]:
+                out = []
+                for num_workers in [1, 3]:
+                    np.random.seed(RANDOM_SEED)
+                    out.append(preprocessFromPandas_label_dir_pairs(pairs, 13, 20, object_profiles1, observ_types,
+                                                                    single_list=single_list, sort_columns=["Phi"],
+                                                                    verbose=0, num_workers=num_workers))
+                (X_1, Y_1), (X_3, Y_3) = out
+                self.assertTrue(np.array_equal(Y_1, Y_3))
+                if(single_list): X_1, X_3 = [X_1], [X_3]
+                for x_1, x_3 in zip(X_1, X_3):
+                    self.assertTrue(np.array_equal(x_1, x_3))
+        finally:
+            preprocessing.PREPROCESS_CHUNK_ENTRIES = chunk_entries
+        self.assertRaises(IOError, preprocessFromPandas_label_dir_pairs, pairs, 30, 20, object_profiles1, observ_types,
+                          verbose=0, num_workers=2)
+
+        dps_1 = procsFrom_label_dir_pairs(0, 10, 10, temp_dir, pairs, object_profiles1, observ_types, verbose=0)
+        dps_4 = procsFrom_label_dir_pairs(0, 10, 10, temp_dir, pairs, object_profiles1, observ_types, verbose=0, num_workers=4)
+        self.assertEqual(dps_1[0].hash(), dps_4[0].hash())
+
+    def test_dataset_stats(self):
+        pairs = [(l, temp_dir + "stats_" + l + "/") for l in ["ttbar", "wjet"]]
+        store_fake(pairs[0][1], 6, 2, object_profiles1)
+        store_fake(pairs[1][1], 4, 2, object_profiles1)
+        self.assertEqual(maxMutualLength(pairs, object_profiles1), 8)
+        profiles = [ObjectProfile("EFlowPhoton", -1), ObjectProfile("MET", -1)]
+        resolveProfileMaxes(profiles, pairs)
+        expected = max([preprocessing.getNumValFrame(d + "%03i.h5" % i, "hdf5")["EFlowPhoton"].max()
+                        for l, d in pairs for i in range(2)])
+        self.assertEqual(profiles[0].max_size, expected)
+        self.assertEqual(profiles[1].max_size, 1)
 
+    def test_quantile(self):
+        pairs = [(l, temp_dir + "stats_" + l + "/") for l in ["ttbar", "wjet"]]
+        for l, d in pairs:
+            store_fake(d, 30, 2, object_profiles1)
+        counts = np.concatenate([preprocessing.getNumValFrame(d + "%03i.h5" % i, "hdf5")["EFlowPhoton"].values
+                                 for l, d in pairs for i in range(2)])
+        for q in [.5, .9, 1.0]:
+            profiles = [ObjectProfile("EFlowPhoton", -1, quantile=q)]
+            resolveProfileMaxes(profiles, pairs)
+            max_size = profiles[0].max_size
+            self.assertTrue(np.mean(counts <= max_size) >= q)
+            self.assertTrue(max_size == 0 or np.mean(counts <= max_size - 1) < q)
 
+            report = truncationReport(profiles, pairs, verbose=0)["EFlowPhoton"]
+            self.assertEqual(report["events"], len(counts))
+            self.assertEqual(report["objects"], counts.sum())
+            self.assertEqual(report["truncated_events"], np.sum(counts > max_size))
+            self.assertEqual(report["truncated_objects"], np.maximum(counts - max_size, 0).sum())
+        self.assertEqual(profiles[0].max_size, counts.max())
+        self.assertRaises(ValueError, ObjectProfile, "EFlowPhoton", -1, quantile=1.5)
 
+    def test_ragged(self):
+        #Don't change the random numbers that the other tests generate their fake data with
+        state = np.random.get_state()
+        try:
+            self._checkRagged()
+        finally:
+            np.random.set_state(state)
+
+    def _checkRagged(self):
+        pairs = [(l, temp_dir + "vec_" + l + "/") for l in ["ttbar", "wjet"]]
+        for l, d in pairs:
+            store_fake(d, 20, 2, object_profiles1)
+        archive_dir = temp_dir + "ragged_archive/"
+        #Leave room for padding to see the difference in size
+        profiles = [ObjectProfile(p.name, 10, pre_sort_columns=p.pre_sort_columns, pre_sort_ascending=p.pre_sort_ascending,
+                                  addColumns=p.addColumns) for p in object_profiles1]
+        padded = procsFrom_label_dir_pairs(0, 30, 30, archive_dir, pairs, profiles, observ_types, verbose=0)[0]
+        ragged = procsFrom_label_dir_pairs(0, 30, 30, archive_dir + "r/", pairs, profiles, observ_types, verbose=0,
+                                           ragged=True)[0]
+        self.assertEqual(padded.hash(), ragged.hash())
+        for dp in [padded, ragged]:
+            dp.remove_from_archive()
+            np.random.seed(RANDOM_SEED)
+            dp.getData(verbose=0)
+        self.assertTrue(os.path.getsize(ragged.get_path() + "archive.h5") < os.path.getsize(padded.get_path() + "archive.h5"))
+        X_p, Y_p = padded.getData(verbose=0)
+        X_r, Y_r = ragged.getData(verbose=0)
+        for x_p, x_r in zip(X_p, X_r):
+            self.assertTrue(np.array_equal(x_p, x_r))
+
+        gen = genFromDPs([ragged], 7, verbose=0, pad_batches=True)
+        for start in range(0, 60, 7):
+            X_batch, Y_batch = next(gen)
+            self.assertTrue(np.array_equal(Y_batch[0], Y_p[0][start:start+7]))
+            for x_batch, x_p in zip(X_batch, X_p):
+                length = x_batch.shape[1]
+                self.assertTrue(np.array_equal(x_batch, x_p[start:start+7, :length]))
+                self.assertFalse(np.any(x_p[start:start+7, length:]))
+                self.assertTrue(length == 1 or np.any(x_batch[:, -1]))
+
+        #Every sample is generated once per epoch, in batches of samples with similar lengths padded to their longest sample
+        ragged_X = [RaggedArray.fromPadded(x) for x in X_p]
+        lengths = np.sum([x.lengths() for x in ragged_X], axis=0)
+        epoch_state = np.random.get_state()
+        gen = genFromDPs([padded], 7, verbose=0, bucket_by_length=True)
+        batches = [next(gen) for i in range(9)]
+        np.random.set_state(epoch_state)
+        expected = preprocessing._lengthBatches(ragged_X, 7)
+        self.assertEqual(sorted(np.concatenate(expected).tolist()), list(range(60)))
+        self.assertTrue(all(samples is other or lengths[samples].max() <= lengths[other].min() or lengths[samples].min() >= lengths[other].max()
+                            for samples in expected for other in expected))
+        for (X_batch, Y_batch), samples in zip(batches, expected):
+            self.assertTrue(np.array_equal(Y_batch[0], Y_p[0][samples]))
+            for x_batch, x_p, x_r in zip(X_batch, X_p, ragged_X):
+                self.assertEqual(x_batch.shape[1], max(x_r.lengths()[samples].max(), 1))
+                self.assertTrue(np.array_equal(x_batch, x_p[samples, :x_batch.shape[1]]))
+
+    def test_gen_prefetch(self):
+        dps = [DataProcedure(temp_dir, False, numberedData, i, 10) for i in range(5)]
+        gen = genFromDPs(dps, 4, threading=True, verbose=0, prefetch=2, num_loaders=2)
+        serial = genFromDPs(dps, 4, verbose=0)
+        for i in range(20):
+            (X, Y), (X_s, Y_s) = next(gen), next(serial)
+            self.assertTrue(np.array_equal(X[0], X_s[0]) and np.array_equal(Y[0], Y_s[0]))
+        gen.close()
+
+    def test_gen_cache(self):
+        dps = [DataProcedure(temp_dir + "cached_archive/", True, paddedData, n) for n in [12, 7]]
+        for dp in dps:
+            dp.getData(verbose=0)
+        misses = getDataCache().stats()["misses"]
+        gen = genFromDPs(dps, 4, verbose=0)
+        for i in range(15):
+            X, Y = next(gen)
+            self.assertRaises(ValueError, Y[0].fill, 0)
+        #Each archive is only read the first epoch
+        self.assertEqual(getDataCache().stats()["misses"], misses + 2)
+        for dp in dps:
+            getDataCache().evict(dp.hash())
+
+    def test_gen_lazy(self):
+        padded = DataProcedure(temp_dir + "lazy_archive/", True, paddedData, 23)
+        padded.getData(verbose=0)
+        (X,), (Y,) = paddedData(23)
+        gen = genFromDPs([padded], 5, verbose=0, lazy=True)
+        for start in range(0, 23, 5):
+            (X_batch,), (Y_batch,) = next(gen)
+            self.assertTrue(np.array_equal(X_batch, X[start:start+5]) and np.array_equal(Y_batch, Y[start:start+5]))
+
+    @unittest.skipIf(columnar.pa is None, "requires pyarrow")
+    def test_parquet(self):
+        NUM = 20
+        pairs_h5 = [(l, temp_dir + "h5_" + l + "/") for l in ["ttbar", "wjet"]]
+        pairs_pq = [(l, temp_dir + "parquet_" + l + "/") for l in ["ttbar", "wjet"]]
+        for (l, d_h5), (l, d_pq) in zip(pairs_h5, pairs_pq):
+            for d in [d_h5, d_pq]:
+                if not os.path.exists(d):
+                    os.makedirs(d)
+            for i in range(2):
+                frames = fake_frames(NUM, object_profiles1)
+                store_frames(frames, d_h5 + "%03i.h5" % i)
+                columnar.writeParquetFrames(d_pq + "%03i.parquet" % i, frames, row_group_entries=3)
+        out = []
+        for pairs in [pairs_h5, pairs_pq]:
+            np.random.seed(RANDOM_SEED)
+            out.append(preprocessFromPandas_label_dir_pairs(pairs, 7, 25, object_profiles1, observ_types, verbose=0))
+        (X_h5, Y_h5), (X_pq, Y_pq) = out
+        self.assertTrue(np.array_equal(Y_h5, Y_pq))
+        for x_h5, x_pq in zip(X_h5, X_pq):
+            self.assertTrue(np.array_equal(x_h5, x_pq))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,417 @@
+import unittest
+import sys, os
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+import json
+import shutil
+import sqlite3
+import tempfile
+import threading
+import numpy as np
+import pandas as pd
+import h5py
+from CMS_Deep_Learning.storage import catalog, columnar, dataset_stats, entry_index, lazy, manifest
+from CMS_Deep_Learning.storage.archiving import DataProcedure, archiveLayout, get_data_by_function, get_all_data
+from CMS_Deep_Learning.storage.data_cache import DataCache, getDataCache
+from CMS_Deep_Learning.storage.iterators import DataIterator
+from CMS_Deep_Learning.storage.lazy import LazyArray
+from CMS_Deep_Learning.storage.prefetch import DataPrefetcher
+from CMS_Deep_Learning.storage.ragged import RaggedArray
+from storage_helpers import numberedData, slowData, loading, paddedData, storeNumValues, readNumValues
+
+class StorageTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp() + "/"
+
+    def tearDown(self):
+        #Forget everything this process remembers about the files of the test
+        for path in list(lazy._open_files.keys()):
+            lazy.closeFile(path)
+        getDataCache().evict()
+        catalog._uncataloged.clear()
+        entry_index._loaded.clear()
+        shutil.rmtree(self.directory)
+
+    def test_ragged_array(self):
+        X = np.zeros((4, 3, 2))
+        X[0, :2] = [[1, 2], [3, 4]]
+        X[2, :3] = [[5, 0], [0, 0], [6, 7]]
+        X[3, :1] = [[8, 9]]
+        r = RaggedArray.fromPadded(X)
+        self.assertEqual(r.lengths().tolist(), [2, 0, 3, 1])
+        self.assertTrue(np.array_equal(r.toPadded(), X))
+        self.assertTrue(np.array_equal(r[1:3].toPadded(), X[1:3]))
+        self.assertTrue(np.array_equal(r.take([3, 0]).toPadded(2), X[[3, 0], :2]))
+        self.assertRaises(ValueError, r.toPadded, 2)
+
+        #Ragged archives leave out the padding and are read back as the same arrays
+        padded = DataProcedure(self.directory + "padded/", True, paddedData, 2000)
+        ragged = DataProcedure(self.directory + "ragged/", True, paddedData, 2000)
+        ragged.ragged_archive = True
+        self.assertEqual(padded.hash(), ragged.hash())
+        for dp in [padded, ragged]:
+            dp.getData(verbose=0)
+        self.assertTrue(os.path.getsize(ragged.get_path() + "archive.h5") < os.path.getsize(padded.get_path() + "archive.h5"))
+        (X,), (Y,) = paddedData(2000)
+        (X_r,), (Y_r,) = ragged.getData(verbose=0)
+        self.assertTrue(np.array_equal(X_r, X) and np.array_equal(Y_r, Y))
+        (X_r,), (Y_r,) = ragged.getData(verbose=0, ragged=True)
+        self.assertTrue(isinstance(X_r, RaggedArray) and np.array_equal(X_r.toPadded(), X))
+
+    def test_prefetch(self):
+        dps = [DataProcedure(self.directory, False, numberedData, i, 10) for i in range(5)]
+        for num_loaders in [1, 3]:
+            prefetcher = DataPrefetcher(dps, prefetch=2, num_loaders=num_loaders, verbose=0)
+            for i in range(12):
+                X, Y = next(prefetcher)
+                self.assertTrue(np.all(X[0] == i % 5) and np.all(Y[0] == i % 5))
+            prefetcher.close()
+        prefetcher = DataPrefetcher(dps, prefetch=3, cycle=False, megabytes=0.0001, verbose=0)
+        self.assertEqual([int(Y[0][0, 0]) for X, Y in prefetcher], list(range(5)))
+
+        #Errors are raised when their DataProcedure comes up
+        failing = dps[:2] + [DataProcedure(self.directory, False, numberedData, 2, 10, fail=True)]
+        prefetcher = DataPrefetcher(failing, prefetch=3, verbose=0)
+        next(prefetcher); next(prefetcher)
+        self.assertRaises(ValueError, next, prefetcher)
+        self.assertRaises(StopIteration, next, prefetcher)
+
+        #Closing the prefetcher stops a next() that is waiting for a load
+        slow = [DataProcedure(self.directory, False, slowData, i, 10, 1.0) for i in range(2)]
+        prefetcher = DataPrefetcher(slow, prefetch=1, verbose=0, archive=False)
+        closer = threading.Timer(0.1, prefetcher.close)
+        closer.start()
+        self.assertRaises(StopIteration, next, prefetcher)
+        closer.join()
+
+        #Loads in progress count towards megabytes, so only one of 3 loaders runs at once. The load that
+        #the closed prefetcher started may still be running.
+        running = loading["max"] = loading["now"]
+        slow = [DataProcedure(self.directory, False, slowData, i, 10, 0.05) for i in range(6)]
+        megabytes = 1.5 * sum(a.nbytes for d in numberedData(0, 10) for a in d) / 1e6
+        prefetcher = DataPrefetcher(slow, prefetch=3, num_loaders=3, cycle=False, megabytes=megabytes,
+                                    verbose=0, archive=False)
+        self.assertEqual([int(Y[0][0, 0]) for X, Y in prefetcher], list(range(6)))
+        self.assertEqual(loading["max"], running + 1)
+
+    def test_lazy(self):
+        (X,), (Y,) = paddedData(23)
+        path = self.directory + "arrays.h5"
+        h5f = h5py.File(path, "w")
+        h5f.create_dataset("contiguous", data=X)
+        h5f.create_dataset("chunked", data=X, chunks=(5, 4, 2), compression="gzip")
+        h5f.close()
+
+        #Contiguous datasets are memory mapped and the others are read through h5py
+        for name in ["contiguous", "chunked"]:
+            X_l = LazyArray(path, name)
+            self.assertEqual(X_l.shape, X.shape)
+            self.assertEqual(len(X_l), 23)
+            self.assertEqual(X_l._offset == None, name == "chunked")
+            samples = np.array([7, 2, 2, 22, 0])
+            for key in [slice(3, 9), 5, samples, (samples, slice(1, 3)), X[:, 0, 0] > 3]:
+                self.assertTrue(np.array_equal(X_l[key], X[key]))
+            self.assertEqual(LazyArray(path, name, dtype='float64')[:2].dtype, np.dtype('float64'))
+            self.assertTrue(np.array_equal(np.asarray(X_l), X))
+            X_l.close()
+            self.assertFalse(path in lazy._open_files)
+
+        padded = DataProcedure(self.directory, True, paddedData, 23)
+        ragged = DataProcedure(self.directory + "r/", True, paddedData, 23)
+        ragged.ragged_archive = True
+        for dp in [padded, ragged]:
+            dp.getData(verbose=0)
+        (X_l,), (Y_l,) = padded.getData(verbose=0, lazy=True)
+        self.assertTrue(isinstance(X_l, LazyArray) and np.array_equal(Y_l[samples], Y[samples]))
+        (X_r,), (Y_r,) = ragged.getData(verbose=0, lazy=True, ragged=True)
+        self.assertTrue(np.array_equal(X_r.take(samples).toPadded(), X[samples]))
+        self.assertTrue(np.array_equal(X_r[4:11].toPadded(), X[4:11]))
+        self.assertTrue(np.array_equal(ragged.getData(verbose=0, lazy=True)[0][0], X))
+
+        #The open archive is closed when it is removed or rewritten, and reopened when it is read again
+        path = padded.get_path() + 'archive.h5'
+        self.assertTrue(path in lazy._open_files)
+        padded.remove_from_archive()
+        self.assertFalse(path in lazy._open_files)
+        padded.getData(verbose=0)
+        (X_l,), (Y_l,) = padded.getData(verbose=0, lazy=True)
+        padded.archive(*paddedData(23))
+        self.assertFalse(path in lazy._open_files)
+        self.assertTrue(np.array_equal(X_l[3:9], X[3:9]))
+
+    def test_archive_layout(self):
+        (X,), (Y,) = paddedData(2000)
+        plain = DataProcedure(self.directory + "plain/", True, paddedData, 2000)
+        layouts = [archiveLayout(chunk_samples=50), archiveLayout(compression="gzip", level=4, shuffle=False)]
+        dps = []
+        for i, layout in enumerate(layouts):
+            dp = DataProcedure(self.directory + "%r/" % i, True, paddedData, 2000)
+            dp.archive_layout = layout
+            dps.append(dp)
+        dps[1].ragged_archive = True
+        self.assertEqual(len(set([dp.hash() for dp in [plain] + dps])), 1)
+        self.assertEqual(DataProcedure.from_json(self.directory, dps[1].to_json()).archive_layout, layouts[1])
+        self.assertRaises(ValueError, archiveLayout, compression="zip")
+
+        for dp in [plain] + dps:
+            dp.getData(verbose=0)
+        plain_size = os.path.getsize(plain.get_path() + "archive.h5")
+        for dp, layout in zip(dps, layouts):
+            self.assertTrue(os.path.getsize(dp.get_path() + "archive.h5") < plain_size / 2)
+            h5f = h5py.File(dp.get_path() + "archive.h5", "r")
+            self.assertEqual(json.loads(h5f.attrs["layout"]), layout)
+            h5f.close()
+            (X_a,), (Y_a,) = dp.getData(verbose=0)
+            self.assertTrue(np.array_equal(X_a, X) and np.array_equal(Y_a, Y))
+        h5f = h5py.File(dps[0].get_path() + "archive.h5", "r")
+        self.assertEqual(h5f["X/0"].chunks, (50, 4, 2))
+        self.assertEqual(h5f["X/0"].compression, "lzf")
+        self.assertTrue(h5f["X/0"].shuffle)
+        h5f.close()
+
+        samples = np.array([1999, 3, 0, 700])
+        (X_l,), (Y_l,) = dps[0].getData(verbose=0, lazy=True)
+        self.assertTrue(np.array_equal(X_l[samples], X[samples]) and np.array_equal(Y_l[10:60], Y[10:60]))
+        (X_r,), (Y_r,) = dps[1].getData(verbose=0, lazy=True, ragged=True)
+        self.assertTrue(np.array_equal(X_r.take(samples).toPadded(), X[samples]))
+
+    def test_data_cache(self):
+        cache = DataCache(megabytes=0.0013)
+        data = [([np.zeros(50)], [np.zeros(25)]) for i in range(3)]
+        for i, d in enumerate(data):
+            self.assertTrue(cache.put(("h%r" % i, "path", 0), d))
+        self.assertFalse(cache.put(("big", "path", 0), ([np.zeros(1000)], [np.zeros(1)])))
+        self.assertEqual(cache.get(("h0", "path", 0)), None)
+        #The arrays are kept without copying and made read only
+        cached = cache.get(("h1", "path", 0))
+        self.assertTrue(cached[0][0] is data[1][0][0] and cached[0] is not data[1][0])
+        self.assertRaises(ValueError, cached[0][0].fill, 1)
+        self.assertRaises(ValueError, data[1][0][0].fill, 1)
+        nbytes = cache.stats()["megabytes"]
+        self.assertTrue(cache.put(("h1", "path", 0), data[1]))
+        self.assertEqual(cache.stats()["megabytes"], nbytes)
+        self.assertTrue(cache.put(("h1", "path", 1), data[0]))
+        self.assertEqual(cache.get(("h1", "path", 0)), None)
+        self.assertEqual(cache.evict("h1"), 1)
+        self.assertEqual(cache.stats()["entries"], 1)
+
+        dp = DataProcedure(self.directory, True, paddedData, 11)
+        dp.getData(verbose=0)
+        stats = getDataCache().stats()
+        X, Y = dp.getData(verbose=0)
+        self.assertEqual(getDataCache().stats()["entries"], stats["entries"])
+        X, Y = dp.getData(verbose=0, cache=True)
+        self.assertRaises(ValueError, X[0].fill, 1)
+        X_c, Y_c = dp.getData(verbose=0, cache=True)
+        self.assertTrue(X_c[0] is X[0] and np.array_equal(X_c[0], paddedData(11)[0][0]))
+        self.assertEqual(getDataCache().stats()["hits"], stats["hits"] + 1)
+        self.assertFalse(dp.getData(verbose=0, dtype='float64', cache=True)[0][0] is X_c[0])
+        self.assertFalse(dp.getData(verbose=0)[0][0] is X_c[0])
+        dp.remove_from_archive()
+        dp.getData(verbose=0)
+        self.assertFalse(dp.getData(verbose=0, cache=True)[0][0] is X_c[0])
+
+        #DataIterator reads archives through the cache
+        stats = getDataCache().stats()
+        self.assertEqual(DataIterator([dp], return_X=True).asList()[0][0].tolist(), paddedData(11)[0][0].tolist())
+        self.assertEqual(getDataCache().stats()["misses"], stats["misses"])
+
+    def test_data_meta(self):
+        dps = [DataProcedure(self.directory, True, paddedData, n) for n in [13, 8]]
+        ragged = DataProcedure(self.directory + "r/", True, paddedData, 13)
+        ragged.ragged_archive = True
+        for dp in dps + [ragged]:
+            self.assertEqual(dp.num_samples(), None)
+            dp.getData(verbose=0)
+        for dp in [dps[0], ragged]:
+            self.assertEqual(dp.num_samples(), 13)
+            self.assertEqual(dp.shapes(), {"X" : [(13, 4, 2)], "Y" : [(13, 2)]})
+            self.assertEqual(dp.dtypes(), {"X" : [np.dtype('float32')], "Y" : [np.dtype('float64')]})
+
+        #Archives from before the metadata was recorded get it from their headers
+        for key in ["num_samples", "shapes", "dtypes"]:
+            dps[1].remove_from_record(key)
+        self.assertEqual(dps[1].num_samples(), 8)
+        self.assertEqual(dps[1].shapes()["X"], [(8, 4, 2)])
+        self.assertFalse("shapes" in dps[1].read_record())
+
+        self.assertEqual(DataIterator(dps).getLength(), 21)
+
+    def test_catalog(self):
+        new_dir = self.directory + "new/"
+        old_dir = self.directory + "old/"
+
+        #A new archive is cataloged as it is written
+        dps = [DataProcedure(new_dir, True, paddedData, n) for n in [3, 4, 5]]
+        for dp in dps:
+            dp.getData(verbose=0)
+        self.assertTrue(catalog.hasCatalog(new_dir))
+        self.assertEqual(sorted([dp.hash() for dp in get_all_data(new_dir)]), sorted([dp.hash() for dp in dps]))
+        self.assertEqual(len(get_data_by_function("padded", new_dir)), 3)
+        self.assertEqual(get_data_by_function("numbered", new_dir), [])
+        rows = catalog.queryCatalog(new_dir, record={"num_samples" : 4})
+        self.assertEqual([row["hash"] for row in rows], [dps[1].hash()])
+        self.assertEqual(DataProcedure.get_all_records(new_dir)[dps[1].hash()]["num_samples"], 4)
+        dps[1].remove_from_archive()
+        self.assertEqual(catalog.queryCatalog(new_dir, record={"num_samples" : 4}), [])
+        self.assertEqual(len(DataProcedure.get_all_paths(new_dir)), 2)
+        self.assertEqual(len(catalog.queryCatalog(new_dir, blob_type="procedure", func="paddedData")), 2)
+        self.assertEqual([f for f in os.listdir(new_dir) if f.endswith(".tmp")], [])
+
+        #Names and functions without special characters are matched as prefixes like re.match, with the index
+        self.assertEqual(catalog._matchCondition("func", "padded", True), ("func >= ? AND func < ?", ["padded", "paddee"]))
+        self.assertEqual(catalog._matchCondition("func", "pad.*Data", True), ("func REGEXP ?", ["pad.*Data"]))
+        for func in ["padded", "paddedData", "pad.*Data", "^p"]:
+            self.assertEqual(len(catalog.queryCatalog(new_dir, func=func, regex=True)), 2)
+        self.assertEqual(catalog.queryCatalog(new_dir, func="Data", regex=True), [])
+
+        #Blobs with an empty record are left out, like when the archive is scanned
+        with open(dps[2].get_path() + "record.json", "w") as f:
+            json.dump({}, f)
+        catalog.updateCatalog(new_dir, dps[2].hash())
+        self.assertEqual([dp.hash() for dp in get_data_by_function("padded", new_dir)], [dps[0].hash()])
+        self.assertEqual(list(DataProcedure.get_all_records(new_dir).keys()), [dps[0].hash()])
+        os.remove(catalog.catalogPath(new_dir))
+        self.assertEqual([dp.hash() for dp in get_data_by_function("padded", new_dir)], [dps[0].hash()])
+
+        #An archive with blobs from before it had a catalog is scanned until the catalog is rebuilt
+        DataProcedure(old_dir, True, paddedData, 3).getData(verbose=0)
+        os.remove(catalog.catalogPath(old_dir))
+        catalog._uncataloged.clear()
+        DataProcedure(old_dir, True, paddedData, 4).getData(verbose=0)
+        self.assertFalse(catalog.hasCatalog(old_dir))
+        self.assertEqual(len(get_data_by_function("padded", old_dir)), 2)
+        self.assertEqual(catalog.rebuildCatalog(old_dir), 2)
+        self.assertEqual(len(get_data_by_function("padded", old_dir)), 2)
+
+        #Other processes can't write to the catalog between the listing of the blobs and their rows being replaced
+        listed = []
+        def lockedHashcodes(archive_dir):
+            other = sqlite3.connect(catalog.catalogPath(archive_dir), timeout=0)
+            self.assertRaises(sqlite3.OperationalError, other.execute, "DELETE FROM blobs")
+            other.close()
+            listed.append(archive_dir)
+            return all_hashcodes(archive_dir)
+        all_hashcodes = catalog._allHashcodes
+        catalog._allHashcodes = lockedHashcodes
+        try:
+            self.assertEqual(catalog.rebuildCatalog(old_dir), 2)
+        finally:
+            catalog._allHashcodes = all_hashcodes
+        self.assertEqual(listed, [old_dir])
+
+    def test_manifest(self):
+        source = self.directory + "source.root"
+        with open(source, "w") as f:
+            f.write("0123456789")
+        with open(self.directory + "out.h5", "w") as f:
+            f.write("output")
+        hashed = []
+        checksum = manifest.fileChecksum
+        def countedChecksum(filepath, blocksize=1 << 20):
+            hashed.append(filepath)
+            return checksum(filepath, blocksize)
+        manifest.fileChecksum = countedChecksum
+        try:
+            manifest.recordConversion(self.directory, "out.h5", source, 10)
+            self.assertEqual(len(hashed), 1)
+            #Unchanged sources are recognized by their size and mtime without hashing them
+            self.assertEqual(manifest.isConverted(self.directory, "out.h5", source)["entries"], 10)
+            self.assertEqual(len(hashed), 1)
+            #A source that was touched is hashed once, and the record is updated
+            st = os.stat(source)
+            os.utime(source, (st.st_atime, st.st_mtime + 10))
+            self.assertNotEqual(manifest.isConverted(self.directory, "out.h5", source), None)
+            self.assertNotEqual(manifest.isConverted(self.directory, "out.h5", source), None)
+            self.assertEqual(len(hashed), 2)
+            #A source that changed is not converted, and is not hashed again when it is recorded
+            with open(source, "w") as f:
+                f.write("9876543210")
+            os.utime(source, (st.st_atime, st.st_mtime + 20))
+            self.assertEqual(manifest.isConverted(self.directory, "out.h5", source), None)
+            manifest.recordConversion(self.directory, "out.h5", source, 10)
+            self.assertEqual(len(hashed), 3)
+            with open(source, "w") as f:
+                f.write("01234")
+            self.assertEqual(manifest.isConverted(self.directory, "out.h5", source), None)
+            self.assertEqual(len(hashed), 3)
+        finally:
+            manifest.fileChecksum = checksum
+
+    def test_entry_index(self):
+        files = [self.directory + "%03i.h5" % i for i in range(3)]
+        rng = np.random.RandomState(5)
+        for f, n in zip(files, [7, 5, 9]):
+            storeNumValues(f, {"A" : rng.randint(0, 4, size=n), "B" : rng.randint(0, 2, size=n)})
+        read = []
+        def read_num_values(f):
+            read.append(f)
+            return readNumValues(f)
+
+        index = entry_index.loadEntryIndex(self.directory, files, read_num_values)
+        self.assertEqual(read, files)
+        self.assertEqual(index.numEntries(), 21)
+        self.assertEqual(index.locate(5, 10), [(0, 5, 2), (1, 0, 5), (2, 0, 3)])
+        self.assertEqual(index.locate(19, 10), [(2, 7, 2)])
+        num_vals = readNumValues(files[2])
+        ranges = index.rowRanges(2, 3, 4)
+        for key in num_vals.columns:
+            self.assertEqual(ranges[key], (num_vals[key][:3].sum(), num_vals[key][:7].sum()))
+
+        #Only changed files are read again, and the index is kept in the directory
+        storeNumValues(files[1], {"A" : [1, 2, 3, 0], "B" : [0, 0, 1, 1]})
+        del read[:]
+        entry_index._loaded.clear()
+        index = entry_index.loadEntryIndex(self.directory, files, read_num_values)
+        self.assertEqual(read, [files[1]])
+        self.assertEqual(index.numEntries(), 20)
+        self.assertTrue(np.array_equal(index.numValues(1), readNumValues(files[1])[index.keys].values))
+        entry_index._loaded.clear()
+        index = entry_index.loadEntryIndex(self.directory, files, read_num_values)
+        self.assertEqual(read, [files[1]])
+
+    def test_dataset_stats(self):
+        num_vals = pd.DataFrame({"A" : [0, 2, 2, 5], "B" : [1, 1, 1, 1]})
+        stats = dataset_stats.numValuesStats(num_vals)
+        self.assertEqual(stats["entries"], 4)
+        self.assertEqual(stats["objects"]["A"], {"rows" : 9, "max" : 5, "hist" : [1, 0, 2, 0, 0, 1]})
+        merged = dataset_stats.mergeStats([stats, dataset_stats.numValuesStats(pd.DataFrame({"A" : [1, 7]}))])
+        self.assertEqual(merged["entries"], 6)
+        self.assertEqual(merged["objects"]["A"], {"rows" : 17, "max" : 7, "hist" : [1, 1, 2, 0, 0, 1, 0, 1]})
+        self.assertEqual(merged["objects"]["B"]["rows"], 4)
+        self.assertEqual(dataset_stats.multiplicityQuantile(merged["objects"]["A"], .5), 2)
+        self.assertEqual(dataset_stats.multiplicityQuantile(merged["objects"]["A"], 1.0), 7)
+
+        #The statistics are kept in the manifest, so the files are not read again until they change
+        files = [self.directory + "%03i.h5" % i for i in range(2)]
+        storeNumValues(files[0], {"A" : [0, 2, 2, 5]})
+        storeNumValues(files[1], {"A" : [1, 7]})
+        read = []
+        def read_num_values(f):
+            read.append(f)
+            return readNumValues(f)
+        stats = dataset_stats.directoryStats(self.directory, files, read_num_values)
+        self.assertEqual(read, files)
+        self.assertEqual(dataset_stats.mergeStats(list(stats.values()))["objects"]["A"], merged["objects"]["A"])
+        stats = dataset_stats.directoryStats(self.directory, files, read_num_values)
+        self.assertEqual(read, files)
+        self.assertEqual(stats[files[0]]["entries"], 4)
+        storeNumValues(files[1], {"A" : [1, 7, 3]})
+        stats = dataset_stats.directoryStats(self.directory, files, read_num_values)
+        self.assertEqual(read, files + [files[1]])
+        self.assertEqual(stats[files[1]]["entries"], 3)
+
+    @unittest.skipIf(columnar.pa is None, "requires pyarrow")
+    def test_columnar(self):
+        frames = {"NumValues" : pd.DataFrame({"Electron" : [2, 0, 1, 3, 1]}),
+                  "Electron" : pd.DataFrame({"Entry" : [0, 0, 2, 3, 3, 3, 4], "PT" : np.arange(7, dtype='float64')})}
+        path = self.directory + "frames" + columnar.PARQUET_EXT
+        columnar.writeParquetFrames(path, frames, row_group_entries=2)
+        self.assertEqual(sorted(columnar.parquetColumns(path, "Electron")), ["Entry", "PT"])
+        self.assertTrue(columnar.readParquetNumValues(path).equals(frames["NumValues"]))
+        self.assertTrue(columnar.readParquetFrame(path, "Electron").equals(frames["Electron"]))
+        electrons = columnar.readParquetFrame(path, "Electron", start=2, stop=6, columns=["PT"])
+        self.assertEqual(electrons["PT"].tolist(), [2.0, 3.0, 4.0, 5.0])
+
+if __name__ == '__main__':
+    unittest.main()